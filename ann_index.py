@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""
+Approximate nearest-neighbour indexes over face encodings
+Used for campus-wide identification, where a face is matched against every
+registered student instead of one course's gallery
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+# File locking keeps one process at a time writing the saved index where available
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from face_utils import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+def _top_k(scores, ids, k):
+    """Best k (ids, scores) per row of a similarity matrix, best first"""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64), np.zeros((scores.shape[0], 0), dtype=np.float32)
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    return ids[top], np.take_along_axis(top_scores, order, axis=1)
+
+class BruteForceIndex:
+    """Exact search: every query is scored against every stored vector"""
+
+    kind = 'brute'
+
+    def __init__(self, dim):
+        self.dim = dim
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._lock = threading.Lock()
+        self.generation = None  # caller-defined state of the data the index was saved at
+
+    def __len__(self):
+        return len(self._ids)
+
+    def train(self, vectors):
+        # Nothing to learn
+        pass
+
+    def add(self, ids, vectors):
+        """Add or replace vectors; ids already present are overwritten"""
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = normalize_rows(vectors)
+        with self._lock:
+            keep = ~np.isin(self._ids, ids)
+            self._ids = np.concatenate([self._ids[keep], ids])
+            self._vectors = np.vstack([self._vectors[keep], vectors])
+
+    def remove(self, ids):
+        with self._lock:
+            keep = ~np.isin(self._ids, np.asarray(ids, dtype=np.int64))
+            self._ids = self._ids[keep]
+            self._vectors = self._vectors[keep]
+
+    def search(self, queries, k=5):
+        """Return (ids, scores), each (n_queries, k), by cosine similarity"""
+        queries = normalize_rows(queries)
+        with self._lock:
+            return _top_k(queries @ self._vectors.T, self._ids, k)
+
+    def save(self, path, generation=None):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, ids=self._ids, vectors=self._vectors, generation=np.array(json.dumps(generation)))
+        os.replace(tmp, path)
+        self.generation = generation
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data['vectors'].shape[1])
+        index._ids = data['ids']
+        index._vectors = data['vectors']
+        index.generation = json.loads(str(data['generation'])) if 'generation' in data else None
+        return index
+
+class IVFIndex:
+    """
+    Inverted-file index: vectors are bucketed by their nearest k-means
+    centroid and a query only scans the n_probe closest buckets
+
+    Supports incremental add/remove. When saved to a directory, each bucket
+    lives in its own file, so later updates rewrite only the buckets they
+    touch.
+    """
+
+    kind = 'ivf'
+
+    def __init__(self, dim, n_lists=64, n_probe=8, seed=0):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+        self.centroids = None
+        self._list_ids = []
+        self._list_vectors = []
+        self._where = {}  # id -> list number
+        self._lock = threading.Lock()
+        self.path = None  # directory the index is persisted to, if any
+        self.generation = None  # caller-defined state of the data the index was saved at
+
+    def __len__(self):
+        return len(self._where)
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def train(self, vectors, iterations=20):
+        """Fit the bucket centroids with spherical k-means on a sample of vectors"""
+        vectors = normalize_rows(vectors)
+        rng = np.random.default_rng(self.seed)
+        n_lists = max(1, min(self.n_lists, len(vectors)))
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = vectors[assignment == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+                else:
+                    # Re-seed empty buckets with a random vector
+                    centroids[c] = vectors[rng.integers(len(vectors))]
+            centroids = normalize_rows(centroids)
+
+        with self._lock:
+            self.n_lists = n_lists
+            self.centroids = centroids
+            self._list_ids = [np.zeros(0, dtype=np.int64) for _ in range(n_lists)]
+            self._list_vectors = [np.zeros((0, self.dim), dtype=np.float32) for _ in range(n_lists)]
+            self._where = {}
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def add(self, ids, vectors):
+        """Add or replace vectors; ids already present are moved to their new bucket"""
+        if not self.trained:
+            raise ValueError("IVF index must be trained before vectors are added")
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = normalize_rows(vectors)
+        touched = set()
+        with self._lock:
+            touched |= self._remove_locked(ids)
+            assignment = self._assign(vectors)
+            for c in np.unique(assignment):
+                rows = assignment == c
+                self._list_ids[c] = np.concatenate([self._list_ids[c], ids[rows]])
+                self._list_vectors[c] = np.vstack([self._list_vectors[c], vectors[rows]])
+                for student_id in ids[rows]:
+                    self._where[int(student_id)] = int(c)
+                touched.add(int(c))
+            self._persist(touched)
+
+    def _remove_locked(self, ids):
+        touched = set()
+        for student_id in np.asarray(ids, dtype=np.int64):
+            c = self._where.pop(int(student_id), None)
+            if c is None:
+                continue
+            keep = self._list_ids[c] != student_id
+            self._list_ids[c] = self._list_ids[c][keep]
+            self._list_vectors[c] = self._list_vectors[c][keep]
+            touched.add(c)
+        return touched
+
+    def remove(self, ids):
+        with self._lock:
+            self._persist(self._remove_locked(ids))
+
+    def search(self, queries, k=5, n_probe=None):
+        """Return (ids, scores), each (n_queries, k), scanning the n_probe nearest buckets"""
+        queries = normalize_rows(queries)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        all_ids = []
+        all_scores = []
+        with self._lock:
+            probe_lists = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :n_probe]
+            for query, lists in zip(queries, probe_lists):
+                # Score bucket by bucket rather than copying the buckets into one matrix
+                ids = np.concatenate([self._list_ids[c] for c in lists])
+                scores = np.concatenate([self._list_vectors[c] @ query for c in lists])
+                top_ids, top_scores = _top_k(scores[None, :], ids, k)
+                all_ids.append(top_ids[0])
+                all_scores.append(top_scores[0])
+
+        # Pad queries whose probed buckets held fewer than k vectors
+        width = max((len(ids) for ids in all_ids), default=0)
+        ids_out = np.full((len(all_ids), width), -1, dtype=np.int64)
+        scores_out = np.full((len(all_ids), width), -np.inf, dtype=np.float32)
+        for i, (ids, scores) in enumerate(zip(all_ids, all_scores)):
+            ids_out[i, :len(ids)] = ids
+            scores_out[i, :len(scores)] = scores
+        return ids_out, scores_out
+
+    def _list_file(self, c):
+        return os.path.join(self.path, f"list_{c:05d}.npz")
+
+    def _write_list(self, c):
+        tmp = self._list_file(c) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, ids=self._list_ids[c], vectors=self._list_vectors[c])
+        os.replace(tmp, self._list_file(c))
+
+    def _persist(self, lists):
+        if self.path is not None:
+            for c in lists:
+                self._write_list(c)
+
+    def save(self, path, generation=None, attach=True):
+        """
+        Write the whole index to a directory, replacing it atomically
+
+        With attach, later add() and remove() calls rewrite the touched
+        bucket files; only do that when no other process writes the same
+        directory.
+        """
+        tmp = path.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        with self._lock:
+            self.path = tmp
+            np.save(os.path.join(tmp, 'centroids.npy'), self.centroids)
+            for c in range(self.n_lists):
+                self._write_list(c)
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'kind': self.kind, 'dim': self.dim, 'n_lists': self.n_lists,
+                           'n_probe': self.n_probe, 'seed': self.seed, 'generation': generation}, f)
+            old = path.rstrip(os.sep) + '.old'
+            shutil.rmtree(old, ignore_errors=True)
+            if os.path.exists(path):
+                os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old, ignore_errors=True)
+            self.path = path if attach else None
+            self.generation = generation
+
+    @classmethod
+    def load(cls, path, attach=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        index = cls(meta['dim'], n_lists=meta['n_lists'], n_probe=meta['n_probe'], seed=meta['seed'])
+        index.generation = meta.get('generation')
+        index.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        for c in range(index.n_lists):
+            data = np.load(os.path.join(path, f"list_{c:05d}.npz"))
+            index._list_ids.append(data['ids'])
+            index._list_vectors.append(data['vectors'])
+            for student_id in data['ids']:
+                index._where[int(student_id)] = c
+        index.path = path if attach else None
+        return index
+
+INDEX_TYPES = {
+    BruteForceIndex.kind: BruteForceIndex,
+    IVFIndex.kind: IVFIndex,
+}
+
+def build_index(kind, ids, vectors, **options):
+    """Create, train and fill an index of the given kind"""
+    vectors = normalize_rows(vectors)
+    index = INDEX_TYPES[kind](vectors.shape[1], **options)
+    index.train(vectors)
+    index.add(ids, vectors)
+    return index
+
+def load_index(path, attach=True):
+    """Load an index saved with save(); directories are IVF indexes, files brute-force ones"""
+    if os.path.isdir(path):
+        return IVFIndex.load(path, attach=attach)
+    return BruteForceIndex.load(path)
+
+def read_index_generation(path):
+    """Generation an index was saved at, without loading its vectors; None if there is none"""
+    try:
+        if os.path.isdir(path):
+            with open(os.path.join(path, 'meta.json')) as f:
+                return json.load(f).get('generation')
+        with np.load(path) as data:
+            return json.loads(str(data['generation'])) if 'generation' in data else None
+    except (OSError, ValueError, KeyError):
+        return None
+
+class CampusIndex:
+    """
+    Lazily built index over every registered student, shared by the routes
+
+    Other worker processes register and delete students too, so get()
+    compares the index with a generation read from the database at most
+    every check_interval seconds. Students registered since are added to
+    it; any other change rebuilds it. A saved copy at `path` is only used
+    when it was saved at the current generation, and is written by one
+    process at a time, under a file lock. Small galleries get an exact
+    index: below min_ivf_size students a scan is as fast as probing buckets.
+    """
+
+    def __init__(self, kind='ivf', path=None, min_ivf_size=1000, check_interval=10, **options):
+        self.kind = kind
+        self.path = path
+        self.min_ivf_size = min_ivf_size
+        self.check_interval = check_interval
+        self.options = options
+        self._index = None
+        self._generation = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self, loader, generation, updates=None, dim=None):
+        """
+        Return the index, building or refreshing it when the students have changed
+
+        loader() returns (ids, encodings) for all registered students.
+        generation() returns [key, registered count, last registration]
+        (JSON values), where key changes with anything that invalidates
+        every vector, e.g. the projection. updates(last registration)
+        returns (ids, encodings) of the students registered at or after
+        that time. dim, if given, is the expected vector dimension.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._index is not None and now - self._checked_at < self.check_interval:
+                return self._index
+            current = generation()
+            self._checked_at = now
+            if self._index is not None and current == self._generation:
+                return self._index
+
+            if self._index is not None and updates is not None and self._refresh(current, updates):
+                self._generation = current
+                self._save(self._index, generation)
+                return self._index
+
+            self._index = self._load(current, dim)
+            self._generation = current
+            if self._index is None:
+                ids, encodings = loader()
+                self._index = self._build(ids, encodings)
+                if self._index is not None:
+                    self._save(self._index, generation)
+            return self._index
+
+    def _refresh(self, current, updates):
+        """Add the students registered since the last check; False if the index must be rebuilt instead"""
+        key, count, _ = current
+        previous_key, _, previous_last = self._generation
+        if key != previous_key:
+            return False
+        ids, encodings = updates(previous_last)
+        try:
+            if len(ids):
+                self._index.add(ids, np.vstack(encodings))
+        except ValueError as e:
+            logger.warning(f"Could not update face index, rebuilding: {str(e)}")
+            return False
+        if len(self._index) != count:
+            # Students were deleted or lost their encoding
+            return False
+        logger.info(f"Added {len(ids)} newly registered students to the face index")
+        return True
+
+    def _file_lock(self, exclusive):
+        """Open and lock the index's lock file; closing it releases the lock"""
+        lock_file = open(self.path.rstrip(os.sep) + '.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock_file
+
+    def _load(self, current, dim):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with self._file_lock(exclusive=False):
+                # Workers keep their own copy; only _save writes the files
+                index = load_index(self.path, attach=False)
+        except Exception as e:
+            logger.warning(f"Could not load saved face index from {self.path}: {str(e)}")
+            return None
+        if dim is not None and index.dim != dim:
+            logger.info(f"Saved face index has {index.dim} dimensions instead of {dim}; rebuilding")
+            return None
+        if index.generation != current:
+            logger.info(f"Saved face index is from {index.generation}, the students are at {current}; rebuilding")
+            return None
+        logger.info(f"Loaded face index with {len(index)} students from {self.path}")
+        return index
+
+    def _build(self, ids, encodings):
+        if len(ids) == 0:
+            return None
+        kind = self.kind
+        options = self.options if kind == IVFIndex.kind else {}
+        if kind == IVFIndex.kind and len(ids) < self.min_ivf_size:
+            kind = BruteForceIndex.kind
+            options = {}
+        start = time.perf_counter()
+        index = build_index(kind, ids, np.vstack(encodings), **options)
+        logger.info(f"Built {kind} face index over {len(ids)} students in {time.perf_counter() - start:.1f}s")
+        return index
+
+    def _save(self, index, generation):
+        """
+        Save the index if it is still current and not saved yet
+
+        The generation is read again once the lock is held, so a process
+        whose view is already out of date never overwrites a newer copy.
+        """
+        if not self.path:
+            return
+        try:
+            with self._file_lock(exclusive=True):
+                current = generation()
+                if current != self._generation or read_index_generation(self.path) == current:
+                    return
+                if isinstance(index, IVFIndex):
+                    index.save(self.path, generation=current, attach=False)
+                else:
+                    index.save(self.path, generation=current)
+        except Exception as e:
+            logger.error(f"Error saving face index to {self.path}: {str(e)}")
+
+    def add(self, student_id, encoding):
+        """Insert or replace one student in this process's index; a no-op until it has been built"""
+        with self._lock:
+            if self._index is None:
+                return
+            try:
+                self._index.add([student_id], np.asarray(encoding)[None, :])
+            except ValueError as e:
+                # e.g. an encoding of another dimension; the next rebuild sorts it out
+                logger.warning(f"Dropping face index after failed update for student {student_id}: {str(e)}")
+                self._index = None
+
+    def remove(self, student_ids):
+        """Remove students from this process's index if it has been built"""
+        with self._lock:
+            if self._index is None:
+                return
+            self._index.remove(student_ids)
+
+def recall_benchmark(index, ids, vectors, queries, k=5):
+    """
+    Compare an index against exact brute-force search
+
+    Returns recall@k (fraction of the true top-k found by the index) and
+    the mean per-query latency of both searches, in milliseconds.
+    """
+    exact = BruteForceIndex(vectors.shape[1])
+    exact.add(ids, vectors)
+
+    start = time.perf_counter()
+    true_ids, _ = exact.search(queries, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    found_ids, _ = index.search(queries, k)
+    index_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    hits = sum(len(set(t.tolist()) & set(f.tolist())) for t, f in zip(true_ids, found_ids))
+    return {
+        'kind': index.kind,
+        'size': len(ids),
+        'k': k,
+        f'recall@{k}': hits / true_ids.size if true_ids.size else 1.0,
+        'exact_ms_per_query': exact_ms,
+        'index_ms_per_query': index_ms,
+    }
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Recall benchmark of the ANN index on synthetic clustered encodings')
+    parser.add_argument('--students', type=int, default=20000, help='Number of gallery vectors')
+    parser.add_argument('--dim', type=int, default=512, help='Vector dimension')
+    parser.add_argument('--queries', type=int, default=200, help='Number of noisy probe queries')
+    parser.add_argument('--lists', type=int, default=128, help='IVF bucket count')
+    parser.add_argument('--probe', type=int, nargs='+', default=[4, 8, 16], help='Buckets scanned per query')
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # Clustered vectors loosely mimic real encodings, which are far from uniform
+    centers = rng.normal(size=(64, args.dim))
+    gallery = centers[rng.integers(64, size=args.students)] + rng.normal(scale=0.5, size=(args.students, args.dim))
+    gallery_ids = np.arange(args.students)
+    picks = rng.integers(args.students, size=args.queries)
+    queries = gallery[picks] + rng.normal(scale=0.2, size=(args.queries, args.dim))
+
+    ivf = build_index('ivf', gallery_ids, gallery, n_lists=args.lists)
+    for n_probe in args.probe:
+        ivf.n_probe = n_probe
+        report = recall_benchmark(ivf, gallery_ids, gallery, queries, k=args.k)
+        report['n_probe'] = n_probe
+        print(json.dumps(report))
@@ -1,17 +1,31 @@
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, date
 import numpy as np
 import cv2
-from flask import Flask, render_template, redirect, url_for, request, jsonify, session, flash
+from flask import Flask, render_template, redirect, url_for, request, jsonify, session, flash, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.dialects import postgresql, sqlite
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import base64
 from io import BytesIO
 import json
+import threading
 from face_utils import process_and_encode_face, recognize_faces, process_image_data, detect_face, extract_face_features
+from face_utils import encode_face_encoding, load_face_encoding, match_probe_faces
+from face_utils import match_face_features, build_face_prototype, REGISTRATION_MESSAGES, RERANK_MARGIN
+from recognition_pool import recognition_pool, registration_job, probe_job, PoolSaturated
+from attendance_jobs import JobQueue, JobQueueFull
+from attendance_sessions import SessionStore, SessionLimitReached, FRAME_STREAM_MIMETYPE, read_frame_stream
+from micro_batcher import recognition_batcher
+from gallery_cache import gallery_cache, build_gallery
+from gallery_store import GalleryStore
+from ann_index import CampusIndex
+import face_projection
+import metrics
+from attendance_export import EXPORT_BATCH_SIZE, EXPORT_FORMATS, available_export_formats, iter_export
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -62,6 +76,26 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 }
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Storage precision of face encodings: float32 (default) or float16 for half the size
+app.config["FACE_ENCODING_DTYPE"] = os.environ.get("FACE_ENCODING_DTYPE", "float32")
+
+# Size and JPEG quality browsers capture at before uploading (see static/js/webcam.js)
+app.config["CAPTURE_CONFIG"] = {
+    "maxWidth": int(os.environ.get("CAPTURE_MAX_WIDTH", "640")),
+    "quality": float(os.environ.get("CAPTURE_JPEG_QUALITY", "0.85")),
+    # Snapshots taken per face registration
+    "enrollmentShots": int(os.environ.get("FACE_ENROLLMENT_SHOTS", "3")),
+}
+
+# Enrollment templates kept per student; the oldest are dropped beyond this
+app.config["FACE_TEMPLATE_LIMIT"] = int(os.environ.get("FACE_TEMPLATE_LIMIT", "5"))
+
+# In-memory precision of course galleries: float32 (default), float16 or int8
+app.config["GALLERY_DTYPE"] = os.environ.get("GALLERY_DTYPE", "float32")
+
+# Seconds a process keeps a course gallery before re-reading it (0 = until invalidated, single worker only)
+app.config["GALLERY_CACHE_TTL"] = float(os.environ.get("GALLERY_CACHE_TTL", "30"))
+
 # Initialize database with app
 db.init_app(app)
 
@@ -71,7 +105,7 @@ from face_utils import process_and_encode_face, recognize_faces
 # Initialize models and create tables within app context
 with app.app_context():
     # Import models here to avoid circular imports
-    from models import User, Student, Course, Attendance
+    from models import User, Student, Course, Attendance, FaceTemplate, student_course_association
     db.create_all()
     
     # Add missing columns if they don't exist
@@ -91,6 +125,444 @@ with app.app_context():
         logger.error(f"Error adding columns to users table: {str(e)}")
         # Since we're in app context, this is safe
         db.session.rollback()
+    
+    # Binary face encoding column replacing the JSON text column
+    try:
+        db.session.execute(text("ALTER TABLE students ADD COLUMN IF NOT EXISTS face_encoding_bin BYTEA"))
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Error adding face_encoding_bin column to students table: {str(e)}")
+        db.session.rollback()
+    
+    # Per-day attendance column backing the one-mark-per-day unique constraint
+    # Committed on its own: PostgreSQL DDL is transactional, so a failing index below must not roll the column back
+    try:
+        db.session.execute(text("ALTER TABLE attendances ADD COLUMN IF NOT EXISTS attendance_date DATE"))
+        db.session.execute(text("UPDATE attendances SET attendance_date = CAST(timestamp AS DATE) WHERE attendance_date IS NULL"))
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Error adding attendance_date column to attendances table: {str(e)}")
+        db.session.rollback()
+    
+    # Duplicates left by the old check-then-insert race make this fail; attendance data is not deleted automatically
+    try:
+        db.session.execute(text("""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_attendance_student_course_date
+        ON attendances (student_id, course_id, attendance_date)
+        """))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(
+            "Skipped the one-attendance-per-day unique index on attendances, probably because of existing same-day "
+            "duplicates; students can be marked twice on a day until it exists. Remove the duplicates with "
+            "DELETE FROM attendances a USING attendances b WHERE a.student_id = b.student_id AND "
+            "a.course_id = b.course_id AND a.attendance_date = b.attendance_date AND a.id > b.id "
+            f"and restart. Error: {str(e)}"
+        )
+    
+    # Day-scoped per-course lookups; independent of the unique index, so a duplicate-key failure cannot drop it
+    try:
+        db.session.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_attendance_course_date_student
+        ON attendances (course_id, attendance_date, student_id)
+        """))
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Error creating idx_attendance_course_date_student index on attendances table: {str(e)}")
+        db.session.rollback()
+
+def migrate_legacy_face_encodings(batch_size=100):
+    """
+    Convert JSON face encodings to the binary format, one batch per transaction
+    
+    Runs online: routes read either column while rows are being converted,
+    so the app can serve requests during the migration.
+    """
+    converted = 0
+    failed_ids = set()
+    with app.app_context():
+        while True:
+            query = Student.query.filter(Student.face_encoding.isnot(None))
+            if failed_ids:
+                query = query.filter(Student.id.notin_(failed_ids))
+            batch = query.order_by(Student.id).limit(batch_size).all()
+            if not batch:
+                break
+            
+            for student in batch:
+                try:
+                    if student.face_encoding_bin is None:
+                        student.face_encoding_bin = encode_face_encoding(json.loads(student.face_encoding),
+                                                                         dtype=app.config["FACE_ENCODING_DTYPE"])
+                    student.face_encoding = None
+                    converted += 1
+                except Exception as e:
+                    failed_ids.add(student.id)
+                    logger.warning(f"Could not convert face encoding for student {student.id}: {str(e)}")
+            
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error migrating face encodings: {str(e)}")
+                return converted
+        
+        if converted:
+            gallery_cache.invalidate()
+            logger.info(f"Converted {converted} face encodings to the binary format")
+    return converted
+
+# Fork the optional recognition workers before any other thread is started
+recognition_pool.start()
+
+# Background queue for /mark_attendance_async; jobs are per process, so polls need sticky routing
+attendance_jobs = JobQueue(
+    handler=lambda payload: run_attendance_job(payload),
+    workers=int(os.environ.get("ATTENDANCE_JOB_WORKERS", "2")),
+    max_queued=int(os.environ.get("ATTENDANCE_JOB_QUEUE_SIZE", "100")),
+)
+
+# Index over every registered student for campus-wide /identify, built on first use and
+# checked against the database every FACE_INDEX_CHECK_INTERVAL seconds for other workers' changes
+campus_index = CampusIndex(
+    kind=os.environ.get("FACE_INDEX_KIND", "ivf"),
+    path=os.environ.get("FACE_INDEX_PATH") or None,
+    check_interval=float(os.environ.get("FACE_INDEX_CHECK_INTERVAL", "10")),
+    n_lists=int(os.environ.get("FACE_INDEX_LISTS", "64")),
+    n_probe=int(os.environ.get("FACE_INDEX_PROBE", "8")),
+)
+
+# Open video attendance sessions; frames of a session must reach the process that opened it
+attendance_sessions = SessionStore(
+    max_sessions=int(os.environ.get("ATTENDANCE_SESSION_LIMIT", "20")),
+    idle_timeout=int(os.environ.get("ATTENDANCE_SESSION_IDLE_TIMEOUT", "120")),
+    embeddings_per_track=int(os.environ.get("ATTENDANCE_SESSION_EMBEDDINGS", "3")),
+    detect_interval=int(os.environ.get("ATTENDANCE_SESSION_DETECT_INTERVAL", "5")),
+)
+
+# Memory-mapped gallery file shared by all worker processes, when configured; rebuilt once the loaders below exist
+gallery_store = GalleryStore(
+    os.environ["GALLERY_FILE_PATH"],
+    builder=lambda: load_all_course_galleries(),
+    dtype=app.config["GALLERY_DTYPE"],
+    projection_version=face_projection.active_projection.version if face_projection.active_projection is not None else None,
+) if os.environ.get("GALLERY_FILE_PATH") else None
+
+# Without the shared file, registrations invalidate only the worker that handled them
+gallery_cache.ttl = app.config["GALLERY_CACHE_TTL"] or None
+if gallery_store is None and gallery_cache.ttl is None:
+    logger.warning("GALLERY_CACHE_TTL=0 without GALLERY_FILE_PATH: course galleries are cached until invalidated, "
+                   "so with more than one server worker the others keep matching against stale galleries")
+
+# Queue, cache and pool state is read only when /metrics is scraped
+metrics.registry.callback('face_gallery_cache_hits_total', 'Course gallery cache hits',
+                          lambda: gallery_cache.stats()["hits"], kind='counter')
+metrics.registry.callback('face_gallery_cache_misses_total', 'Course gallery cache misses (gallery built from the database)',
+                          lambda: gallery_cache.stats()["misses"], kind='counter')
+metrics.registry.callback('face_gallery_cache_courses', 'Course galleries cached in this process',
+                          lambda: gallery_cache.stats()["courses"])
+metrics.registry.callback('face_recognition_pool_pending', 'Jobs queued or running in the recognition pool',
+                          lambda: recognition_pool.pending)
+metrics.registry.callback('face_recognition_pool_rejected_total', 'Jobs refused because the recognition pool was full',
+                          lambda: recognition_pool.rejected, kind='counter')
+metrics.registry.callback('face_attendance_jobs_queued', 'Asynchronous attendance jobs waiting for a worker',
+                          lambda: attendance_jobs.depth)
+metrics.registry.callback('face_attendance_sessions_open', 'Open roll-call sessions',
+                          lambda: len(attendance_sessions))
+
+# Convert remaining JSON encodings in the background so startup is not blocked
+threading.Thread(target=migrate_legacy_face_encodings, name="face-encoding-migration", daemon=True).start()
+
+def load_course_templates(course_id):
+    """Raw enrollment templates used in the prototypes of a course's students, by student id"""
+    templates = {}
+    query = (FaceTemplate.query
+             .join(student_course_association, FaceTemplate.student_id == student_course_association.c.student_id)
+             .filter(student_course_association.c.course_id == course_id, FaceTemplate.outlier.is_(False))
+             .order_by(FaceTemplate.id))
+    for template in query:
+        try:
+            templates.setdefault(template.student_id, []).append(load_face_encoding(template.encoding))
+        except Exception as e:
+            logger.warning(f"Could not load face template {template.id} of student {template.student_id}: {str(e)}")
+    return templates
+
+def load_course_gallery(course_id):
+    """
+    Decode the registered face encodings of a course's students into a gallery
+    
+    The enrollment templates are kept with it, so near-threshold matches are
+    re-ranked without going back to the database; FACE_RERANK_MARGIN=0
+    turns re-ranking off and keeps none.
+    """
+    course = Course.query.get(course_id)
+    if not course:
+        return build_gallery([], [])
+    
+    encodings = []
+    ids = []
+    names = {}
+    registered = db.or_(Student.face_encoding_bin.isnot(None), Student.face_encoding.isnot(None))
+    for student in course.students.filter(registered):
+        try:
+            encodings.append(load_face_encoding(student.stored_face_encoding))
+            ids.append(student.id)
+            names[student.id] = student.name
+        except Exception as e:
+            logger.warning(f"Could not load face encoding for student {student.id} ({student.name}): {str(e)}")
+    
+    return build_gallery(encodings, ids, names, projection=face_projection.active_projection,
+                         dtype=app.config["GALLERY_DTYPE"],
+                         templates=load_course_templates(course_id) if RERANK_MARGIN > 0 else None)
+
+def load_all_course_galleries():
+    """Every course's gallery, for rebuilding the shared gallery file"""
+    with app.app_context():
+        return {course.id: load_course_gallery(course.id) for course in Course.query.all()}
+
+# Rebuild the shared file once per start, so it reflects the database and the current configuration
+if gallery_store is not None:
+    gallery_store.request_rebuild()
+
+def get_course_gallery(course_id):
+    """
+    Gallery of a course, from the shared gallery file when configured
+    
+    Falls back to this process's gallery cache while the file does not
+    exist yet, was built under another configuration or does not contain
+    the course.
+    """
+    if gallery_store is not None:
+        gallery = gallery_store.get(course_id)
+        if gallery is not None:
+            return gallery
+    return gallery_cache.get(course_id, load_course_gallery)
+
+def invalidate_galleries(course_ids):
+    """
+    Drop the galleries of courses whose encodings or enrollments changed
+    
+    Call after committing. With a shared gallery file the file is rebuilt
+    in the background; other workers re-map it on their next request.
+    Without it, other workers rebuild the course once GALLERY_CACHE_TTL
+    has passed.
+    """
+    gallery_cache.invalidate(course_ids)
+    if gallery_store is not None:
+        gallery_store.request_rebuild()
+
+def registered_students():
+    return Student.query.filter(db.or_(Student.face_encoding_bin.isnot(None), Student.face_encoding.isnot(None)))
+
+def iter_registered_encodings():
+    """Yield (student id, raw encoding) for every registered student"""
+    for student in registered_students().order_by(Student.id).yield_per(500):
+        try:
+            yield student.id, load_face_encoding(student.stored_face_encoding)
+        except Exception as e:
+            logger.warning(f"Could not load face encoding for student {student.id} ({student.name}): {str(e)}")
+
+def iter_face_templates():
+    """Yield (student id, raw encoding) for every enrollment template used in a prototype"""
+    for template in FaceTemplate.query.filter(FaceTemplate.outlier.is_(False)).order_by(FaceTemplate.id).yield_per(500):
+        try:
+            yield template.student_id, load_face_encoding(template.encoding)
+        except Exception as e:
+            logger.warning(f"Could not load face template {template.id} of student {template.student_id}: {str(e)}")
+
+def load_campus_encodings(chunk_size=1000):
+    """Encodings of every registered student for the campus index, projected in chunks"""
+    ids = []
+    chunks = []
+    pending = []
+    for student_id, encoding in iter_registered_encodings():
+        ids.append(student_id)
+        pending.append(encoding)
+        if len(pending) == chunk_size:
+            chunks.append(face_projection.project_features(np.vstack(pending)))
+            pending = []
+    if pending:
+        chunks.append(face_projection.project_features(np.vstack(pending)))
+    return ids, chunks
+
+def load_campus_updates(since):
+    """Projected encodings of the students whose templates were created at or after since (isoformat, None for all)"""
+    if since:
+        recent = Student.face_templates.any(FaceTemplate.created_at >= datetime.fromisoformat(since))
+    else:
+        recent = Student.face_templates.any()
+    query = registered_students().filter(recent)
+    ids = []
+    encodings = []
+    for student in query.order_by(Student.id):
+        try:
+            encodings.append(face_projection.project_features(load_face_encoding(student.stored_face_encoding)))
+            ids.append(student.id)
+        except Exception as e:
+            logger.warning(f"Could not load face encoding for student {student.id} ({student.name}): {str(e)}")
+    return ids, encodings
+
+def campus_index_generation():
+    """[projection, registered students, last registration] as the campus index compares them"""
+    projection = face_projection.active_projection
+    last_registration = db.session.query(db.func.max(FaceTemplate.created_at)).scalar()
+    return [projection.version if projection is not None else 'raw', registered_students().count(),
+            last_registration.isoformat() if last_registration else None]
+
+def get_campus_index():
+    projection = face_projection.active_projection
+    return campus_index.get(load_campus_encodings, campus_index_generation, updates=load_campus_updates,
+                            dim=projection.dims if projection is not None else None)
+
+def save_face_templates(student, encodings, append=False):
+    """
+    Store new enrollment templates for a student and recompute the prototype
+    
+    The new templates replace the student's existing ones unless append is
+    set. A student registered before templates existed keeps their old
+    encoding as the first template when appending. Only the newest
+    FACE_TEMPLATE_LIMIT templates are kept. The caller commits.
+    
+    Returns the prototype and the number of templates it was built from.
+    """
+    dtype = app.config["FACE_ENCODING_DTYPE"]
+    templates = list(student.face_templates)
+    if not append:
+        for template in templates:
+            db.session.delete(template)
+        templates = []
+    elif not templates and student.has_face_encoding:
+        templates.append(FaceTemplate(encoding=encode_face_encoding(load_face_encoding(student.stored_face_encoding), dtype=dtype)))
+    
+    templates += [FaceTemplate(encoding=encode_face_encoding(encoding, dtype=dtype)) for encoding in encodings]
+    limit = app.config["FACE_TEMPLATE_LIMIT"]
+    for template in templates[:-limit]:
+        if template.id is not None:
+            db.session.delete(template)
+    templates = templates[-limit:]
+    
+    prototype, kept = build_face_prototype(np.vstack([load_face_encoding(template.encoding) for template in templates]))
+    for template, used in zip(templates, kept):
+        template.outlier = not used
+        if template.id is None:
+            student.face_templates.append(template)
+    
+    # Galleries score against the prototype only, in the compact binary format
+    student.face_encoding_bin = encode_face_encoding(prototype, dtype=dtype)
+    student.face_encoding = None
+    return prototype, int(kept.sum())
+
+def record_attendance(course_id, student_ids):
+    """
+    Mark recognized students present in a course, at most once per day
+    
+    Enrollment and same-day duplicates are checked for all students in one
+    query, and the new rows are written with one multi-row insert. The insert
+    skips rows that hit the unique (student, course, day) constraint, so two
+    kiosks recognizing the same student at once cannot both mark them.
+    
+    Returns the names of the students newly marked present.
+    """
+    if not student_ids:
+        return []
+    
+    now = datetime.now()
+    today = now.date()
+    candidates = db.session.query(
+        Student.id, Student.name, student_course_association.c.course_id, Attendance.id
+    ).outerjoin(
+        student_course_association,
+        db.and_(student_course_association.c.student_id == Student.id,
+                student_course_association.c.course_id == course_id)
+    ).outerjoin(
+        Attendance,
+        db.and_(Attendance.student_id == Student.id,
+                Attendance.course_id == course_id,
+                Attendance.attendance_date == today)
+    ).filter(Student.id.in_(student_ids)).all()
+    
+    names = {}
+    new_rows = []
+    for student_id, name, enrolled_course_id, attendance_id in candidates:
+        # Double-check that student is in this course - extra security measure
+        if enrolled_course_id is None:
+            logger.warning(f"Security alert: Student {student_id} ({name}) recognized but not enrolled in course {course_id}")
+            continue
+        if attendance_id is not None:
+            continue
+        names[student_id] = name
+        new_rows.append({
+            'student_id': student_id,
+            'course_id': course_id,
+            'timestamp': now,
+            'attendance_date': today,
+        })
+    
+    if not new_rows:
+        return []
+    
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(db.engine.dialect.name)
+    if dialect is not None:
+        stmt = dialect.insert(Attendance).values(new_rows).on_conflict_do_nothing().returning(Attendance.student_id)
+        inserted_ids = db.session.execute(stmt).scalars().all()
+    else:
+        db.session.execute(db.insert(Attendance), new_rows)
+        inserted_ids = [row['student_id'] for row in new_rows]
+    
+    return [names[student_id] for student_id in inserted_ids]
+
+def record_probe_metrics(endpoint, probes):
+    """Feed a frame's stage timings, detections and rejections into the metrics"""
+    if probes is None:
+        return
+    metrics.record_timings(probes.timings)
+    metrics.faces_detected.inc(probes.detected, endpoint=endpoint)
+    for reason in probes.rejected:
+        metrics.rejections.inc(endpoint=endpoint, reason=reason)
+    # Frame-level failures; a frame whose faces all failed the quality gate is already counted per face
+    if probes.reason is not None and not probes.rejected:
+        metrics.rejections.inc(endpoint=endpoint, reason=probes.reason)
+
+def pool_busy_response():
+    """429 response for when the recognition pool cannot take another job"""
+    response = jsonify({
+        "status": "error",
+        "message": "The server is busy processing other images. Please try again in a moment."
+    })
+    response.headers["Retry-After"] = "1"
+    return response, 429
+
+def get_uploaded_image():
+    """
+    The frame sent with a recognition request
+    
+    Accepts a multipart file field "image", a raw application/octet-stream
+    (or image/*) body, or the legacy base64 "image_data" form field. Raw
+    uploads are passed on as bytes, skipping base64 decoding entirely.
+    """
+    upload = request.files.get('image')
+    if upload is not None:
+        return upload.read() or None
+    if request.mimetype == 'application/octet-stream' or request.mimetype.startswith('image/'):
+        return request.get_data() or None
+    return request.form.get('image_data')
+
+def get_uploaded_images():
+    """Every frame sent with a request: repeated multipart "image" fields, or the single frame of get_uploaded_image()"""
+    uploads = [upload.read() for upload in request.files.getlist('image')]
+    if uploads:
+        return [upload for upload in uploads if upload]
+    image_data = get_uploaded_image()
+    return [image_data] if image_data else []
+
+def get_request_param(name):
+    """A form field, or a query-string parameter when the body is a raw image"""
+    return request.form.get(name) or request.args.get(name)
+
+@app.context_processor
+def inject_capture_config():
+    return {"capture_config": app.config["CAPTURE_CONFIG"]}
 
 # Routes
 @app.route('/')
@@ -205,7 +677,7 @@ def dashboard():
         # Get today's attendance count
         today = datetime.now().date()
         today_attendance = Attendance.query.filter(
-            db.func.date(Attendance.timestamp) == today
+            Attendance.between_days(today, today)
         ).count()
     except Exception as e:
         logger.error(f"Error getting dashboard stats: {str(e)}")
@@ -249,6 +721,7 @@ def students():
                 
                 db.session.add(new_student)
                 db.session.commit()
+                invalidate_galleries([course.id for course in new_student.courses])
                 flash('Student added successfully!', 'success')
         except Exception as e:
             db.session.rollback()
@@ -272,8 +745,11 @@ def delete_student(id):
     
     try:
         student = Student.query.get_or_404(id)
+        enrolled_course_ids = [course.id for course in student.courses]
         db.session.delete(student)
         db.session.commit()
+        invalidate_galleries(enrolled_course_ids)
+        campus_index.remove([id])
         flash('Student deleted successfully!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -340,10 +816,12 @@ def register_face():
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
     
     try:
-        student_id = request.form.get('student_id')
-        image_data = request.form.get('image_data')
+        student_id = get_request_param('student_id')
+        images = get_uploaded_images()
+        # With append, the shots are added to the student's templates instead of replacing them
+        append = get_request_param('append') == '1'
         
-        if not student_id or not image_data:
+        if not student_id or not images:
             return jsonify({
                 "status": "error", 
                 "message": "Missing required parameters"
@@ -357,59 +835,58 @@ def register_face():
                 "message": "Student not found"
             }), 404
             
-        # Process the image to detect face quality
-        image = process_image_data(image_data)
-        if image is None:
-            return jsonify({
-                "status": "error", 
-                "message": "Could not process the image. Please try again."
-            }), 400
-            
-        # Detect faces
-        faces = detect_face(image)
-        
-        # Validate face detection
-        if len(faces) == 0:
-            return jsonify({
-                "status": "error", 
-                "message": "No face detected in the image. Please ensure your face is clearly visible."
-            }), 400
-            
-        if len(faces) > 1:
-            return jsonify({
-                "status": "error", 
-                "message": "Multiple faces detected. Please ensure only one person is in the frame."
-            }), 400
-            
-        # Check face size - should be large enough for good recognition
-        x, y, w, h = faces[0]
-        if w < 100 or h < 100:
-            return jsonify({
-                "status": "error", 
-                "message": "Face is too small in the image. Please move closer to the camera."
-            }), 400
-            
-        # Process and encode the face
-        face_features = process_and_encode_face(image_data)
-        
-        if face_features is None:
+        # Decode, detect, check and encode the face of every shot in a single pass each
+        shots = images[:app.config["FACE_TEMPLATE_LIMIT"]]
+        if recognition_pool.enabled:
+            # Queue the shots before waiting, so the pool processes them in parallel
+            registrations = []
+            futures = []
+            for image_data in shots:
+                try:
+                    futures.append(recognition_pool.submit(registration_job, image_data, count_rejection=False))
+                except PoolSaturated:
+                    # Busy only if the pool is full with other requests' jobs, not this request's own shots
+                    if not futures:
+                        recognition_pool.note_rejection()
+                        return pool_busy_response()
+                    registrations += [future.result(timeout=recognition_pool.timeout) for future in futures]
+                    futures = []
+                    try:
+                        futures.append(recognition_pool.submit(registration_job, image_data))
+                    except PoolSaturated:
+                        return pool_busy_response()
+            registrations += [future.result(timeout=recognition_pool.timeout) for future in futures]
+        else:
+            registrations = [registration_job(image_data) for image_data in shots]
+        accepted = [registration.features for registration in registrations if registration.ok]
+        rejected = [registration.reason for registration in registrations if not registration.ok]
+        for registration in registrations:
+            metrics.record_timings(registration.timings)
+            metrics.faces_detected.inc(len(registration.faces) if registration.faces is not None else 0,
+                                       endpoint='register_face')
+        for reason in rejected:
+            metrics.rejections.inc(endpoint='register_face', reason=reason)
+        if not accepted:
             return jsonify({
                 "status": "error", 
-                "message": "Could not extract facial features. Please ensure good lighting and a clear view of your face."
+                "message": registrations[0].message,
+                "reason": registrations[0].reason
             }), 400
-            
-        # Convert the features to a JSON string for storage
-        face_encoding_json = json.dumps(face_features.tolist())
         
-        # Save to the database
-        student.face_encoding = face_encoding_json
-        db.session.commit()
+        with metrics.timed('db_write'):
+            prototype, templates_used = save_face_templates(student, accepted, append=append)
+            db.session.commit()
+        invalidate_galleries([course.id for course in student.courses])
+        campus_index.add(student.id, face_projection.project_features(prototype))
         
-        logger.info(f"Face registered successfully for student {student.id} ({student.name})")
+        logger.info(f"Face registered successfully for student {student.id} ({student.name}): "
+                    f"{len(accepted)} of {len(registrations)} shots accepted, prototype of {templates_used} templates")
         
         return jsonify({
             "status": "success", 
-            "message": f"Face registered successfully for {student.name}"
+            "message": f"Face registered successfully for {student.name}",
+            "templates": templates_used,
+            "rejected": rejected
         })
         
     except Exception as e:
@@ -430,14 +907,102 @@ def attendance():
     
     return render_template('attendance.html', courses=courses)
 
+def process_attendance_frame(course_id, image_data):
+    """
+    Recognize the faces in one frame and mark the recognized students present
+    
+    Shared by the synchronous route and the async job workers. Returns the
+    JSON payload and HTTP status; raises PoolSaturated when the recognition
+    pool is full.
+    """
+    # Get students enrolled in this course
+    course = Course.query.get(course_id)
+    if not course:
+        return {
+            "status": "error", 
+            "message": "Course not found"
+        }, 404
+    
+    # Normalized encodings of the enrolled students, cached per course or mapped from the shared gallery file
+    gallery = get_course_gallery(course.id)
+    known_encodings = gallery.matrix
+    known_ids = gallery.ids.tolist()
+    student_names = gallery.names  # For better logging
+    
+    if len(known_ids) == 0:
+        return {
+            "status": "error", 
+            "message": "No students with registered faces found in this course"
+        }, 400
+    
+    # Use a very high threshold (MATCH_THRESHOLD, or the projection's calibrated one) for extremely strict face matching
+    # This will require faces to be extremely similar to be recognized
+    threshold = face_projection.match_threshold()
+    if recognition_batcher.enabled:
+        # Extracted and scored together with the other frames arriving in the same window
+        recognition = recognition_batcher.recognize(course.id, image_data, known_encodings, known_ids, tolerance=threshold,
+                                                    templates=gallery.templates)
+    else:
+        probes = recognition_pool.run(probe_job, image_data)
+        recognition = match_probe_faces(probes, known_encodings, known_ids, tolerance=threshold, known_normalized=True,
+                                        templates=gallery.templates)
+    record_probe_metrics('mark_attendance', recognition.probes)
+    for face in recognition.faces:
+        metrics.match_decisions.inc(result='matched' if face.matched else 'unmatched')
+    if recognition.reason in REGISTRATION_MESSAGES:
+        # The frame was rejected before matching; tell the user what to fix right away
+        logger.info(f"Attendance frame rejected: {recognition.reason}")
+        return {
+            "status": "error", 
+            "message": REGISTRATION_MESSAGES[recognition.reason],
+            "reason": recognition.reason
+        }, 400
+    recognized_student_ids = recognition.recognized_ids
+    
+    # Log which students were recognized for debugging
+    if recognized_student_ids:
+        logger.info(f"Recognized students: {[student_names.get(id, id) for id in recognized_student_ids]}")
+    else:
+        logger.info("No students recognized. Face verification failed.")
+        
+        # Debug log the highest similarity score, already computed by recognize_faces
+        best_face = recognition.best_face
+        if best_face is not None:
+            logger.info(f"Highest similarity: {best_face.best_score} for student {student_names.get(best_face.best_id, best_face.best_id)}")
+        elif recognition.reason:
+            logger.info(f"Recognition did not run: {recognition.reason}")
+        
+        return {
+            "status": "error", 
+            "message": "No students recognized. Face verification failed. Please ensure you are the registered student and try again with better lighting and positioning."
+        }, 400
+    
+    # Mark attendance for recognized students
+    with metrics.timed('db_write'):
+        marked_students = record_attendance(course.id, recognized_student_ids)
+        db.session.commit()
+    
+    if marked_students:
+        return {
+            "status": "success", 
+            "message": f"Attendance marked for: {', '.join(marked_students)}",
+            "students": marked_students
+        }, 200
+    else:
+        return {
+            "status": "info", 
+            "message": "No new attendances recorded. Students may already be marked present for today.",
+            "students": []
+        }, 200
+
 @app.route('/mark_attendance', methods=['POST'])
 def mark_attendance():
     if 'user_id' not in session:
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
     
     try:
-        course_id = request.form.get('course_id')
-        image_data = request.form.get('image_data')
+        course_id = get_request_param('course_id')
+        image_data = get_uploaded_image()
         
         if not course_id or not image_data:
             return jsonify({
@@ -445,129 +1010,247 @@ def mark_attendance():
                 "message": "Missing required parameters"
             }), 400
         
-        # Get students enrolled in this course
-        course = Course.query.get(course_id)
-        if not course:
+        try:
+            payload, status_code = process_attendance_frame(course_id, image_data)
+        except PoolSaturated:
+            return pool_busy_response()
+        return jsonify(payload), status_code
+    
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error in marking attendance: {str(e)}")
+        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"}), 500
+
+def run_attendance_job(payload):
+    """Job handler for /mark_attendance_async, run on a job worker thread"""
+    with app.app_context():
+        try:
+            return process_attendance_frame(payload['course_id'], payload['image_data'])
+        except PoolSaturated:
+            return {"status": "error", "message": "The server is busy processing other images. Please try again in a moment."}, 429
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error in attendance job: {str(e)}")
+            return {"status": "error", "message": f"An error occurred: {str(e)}"}, 500
+
+@app.route('/mark_attendance_async', methods=['POST'])
+def mark_attendance_async():
+    """Queue a frame for attendance marking and return a job id to poll"""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    course_id = get_request_param('course_id')
+    image_data = get_uploaded_image()
+    
+    if not course_id or not image_data:
+        return jsonify({
+            "status": "error", 
+            "message": "Missing required parameters"
+        }), 400
+    
+    try:
+        job = attendance_jobs.submit({'course_id': course_id, 'image_data': image_data}, owner=session['user_id'])
+    except JobQueueFull:
+        return pool_busy_response()
+    
+    return jsonify({
+        "status": "queued",
+        "job_id": job.id,
+        "status_url": url_for('attendance_job_status', job_id=job.id)
+    }), 202
+
+@app.route('/attendance_jobs/<job_id>')
+def attendance_job_status(job_id):
+    """Poll the state of an async attendance job; finished jobs include the result"""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    job = attendance_jobs.get(job_id)
+    if job is None or job.owner != session['user_id']:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    
+    return jsonify(job.to_dict())
+
+@app.route('/identify', methods=['POST'])
+def identify():
+    """
+    Campus-wide "who is this": match the faces in a frame against every
+    registered student, not just one course, and mark no attendance
+    """
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    try:
+        image_data = get_uploaded_image()
+        if not image_data:
             return jsonify({
                 "status": "error", 
-                "message": "Course not found"
-            }), 404
-        
-        # Prepare face encodings and corresponding student IDs
-        known_encodings = []
-        known_ids = []
-        student_names = {}  # For better logging
-        
-        # Get all students in this course
-        students = course.students.all()
-        
-        # Build the known encodings and IDs
-        for student in students:
-            if student.face_encoding:
-                try:
-                    encoding = np.array(json.loads(student.face_encoding))
-                    known_encodings.append(encoding)
-                    known_ids.append(student.id)
-                    student_names[student.id] = student.name
-                except Exception as e:
-                    logger.warning(f"Could not load face encoding for student {student.id} ({student.name}): {str(e)}")
+                "message": "Missing required parameters"
+            }), 400
         
-        if not known_encodings:
+        index = get_campus_index()
+        if index is None:
             return jsonify({
                 "status": "error", 
-                "message": "No students with registered faces found in this course"
+                "message": "No students with registered faces found"
             }), 400
         
-        # Use a very high threshold (0.75) for extremely strict face matching
-        # This will require faces to be extremely similar to be recognized
-        recognized_student_ids = recognize_faces(image_data, known_encodings, known_ids, tolerance=0.75)
-        
-        # Log which students were recognized for debugging
-        if recognized_student_ids:
-            logger.info(f"Recognized students: {[student_names.get(id, id) for id in recognized_student_ids]}")
-        else:
-            logger.info("No students recognized. Face verification failed.")
-            
-            # Debug log the highest similarity score
-            image = process_image_data(image_data)
-            if image is not None:
-                faces = detect_face(image)
-                if len(faces) > 0:
-                    face_features = extract_face_features(image, faces[0])
-                    if face_features is not None:
-                        if np.linalg.norm(face_features) > 0:
-                            face_features = face_features / np.linalg.norm(face_features)
-                            
-                            # Find highest similarity
-                            max_similarity = 0
-                            max_student_id = None
-                            
-                            for i, known_encoding in enumerate(known_encodings):
-                                if np.linalg.norm(known_encoding) > 0:
-                                    known_encoding_norm = known_encoding / np.linalg.norm(known_encoding)
-                                else:
-                                    known_encoding_norm = known_encoding
-                                similarity = np.dot(face_features, known_encoding_norm)
-                                
-                                if similarity > max_similarity:
-                                    max_similarity = similarity
-                                    max_student_id = known_ids[i]
-                            
-                            logger.info(f"Highest similarity: {max_similarity} for student {student_names.get(max_student_id, max_student_id)}")
-            
+        try:
+            probes = recognition_pool.run(probe_job, image_data)
+        except PoolSaturated:
+            return pool_busy_response()
+        record_probe_metrics('identify', probes)
+        if probes.reason is not None or probes.features is None:
             return jsonify({
                 "status": "error", 
-                "message": "No students recognized. Face verification failed. Please ensure you are the registered student and try again with better lighting and positioning."
+                "message": REGISTRATION_MESSAGES.get(probes.reason, REGISTRATION_MESSAGES['extraction_failed']),
+                "reason": probes.reason or 'extraction_failed'
             }), 400
         
-        # Mark attendance for recognized students
-        marked_students = []
-        for student_id in recognized_student_ids:
-            # Get the student object
-            student = Student.query.get(student_id)
-            if not student:
-                continue
-                
-            # Double-check that student is in this course - extra security measure
-            course_ids = [c.id for c in student.courses]
-            if int(course_id) not in course_ids:
-                logger.warning(f"Security alert: Student {student.id} ({student.name}) recognized but not enrolled in course {course_id}")
-                continue
-            
-            # Check if attendance already marked for today
-            today = datetime.now().date()
-            existing_attendance = Attendance.query.filter(
-                Attendance.student_id == student_id,
-                Attendance.course_id == course_id,
-                db.func.date(Attendance.timestamp) == today
-            ).first()
-            
-            if not existing_attendance:
-                new_attendance = Attendance(
-                    student_id=student_id,
-                    course_id=course_id,
-                    timestamp=datetime.now()
-                )
-                db.session.add(new_attendance)
-                marked_students.append(student.name)
+        with metrics.timed('index_search'):
+            top_ids, top_scores = index.search(probes.features, k=3)
+        candidate_ids = {int(student_id) for student_id in top_ids.ravel() if student_id >= 0}
+        names = dict(db.session.query(Student.id, Student.name).filter(Student.id.in_(candidate_ids)).all())
         
-        db.session.commit()
+        faces = []
+        for box, ids, scores in zip(probes.boxes, top_ids, top_scores):
+            candidates = [
+                {"student_id": int(student_id), "name": names.get(int(student_id)), "score": float(score)}
+                for student_id, score in zip(ids, scores) if student_id >= 0
+            ]
+            # Same strict threshold as attendance marking
+            match = candidates[0] if candidates and candidates[0]["score"] > face_projection.match_threshold() else None
+            faces.append({
+                "box": [int(v) for v in box],
+                "match": match,
+                "candidates": candidates
+            })
         
+        return jsonify({
+            "status": "success",
+            "faces": faces
+        })
+    
+    except Exception as e:
+        logger.error(f"Error in identification: {str(e)}")
+        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"}), 500
+
+def match_session_embedding(course_id, embedding):
+    """Match one aggregated track embedding against a course gallery: (student id or None, best score)"""
+    gallery = get_course_gallery(course_id)
+    if len(gallery) == 0:
+        return None, None
+    match = match_face_features(embedding[None, :], gallery.matrix, gallery.ids, tolerance=face_projection.match_threshold(),
+                                gallery_normalized=True, templates=gallery.templates)
+    return match.assigned_ids[0], float(match.top_scores[0, 0])
+
+def process_session_frame(attendance_session, image_data):
+    """Run one frame through a session, marking newly recognized students present"""
+    def mark(student_ids):
+        try:
+            marked_students = record_attendance(attendance_session.course_id, student_ids)
+            db.session.commit()
+        except Exception:
+            # The session keeps these students eligible, so the next frame can mark them again
+            db.session.rollback()
+            raise
         if marked_students:
+            logger.info(f"Session {attendance_session.id} marked: {marked_students}")
+        return marked_students
+    
+    return attendance_session.process_frame(
+        image_data,
+        match=lambda embedding: match_session_embedding(attendance_session.course_id, embedding),
+        mark=mark,
+    )
+
+def get_owned_session(session_id):
+    attendance_session = attendance_sessions.get(session_id)
+    if attendance_session is None or attendance_session.owner != session['user_id']:
+        return None
+    return attendance_session
+
+@app.route('/attendance_sessions', methods=['POST'])
+def start_attendance_session():
+    """Open a video attendance session for a course"""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    course = Course.query.get(get_request_param('course_id') or 0)
+    if not course:
+        return jsonify({"status": "error", "message": "Course not found"}), 404
+    
+    try:
+        attendance_session = attendance_sessions.open(course.id, owner=session['user_id'])
+    except SessionLimitReached:
+        return pool_busy_response()
+    
+    return jsonify({
+        "status": "success",
+        "session_id": attendance_session.id,
+        "frames_url": url_for('attendance_session_frames', session_id=attendance_session.id),
+        "stop_url": url_for('stop_attendance_session', session_id=attendance_session.id)
+    }), 201
+
+@app.route('/attendance_sessions/<session_id>/frames', methods=['POST'])
+def attendance_session_frames(session_id):
+    """
+    Send frames to a session
+    
+    One frame per request (multipart "image", raw image body or base64
+    "image_data"), or many in one chunked request with Content-Type
+    application/x-face-frames: each frame prefixed by its length as a
+    4-byte big-endian integer. Streamed frames are answered with one JSON
+    line per frame as they are processed.
+    """
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    attendance_session = get_owned_session(session_id)
+    if attendance_session is None:
+        return jsonify({"status": "error", "message": "Session not found"}), 404
+    
+    try:
+        if request.mimetype == FRAME_STREAM_MIMETYPE:
+            def generate():
+                try:
+                    for frame in read_frame_stream(request.stream):
+                        yield json.dumps(process_session_frame(attendance_session, frame)) + "\n"
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error in attendance session stream: {str(e)}")
+                    yield json.dumps({"status": "error", "message": f"An error occurred: {str(e)}"}) + "\n"
+            
+            return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        image_data = get_uploaded_image()
+        if not image_data:
             return jsonify({
-                "status": "success", 
-                "message": f"Attendance marked for: {', '.join(marked_students)}"
-            })
-        else:
-            return jsonify({
-                "status": "info", 
-                "message": "No new attendances recorded. Students may already be marked present for today."
-            })
+                "status": "error", 
+                "message": "Missing required parameters"
+            }), 400
+        
+        payload = process_session_frame(attendance_session, image_data)
+        return jsonify(payload), 200 if payload["status"] == "success" else 400
     
     except Exception as e:
         db.session.rollback()
-        logger.error(f"Error in marking attendance: {str(e)}")
+        logger.error(f"Error in attendance session: {str(e)}")
         return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"}), 500
+
+@app.route('/attendance_sessions/<session_id>/stop', methods=['POST'])
+def stop_attendance_session(session_id):
+    """Close a session and return what it did"""
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    attendance_session = get_owned_session(session_id)
+    if attendance_session is None:
+        return jsonify({"status": "error", "message": "Session not found"}), 404
+    
+    attendance_sessions.close(session_id)
+    return jsonify(attendance_session.summary())
+
 @app.route('/reports')
 def reports():
     if 'user_id' not in session:
@@ -584,61 +1267,118 @@ def reports():
     
     return render_template('reports.html', courses=courses, students=students)
 
+# Page size limits for /get_attendance_data
+ATTENDANCE_PAGE_SIZE = 500
+ATTENDANCE_MAX_PAGE_SIZE = 5000
+
+def build_attendance_report_query(args):
+    """
+    Build the attendance report query for the course/student/date filters in args
+    
+    Rows are (id, timestamp, student_name, course_name), newest first with
+    id as tie-breaker, so (timestamp, id) can be used as a keyset cursor.
+    Raises ValueError for malformed dates.
+    """
+    course_id = args.get('course_id')
+    student_id = args.get('student_id')
+    date_from = args.get('date_from')
+    date_to = args.get('date_to')
+    
+    # Fixed query with explicit join paths
+    query = db.session.query(
+        Attendance.id, Attendance.timestamp, Student.name.label('student_name'), Course.name.label('course_name')
+    ).select_from(Attendance).\
+      join(Student, Attendance.student_id == Student.id).\
+      join(Course, Attendance.course_id == Course.id)
+    
+    # Apply filters
+    if course_id and course_id != 'all':
+        query = query.filter(Attendance.course_id == course_id)
+    
+    if student_id and student_id != 'all':
+        query = query.filter(Attendance.student_id == student_id)
+    
+    # Whole days, as a half-open timestamp range the date index can serve
+    try:
+        first_day = date.fromisoformat(date_from) if date_from else None
+        last_day = date.fromisoformat(date_to) if date_to else None
+    except ValueError:
+        raise ValueError("Dates must be in YYYY-MM-DD format")
+    query = query.filter(Attendance.between_days(first_day, last_day))
+    
+    # Order by date
+    return query.order_by(Attendance.timestamp.desc(), Attendance.id.desc())
+
+def attendance_row_to_dict(row):
+    """Format one report row for the JSON responses"""
+    return {
+        'id': row.id,
+        'student_name': row.student_name,
+        'course_name': row.course_name,
+        'timestamp': row.timestamp.isoformat(),
+        'date': row.timestamp.strftime('%Y-%m-%d'),
+        'time': row.timestamp.strftime('%H:%M:%S')
+    }
+
+def encode_attendance_cursor(row):
+    """Opaque cursor pointing just after the given row"""
+    payload = json.dumps([row.timestamp.isoformat(), row.id])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_attendance_cursor(cursor):
+    """Inverse of encode_attendance_cursor; raises ValueError for invalid tokens"""
+    try:
+        timestamp, attendance_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(timestamp), int(attendance_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
 @app.route('/get_attendance_data', methods=['GET'])
 def get_attendance_data():
+    """
+    Attendance report data, one page at a time
+    
+    Query parameters: course_id, student_id, date_from, date_to (filters),
+    limit (page size) and cursor (next_cursor of the previous page).
+    With format=ndjson all matching rows are streamed as one JSON object
+    per line instead.
+    """
     if 'user_id' not in session:
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
     
     try:
-        course_id = request.args.get('course_id')
-        student_id = request.args.get('student_id')
-        date_from = request.args.get('date_from')
-        date_to = request.args.get('date_to')
-        
-        # Fixed query with explicit join paths
-        query = db.session.query(
-            Attendance, Student.name.label('student_name'), Course.name.label('course_name')
-        ).select_from(Attendance).\
-          join(Student, Attendance.student_id == Student.id).\
-          join(Course, Attendance.course_id == Course.id)
-        
-        # Apply filters
-        if course_id and course_id != 'all':
-            query = query.filter(Attendance.course_id == course_id)
-        
-        if student_id and student_id != 'all':
-            query = query.filter(Attendance.student_id == student_id)
-        
-        if date_from:
-            query = query.filter(Attendance.timestamp >= date_from)
-        
-        if date_to:
-            query = query.filter(Attendance.timestamp <= date_to + " 23:59:59")
-        
-        # Order by date
-        query = query.order_by(Attendance.timestamp.desc())
-        
-        results = query.all()
+        try:
+            query = build_attendance_report_query(request.args)
+            limit = min(max(int(request.args.get('limit', ATTENDANCE_PAGE_SIZE)), 1), ATTENDANCE_MAX_PAGE_SIZE)
+            cursor = request.args.get('cursor')
+            if cursor:
+                timestamp, attendance_id = decode_attendance_cursor(cursor)
+                query = query.filter(db.tuple_(Attendance.timestamp, Attendance.id) < db.tuple_(timestamp, attendance_id))
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
         
-        # Format the data for the response
-        attendance_data = []
-        for record in results:
-            attendance = record[0]  # The Attendance instance
-            student_name = record.student_name
-            course_name = record.course_name
+        if request.args.get('format') == 'ndjson':
+            # Stream rows straight from a server-side cursor, never holding the full result
+            rows = query.execution_options(stream_results=True).yield_per(1000)
             
-            attendance_data.append({
-                'id': attendance.id,
-                'student_name': student_name,
-                'course_name': course_name,
-                'timestamp': attendance.timestamp.isoformat(),
-                'date': attendance.timestamp.strftime('%Y-%m-%d'),
-                'time': attendance.timestamp.strftime('%H:%M:%S')
-            })
+            def generate():
+                for row in rows:
+                    yield json.dumps(attendance_row_to_dict(row)) + '\n'
+            
+            return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        # Fetch one extra row to know whether there is a next page
+        results = query.limit(limit + 1).all()
+        has_more = len(results) > limit
+        results = results[:limit]
         
         return jsonify({
             "status": "success",
-            "data": attendance_data
+            "data": [attendance_row_to_dict(row) for row in results],
+            "next_cursor": encode_attendance_cursor(results[-1]) if has_more else None
         })
     
     except Exception as e:
@@ -648,6 +1388,47 @@ def get_attendance_data():
             "message": f"An error occurred: {str(e)}"
         }), 500
 
+@app.route('/export_attendance', methods=['GET'])
+def export_attendance():
+    """
+    Download the attendance report as a file, streamed from a server-side cursor
+    
+    Takes the same filters as /get_attendance_data plus format=csv (default),
+    parquet or arrow (the last two only when pyarrow is installed).
+    """
+    if 'user_id' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt not in available_export_formats():
+        return jsonify({
+            "status": "error",
+            "message": f"Unsupported export format '{fmt}'. Available: {', '.join(available_export_formats())}"
+        }), 400
+    
+    try:
+        query = build_attendance_report_query(request.args)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+    
+    rows = query.execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    filename = f"attendance_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+    
+    return app.response_class(
+        stream_with_context(iter_export(rows, fmt)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@app.route('/capture_config')
+def capture_config():
+    """Snapshot size and quality for capture clients such as kiosks"""
+    return jsonify({"status": "success", **app.config["CAPTURE_CONFIG"]})
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring"""
@@ -669,6 +1450,11 @@ def health_check():
             "message": f"System error: {str(e)}"
         }), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Recognition metrics in the Prometheus text format, for scraping like /health"""
+    return app.response_class(metrics.registry.render(), content_type=metrics.TEXT_CONTENT_TYPE)
+
 @app.route('/dbinfo')
 def db_info():
     """Database information endpoint"""
@@ -723,6 +1509,8 @@ def edit_student(id):
         student = Student.query.get_or_404(id)
         
         if request.method == 'POST':
+            previous_course_ids = [course.id for course in student.courses]
+            
             # Update student information
             student.name = request.form.get('name')
             
@@ -737,6 +1525,7 @@ def edit_student(id):
                 student.courses = []
             
             db.session.commit()
+            invalidate_galleries(set(previous_course_ids) | {course.id for course in student.courses})
             flash('Student updated successfully!', 'success')
             return redirect(url_for('students'))
         
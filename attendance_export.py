@@ -0,0 +1,144 @@
+"""
+Streaming writers for attendance exports
+Each writer consumes report rows lazily and yields encoded chunks, so an
+export of any size is produced with constant memory
+"""
+
+import csv
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Parquet / Arrow IPC export is optional and only offered when pyarrow is installed
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+EXPORT_COLUMNS = ['id', 'student_name', 'course_name', 'date', 'time', 'timestamp']
+
+# Rows per CSV chunk / Arrow record batch
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+def available_export_formats():
+    """Names of the export formats supported in this installation"""
+    if pa is None:
+        return ['csv']
+    return list(EXPORT_FORMATS)
+
+def export_record(row):
+    """Flatten one report row (id, timestamp, student_name, course_name) into export columns"""
+    return (
+        row.id,
+        row.student_name,
+        row.course_name,
+        row.timestamp.strftime('%Y-%m-%d'),
+        row.timestamp.strftime('%H:%M:%S'),
+        row.timestamp.isoformat(),
+    )
+
+def _batches(rows, size=EXPORT_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(export_record(row))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_csv(rows):
+    """Yield the CSV export (header first) in chunks of EXPORT_BATCH_SIZE rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+
+    for batch in _batches(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _arrow_schema():
+    return pa.schema([
+        ('id', pa.int64()),
+        ('student_name', pa.string()),
+        ('course_name', pa.string()),
+        ('date', pa.string()),
+        ('time', pa.string()),
+        ('timestamp', pa.string()),
+    ])
+
+def iter_arrow(rows, fmt):
+    """Yield a Parquet file or an Arrow IPC stream, one record batch at a time"""
+    if pa is None:
+        raise ValueError("Parquet and Arrow exports require pyarrow")
+
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    if fmt == 'parquet':
+        writer = pa.parquet.ParquetWriter(sink, schema)
+        write = writer.write_table
+        to_chunk = lambda batch: pa.Table.from_batches([batch])
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+        to_chunk = lambda batch: batch
+
+    try:
+        for batch in _batches(rows):
+            columns = list(zip(*batch))
+            record_batch = pa.RecordBatch.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema,
+            )
+            write(to_chunk(record_batch))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def iter_export(rows, fmt):
+    """Dispatch to the streaming writer for an export format"""
+    if fmt == 'csv':
+        return iter_csv(rows)
+    if fmt in ('parquet', 'arrow'):
+        return iter_arrow(rows, fmt)
+    raise ValueError(f"Unknown export format: {fmt}")
@@ -0,0 +1,118 @@
+"""
+In-process job queue for asynchronous attendance marking
+Kiosks submit a frame, get a job id back immediately and poll for the
+result while a small pool of worker threads does the recognition. Jobs
+are kept in this process only, so with several server workers a client's
+polls must be routed to the worker that accepted its job.
+"""
+
+import logging
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+class JobQueueFull(Exception):
+    """Raised when the queue already holds as many waiting jobs as it accepts"""
+    pass
+
+@dataclass
+class Job:
+    """One queued unit of work and, once finished, its result"""
+    id: str
+    payload: dict
+    owner: object = None  # user id that submitted the job; only they may read it
+    state: str = 'queued'  # queued -> running -> done
+    result: dict = None  # JSON payload produced by the handler
+    result_code: int = None  # HTTP status the synchronous route would have answered
+    created_at: float = field(default_factory=time.time)
+    finished_at: float = None
+
+    def to_dict(self):
+        return {
+            "status": "success",
+            "job_id": self.id,
+            "state": self.state,
+            "result": self.result,
+            "result_code": self.result_code,
+        }
+
+class JobQueue:
+    """
+    Bounded FIFO of jobs processed by background worker threads
+
+    handler(payload) must return (result_dict, http_status). Finished jobs
+    are kept for `retention` seconds so clients can poll their result.
+    """
+
+    def __init__(self, handler, workers=2, max_queued=100, retention=600):
+        self.handler = handler
+        self.workers = workers
+        self.retention = retention
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    @property
+    def depth(self):
+        """Jobs waiting for a worker"""
+        return self._queue.qsize()
+
+    def _start_workers(self):
+        # Threads are started on first use so that importing the app starts none
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"attendance-job-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, payload, owner=None):
+        """Queue a job and return it; raises JobQueueFull when the queue is at capacity"""
+        self._start_workers()
+        self._prune()
+
+        job = Job(id=uuid.uuid4().hex, payload=payload, owner=owner)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise JobQueueFull(f"Job queue is full ({self._queue.maxsize} jobs waiting)")
+        return job
+
+    def get(self, job_id):
+        """Return the job with this id, or None if unknown or expired"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.state = 'running'
+            try:
+                job.result, job.result_code = self.handler(job.payload)
+            except Exception as e:
+                logger.error(f"Error running job {job.id}: {str(e)}")
+                job.result = {"status": "error", "message": f"An error occurred: {str(e)}"}
+                job.result_code = 500
+            # The frame is no longer needed once processed
+            job.payload = None
+            job.finished_at = time.time()
+            job.state = 'done'
+            self._queue.task_done()
@@ -0,0 +1,200 @@
+"""
+Video-session attendance
+A kiosk opens a session for a course and streams frames into it; faces
+are tracked across frames, each track's embeddings are aggregated over a
+few frames before matching, and every student is marked at most once per
+session
+"""
+
+import logging
+import struct
+import threading
+import time
+import uuid
+
+from face_projection import project_features
+from face_tracking import FaceTracker
+from face_utils import assess_face_quality, extract_face_features, load_image
+
+logger = logging.getLogger(__name__)
+
+# Frames in a streamed body are prefixed with their length as a 4-byte big-endian integer
+FRAME_STREAM_MIMETYPE = 'application/x-face-frames'
+_FRAME_LENGTH = struct.Struct('>I')
+MAX_FRAME_BYTES = 8 * 1024 * 1024
+
+class SessionLimitReached(Exception):
+    """Raised when as many sessions are open as the server allows"""
+    pass
+
+def read_frame_stream(stream):
+    """Yield the frames of a length-prefixed stream as they arrive"""
+    while True:
+        header = _read_exactly(stream, _FRAME_LENGTH.size)
+        if not header:
+            return
+        if len(header) != _FRAME_LENGTH.size:
+            raise ValueError("Frame stream ended in the middle of a frame header")
+        (length,) = _FRAME_LENGTH.unpack(header)
+        if length > MAX_FRAME_BYTES:
+            raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_BYTES} byte limit")
+        frame = _read_exactly(stream, length)
+        if len(frame) != length:
+            raise ValueError("Frame stream ended in the middle of a frame")
+        yield frame
+
+def _read_exactly(stream, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+class AttendanceSession:
+    """
+    Tracking state of one kiosk's session
+
+    A track collects embeddings_per_track embeddings before its aggregate
+    is matched. A track that matches nobody starts collecting again, up to
+    max_attempts times, and is then left alone as unknown. Frames of one
+    session are processed one at a time.
+    """
+
+    def __init__(self, course_id, owner=None, embeddings_per_track=3, max_attempts=3, **tracker_options):
+        self.id = uuid.uuid4().hex
+        self.course_id = course_id
+        self.owner = owner
+        self.embeddings_per_track = embeddings_per_track
+        self.max_attempts = max_attempts
+        self.tracker = FaceTracker(**tracker_options)
+        self.recognized = set()  # student ids matched in this session
+        self.marked = []  # names of students marked present by this session
+        self.extractions = 0
+        self.quality_rejections = 0
+        self.created_at = time.time()
+        self.last_seen = self.created_at
+        self.lock = threading.Lock()
+
+    def process_frame(self, image_data, match, mark):
+        """
+        Track the faces in one frame and mark newly recognized students
+
+        match(embedding) returns (student_id or None, best score) and
+        mark(student_ids) returns the names of the students it marked.
+        Returns the frame's JSON payload.
+        """
+        with self.lock:
+            self.last_seen = time.time()
+            image = load_image(image_data)
+            if image is None:
+                return {"status": "error", "message": "Invalid image data", "reason": "invalid_image"}
+
+            newly_recognized = []
+            for track in self.tracker.update(image):
+                if not track.needs_embedding or track.misses > 0:
+                    continue
+                # Blurry or turned frames are skipped; the track simply waits for a better one
+                if not assess_face_quality(image, track.box).ok:
+                    self.quality_rejections += 1
+                    continue
+                features = extract_face_features(image, track.box)
+                self.extractions += 1
+                if features is None:
+                    continue
+                track.embeddings.append(project_features(features))
+                if len(track.embeddings) < self.embeddings_per_track:
+                    continue
+
+                student_id, track.score = match(track.aggregate_embedding())
+                if student_id is None:
+                    track.attempts += 1
+                    track.embeddings = []
+                    if track.attempts >= self.max_attempts:
+                        track.state = 'unknown'
+                    continue
+
+                track.state = 'matched'
+                track.student_id = student_id
+                if student_id not in self.recognized and student_id not in newly_recognized:
+                    newly_recognized.append(student_id)
+
+            if newly_recognized:
+                try:
+                    names = mark(newly_recognized)
+                except Exception:
+                    # Not marked, so their tracks collect again and they are matched on a later frame
+                    for track in self.tracker.tracks:
+                        if track.state == 'matched' and track.student_id in newly_recognized:
+                            track.state = 'collecting'
+                            track.student_id = None
+                            track.embeddings = []
+                    raise
+                self.recognized.update(newly_recognized)
+            else:
+                names = []
+            self.marked.extend(names)
+            return {
+                "status": "success",
+                "frame": self.tracker.frames,
+                "tracks": [track.to_dict() for track in self.tracker.tracks],
+                "marked": names,
+            }
+
+    def summary(self):
+        return {
+            "status": "success",
+            "session_id": self.id,
+            "course_id": self.course_id,
+            "frames": self.tracker.frames,
+            "detections": self.tracker.detections,
+            "extractions": self.extractions,
+            "quality_rejections": self.quality_rejections,
+            "recognized": len(self.recognized),
+            "marked": self.marked,
+        }
+
+class SessionStore:
+    """Open sessions by id; sessions idle for idle_timeout seconds are closed"""
+
+    def __init__(self, max_sessions=20, idle_timeout=120, **session_options):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.session_options = session_options
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self, course_id, owner=None):
+        """Start a session; raises SessionLimitReached when max_sessions are open"""
+        self._prune()
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                raise SessionLimitReached(f"{len(self._sessions)} attendance sessions are already open")
+            session = AttendanceSession(course_id, owner=owner, **self.session_options)
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        """Return the open session with this id, or None"""
+        self._prune()
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def close(self, session_id):
+        """Close a session and return it, or None if it was not open"""
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def _prune(self):
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            expired = [session_id for session_id, session in self._sessions.items() if session.last_seen < cutoff]
+            for session_id in expired:
+                session = self._sessions.pop(session_id)
+                logger.info(f"Closed idle attendance session {session_id} ({len(session.marked)} students marked)")
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark downscaled face detection against full-resolution detection
+Runs detect_face on a folder of photos at each working width and reports
+recall (full-resolution faces found again, IoU >= 0.5) and latency
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+
+from face_utils import detect_face, box_iou
+
+logger = logging.getLogger(__name__)
+
+def load_images(directory, resize_width=None):
+    """Every readable image under directory, optionally resized to a camera-like width"""
+    images = []
+    for root, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            image = cv2.imread(os.path.join(root, filename))
+            if image is None:
+                continue
+            if resize_width:
+                height = round(image.shape[0] * resize_width / image.shape[1])
+                image = cv2.resize(image, (resize_width, height), interpolation=cv2.INTER_CUBIC)
+            images.append(image)
+    return images
+
+def timed_detect(images, repeats, **options):
+    """Boxes per image and per-call latencies in milliseconds"""
+    boxes = []
+    latencies = []
+    for image in images:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            faces = detect_face(image, **options)
+            latencies.append((time.perf_counter() - start) * 1000)
+        boxes.append([tuple(int(v) for v in face) for face in faces])
+    return boxes, latencies
+
+def compare(reference, boxes, threshold=0.5):
+    """Reference faces matched by a box with IoU >= threshold, and unmatched extra boxes"""
+    found = 0
+    extra = 0
+    ious = []
+    for expected, actual in zip(reference, boxes):
+        unmatched = list(actual)
+        for face in expected:
+            scores = [box_iou(face, box) for box in unmatched]
+            if scores and max(scores) >= threshold:
+                best = int(np.argmax(scores))
+                ious.append(scores[best])
+                unmatched.pop(best)
+                found += 1
+        extra += len(unmatched)
+    return found, extra, ious
+
+def run_benchmark(images, widths, refine=False, repeats=3):
+    """One report row for the full-resolution detector and one per working width"""
+    reference, latencies = timed_detect(images, repeats, working_width=0, refine=False)
+    total = sum(len(faces) for faces in reference)
+
+    def row(name, boxes, latencies):
+        found, extra, ious = compare(reference, boxes)
+        return {
+            'detector': name,
+            'recall': found / total if total else None,
+            'extra_detections': extra,
+            'mean_iou': float(np.mean(ious)) if ious else None,
+            'latency_ms_p50': float(np.percentile(latencies, 50)),
+            'latency_ms_p95': float(np.percentile(latencies, 95)),
+        }
+
+    rows = [row('full_resolution', reference, latencies)]
+    for width in widths:
+        boxes, latencies = timed_detect(images, repeats, working_width=width, refine=refine)
+        rows.append(row(f"width_{width}" + ("_refined" if refine else ""), boxes, latencies))
+    return rows, total
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description='Recall and latency of downscaled face detection')
+    parser.add_argument('--images', required=True, help='Directory of photos containing faces')
+    parser.add_argument('--resize-to', type=int, default=1920,
+                        help='Resize every photo to this width first, to simulate the camera (0 = keep as is)')
+    parser.add_argument('--widths', type=int, nargs='+', default=[320, 480, 640, 960], help='Working widths to test')
+    parser.add_argument('--refine', action='store_true', help='Also benchmark with full-resolution ROI refinement')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per image')
+    args = parser.parse_args()
+
+    images = load_images(args.images, resize_width=args.resize_to or None)
+    if not images:
+        parser.error(f"No readable images in {args.images}")
+
+    rows, total = run_benchmark(images, args.widths, repeats=args.repeats)
+    if args.refine:
+        rows += run_benchmark(images, args.widths, refine=True, repeats=args.repeats)[0][1:]
+
+    print(f"{len(images)} images, {total} faces at full resolution")
+    for row in rows:
+        print(json.dumps(row))
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+PCA projection of face encodings
+Maps the raw LBP + HOG feature vector to a few hundred dimensions for
+matching. The projection is fit offline on the registered gallery, saved
+to a file and loaded at startup from FACE_PROJECTION_PATH. Projected
+scores are distributed differently from raw ones, so the file also holds
+the match threshold calibrated for it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from face_utils import EXTRACTOR_VERSION, MATCH_THRESHOLD, normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# Share of probe faces allowed to score above the threshold against some other student when calibrating
+DEFAULT_TARGET_FAR = 0.01
+
+@dataclass
+class FaceProjection:
+    """A fitted projection: project(x) = (x / |x| - mean) @ components.T, optionally whitened"""
+    mean: np.ndarray  # (input_dim,) float32
+    components: np.ndarray  # (dims, input_dim) float32, orthonormal rows
+    scale: np.ndarray = None  # (dims,) whitening factors 1 / sqrt(variance), None when not whitened
+    extractor_version: int = EXTRACTOR_VERSION  # feature extractor the projection was fit on
+    threshold: float = None  # cosine similarity a projected face must exceed to match, from calibrate_threshold
+
+    @property
+    def dims(self):
+        return self.components.shape[0]
+
+    @property
+    def input_dim(self):
+        return self.components.shape[1]
+
+    @property
+    def version(self):
+        """Identifier of this exact projection, e.g. pca256w-e1-3f2a9c1b"""
+        digest = hashlib.sha1(self.components.tobytes()).hexdigest()[:8]
+        whiten = 'w' if self.scale is not None else ''
+        return f"pca{self.dims}{whiten}-e{self.extractor_version}-{digest}"
+
+    def project(self, features):
+        """Project one vector or a (n, input_dim) matrix; returns float32"""
+        features = np.asarray(features)
+        if features.shape[-1] != self.input_dim:
+            raise ValueError(f"Projection {self.version} expects {self.input_dim} values, got {features.shape[-1]}")
+        # Fit on L2-normalized encodings, so inputs are normalized the same way
+        projected = (normalize_rows(np.atleast_2d(features)) - self.mean) @ self.components.T
+        if self.scale is not None:
+            projected *= self.scale
+        return projected[0] if features.ndim == 1 else projected
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        if self.threshold is None:
+            raise ValueError("Calibrate the projection's match threshold before saving it")
+        arrays = {'mean': self.mean, 'components': self.components,
+                  'extractor_version': np.int64(self.extractor_version), 'threshold': np.float64(self.threshold)}
+        if self.scale is not None:
+            arrays['scale'] = self.scale
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        if 'threshold' not in data:
+            raise ValueError("Projection has no calibrated match threshold; fit it again with face_projection.py fit")
+        projection = cls(
+            mean=data['mean'],
+            components=data['components'],
+            scale=data['scale'] if 'scale' in data else None,
+            extractor_version=int(data['extractor_version']),
+            threshold=float(data['threshold']),
+        )
+        if projection.extractor_version != EXTRACTOR_VERSION:
+            raise ValueError(f"Projection was fit on extractor version {projection.extractor_version}, "
+                             f"current version is {EXTRACTOR_VERSION}")
+        return projection
+
+def _randomized_pca(centered, dims, oversample=10, power_iterations=4, seed=0):
+    """
+    Top principal directions and variances of a centered (n, d) matrix
+
+    Randomized range finder (Halko et al.), so neither the d x d covariance
+    nor a full SVD of the data is ever formed.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = centered.shape[0]
+    sketch = min(dims + oversample, min(centered.shape))
+    basis = centered @ rng.standard_normal((centered.shape[1], sketch), dtype=np.float32)
+    basis, _ = np.linalg.qr(basis)
+    for _ in range(power_iterations):
+        basis, _ = np.linalg.qr(centered.T @ basis)
+        basis, _ = np.linalg.qr(centered @ basis)
+    _, singular_values, vt = np.linalg.svd(basis.T @ centered, full_matrices=False)
+    variances = singular_values[:dims] ** 2 / max(n_samples - 1, 1)
+    return vt[:dims], variances
+
+def fit_projection(encodings, dims=256, whiten=False, eps=1e-6):
+    """
+    Fit a PCA projection to a (n, input_dim) set of encodings
+
+    dims is capped at n - 1, the rank of the centered data. With whiten,
+    every output dimension is scaled to unit variance.
+    """
+    encodings = normalize_rows(encodings)
+    dims = max(1, min(dims, len(encodings) - 1, encodings.shape[1]))
+    mean = encodings.mean(axis=0)
+    components, variances = _randomized_pca(encodings - mean, dims)
+    scale = (1.0 / np.sqrt(variances + eps)).astype(np.float32) if whiten else None
+    return FaceProjection(mean=mean.astype(np.float32), components=components.astype(np.float32), scale=scale)
+
+def threshold_for_false_accepts(best_impostor_scores, target_far=DEFAULT_TARGET_FAR):
+    """Lowest threshold that at most target_far of the best impostor scores exceed (a match needs score > threshold)"""
+    return float(np.quantile(best_impostor_scores, 1 - target_far, method='higher'))
+
+def calibrate_threshold(gallery, gallery_labels, probes, probe_labels, target_far=DEFAULT_TARGET_FAR, chunk_size=1000):
+    """
+    Match threshold for vectors scored the way they are matched
+
+    Every probe is scored against the whole gallery, as a face is against a
+    course. Its best score against another label's row is what a false
+    accept would need to beat, so the threshold is set so at most
+    target_far of the probes have one above it. Returns the threshold,
+    the false accept rate at it and, when probes have a genuine row that is
+    not themselves, the share of probes accepted as the right label.
+    """
+    gallery = normalize_rows(gallery)
+    gallery_labels = np.asarray(gallery_labels)
+    probe_labels = np.asarray(probe_labels)
+    best_impostor = []
+    best_genuine = []
+    for start in range(0, len(probes), chunk_size):
+        scores = normalize_rows(probes[start:start + chunk_size]) @ gallery.T
+        same = gallery_labels[None, :] == probe_labels[start:start + chunk_size, None]
+        best_impostor.append(np.where(same, -np.inf, scores).max(axis=1))
+        best_genuine.append(np.where(same, scores, -np.inf).max(axis=1))
+    best_impostor = np.concatenate(best_impostor)
+    best_genuine = np.concatenate(best_genuine)
+    best_impostor = best_impostor[np.isfinite(best_impostor)]
+    if len(best_impostor) == 0:
+        raise ValueError("Calibrating a threshold needs at least two labels")
+
+    threshold = threshold_for_false_accepts(best_impostor, target_far)
+    # A probe identical to its gallery row (no enrollment templates) says nothing about genuine matches
+    genuine = best_genuine[np.isfinite(best_genuine) & (best_genuine < 1 - 1e-6)]
+    return {
+        'threshold': threshold,
+        'false_accept_rate': float(np.mean(best_impostor > threshold)),
+        'genuine_accept_rate': float(np.mean(genuine > threshold)) if len(genuine) else None,
+        'probes': int(len(probe_labels)),
+    }
+
+def load_configured_projection(path=None):
+    """Load the projection named by FACE_PROJECTION_PATH; None when unset or unusable"""
+    path = path or os.environ.get("FACE_PROJECTION_PATH")
+    if not path:
+        return None
+    try:
+        projection = FaceProjection.load(path)
+    except Exception as e:
+        logger.error(f"Error loading face projection from {path}, matching on raw features: {str(e)}")
+        return None
+    logger.info(f"Loaded face projection {projection.version} ({projection.input_dim} -> {projection.dims} dims, "
+                f"match threshold {projection.threshold:.3f})")
+    return projection
+
+# Projection used for matching in this process; None matches on raw features
+active_projection = load_configured_projection()
+
+def project_features(features):
+    """Project features with the active projection, or return them unchanged"""
+    if active_projection is None:
+        return features
+    return active_projection.project(features)
+
+def match_threshold():
+    """Similarity a face must exceed to match: the active projection's calibrated threshold, or MATCH_THRESHOLD on raw features"""
+    if active_projection is None:
+        return MATCH_THRESHOLD
+    return active_projection.threshold
+
+def _identification_scores(gallery, probes):
+    return normalize_rows(probes) @ normalize_rows(gallery).T
+
+def projection_report(features, labels, dims_list=(32, 64, 128, 256, 512), whiten=False, target_far=DEFAULT_TARGET_FAR):
+    """
+    Accuracy of matching at each projection size, against raw features
+
+    The first sample of every label is enrolled, as registration would, and
+    the projection is fit on those enrolled samples only. Every other
+    sample is a probe. Reports rank-1 identification accuracy, the mean
+    genuine and best-impostor scores, the threshold calibrated for
+    target_far with the genuine accept rate at it, bytes per float32
+    encoding and match time per probe.
+    """
+    features = np.asarray(features, dtype=np.float32)
+    labels = np.asarray(labels)
+    _, first = np.unique(labels, return_index=True)
+    enrolled = np.zeros(len(labels), dtype=bool)
+    enrolled[first] = True
+    gallery, gallery_labels = features[enrolled], labels[enrolled]
+    probes, probe_labels = features[~enrolled], labels[~enrolled]
+    if len(probes) == 0:
+        raise ValueError("The report needs at least one label with two or more samples")
+
+    def evaluate(name, dims, gallery_vectors, probe_vectors):
+        start = time.perf_counter()
+        scores = _identification_scores(gallery_vectors, probe_vectors)
+        match_ms = (time.perf_counter() - start) * 1000 / len(probe_vectors)
+        genuine = scores[np.arange(len(probe_labels)), np.searchsorted(gallery_labels, probe_labels)]
+        impostor = np.where(gallery_labels[None, :] == probe_labels[:, None], -np.inf, scores).max(axis=1)
+        calibration = calibrate_threshold(gallery_vectors, gallery_labels, probe_vectors, probe_labels, target_far)
+        return {
+            'projection': name,
+            'dims': dims,
+            'rank1_accuracy': float(np.mean(gallery_labels[scores.argmax(axis=1)] == probe_labels)),
+            'mean_genuine_score': float(genuine.mean()),
+            'mean_best_impostor_score': float(impostor[np.isfinite(impostor)].mean()) if np.isfinite(impostor).any() else None,
+            'threshold': calibration['threshold'],
+            'genuine_accept_rate': calibration['genuine_accept_rate'],
+            'bytes_per_encoding': dims * 4,
+            'match_ms_per_probe': match_ms,
+        }
+
+    # np.unique sorts gallery labels, which the genuine-score lookup relies on
+    order = np.argsort(gallery_labels)
+    gallery, gallery_labels = gallery[order], gallery_labels[order]
+
+    rows = [evaluate('raw', features.shape[1], gallery, probes)]
+    for dims in dims_list:
+        projection = fit_projection(gallery, dims=dims, whiten=whiten)
+        rows.append(evaluate(projection.version, projection.dims,
+                             projection.project(gallery), projection.project(probes)))
+    return rows
+
+def _load_labelled_images(directory):
+    """Features of every face image under directory/<label>/, one subdirectory per person"""
+    import cv2
+    from face_utils import detect_face, extract_face_features
+
+    features = []
+    labels = []
+    for label in sorted(os.listdir(directory)):
+        person_dir = os.path.join(directory, label)
+        if not os.path.isdir(person_dir):
+            continue
+        for filename in sorted(os.listdir(person_dir)):
+            image = cv2.imread(os.path.join(person_dir, filename))
+            if image is None:
+                continue
+            faces = detect_face(image)
+            if len(faces) != 1:
+                logger.warning(f"Skipping {label}/{filename}: {len(faces)} faces detected")
+                continue
+            vector = extract_face_features(image, faces[0])
+            if vector is not None:
+                features.append(vector)
+                labels.append(label)
+    return np.vstack(features), np.asarray(labels)
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Fit and evaluate the PCA projection of face encodings')
+    subparsers = parser.add_subparsers(dest='command')
+
+    fit_parser = subparsers.add_parser('fit', help='Fit a projection on the registered students in the database')
+    fit_parser.add_argument('--output', required=True, help='File to write; point FACE_PROJECTION_PATH at it')
+    fit_parser.add_argument('--dims', type=int, default=256)
+    fit_parser.add_argument('--whiten', action='store_true')
+    fit_parser.add_argument('--target-far', type=float, default=DEFAULT_TARGET_FAR,
+                            help='Share of faces allowed to score above the match threshold against another student')
+
+    report_parser = subparsers.add_parser('report', help='Accuracy vs dimensions on a labelled image set')
+    report_parser.add_argument('--images', required=True, help='Directory with one subdirectory of face images per person')
+    report_parser.add_argument('--dims', type=int, nargs='+', default=[32, 64, 128, 256, 512])
+    report_parser.add_argument('--whiten', action='store_true')
+    report_parser.add_argument('--target-far', type=float, default=DEFAULT_TARGET_FAR)
+
+    args = parser.parse_args()
+
+    if args.command == 'fit':
+        from app import app, iter_registered_encodings, iter_face_templates
+
+        with app.app_context():
+            registered = list(iter_registered_encodings())
+            if len(registered) < 2:
+                parser.error("At least two registered students are needed to fit a projection")
+            student_ids = [student_id for student_id, _ in registered]
+            encodings = np.vstack([encoding for _, encoding in registered])
+            del registered
+            projection = fit_projection(encodings, dims=args.dims, whiten=args.whiten)
+            gallery = projection.project(encodings)
+            del encodings
+
+            # Enrollment templates probe the prototype gallery; students without templates probe with the prototype
+            probe_ids = []
+            probes = []
+            for student_id, encoding in iter_face_templates():
+                probe_ids.append(student_id)
+                probes.append(projection.project(encoding))
+        with_templates = set(probe_ids)
+        for student_id, row in zip(student_ids, gallery):
+            if student_id not in with_templates:
+                probe_ids.append(student_id)
+                probes.append(row)
+
+        calibration = calibrate_threshold(gallery, student_ids, np.vstack(probes), probe_ids, target_far=args.target_far)
+        projection.threshold = calibration['threshold']
+        projection.save(args.output)
+        print(f"Saved projection {projection.version} fit on {len(student_ids)} students to {args.output}")
+        print(f"Match threshold {projection.threshold:.4f} from {calibration['probes']} faces: "
+              f"false accept rate {calibration['false_accept_rate']:.4f}, genuine accept rate {calibration['genuine_accept_rate']}")
+
+    elif args.command == 'report':
+        features, labels = _load_labelled_images(args.images)
+        for row in projection_report(features, labels, dims_list=args.dims, whiten=args.whiten, target_far=args.target_far):
+            print(json.dumps(row))
+
+    else:
+        parser.print_help()
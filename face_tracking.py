@@ -0,0 +1,155 @@
+"""
+Face tracking across the frames of a video session
+Faces are detected every few frames and followed in between with cheap
+template matching, so feature extraction only runs for tracks that still
+need embeddings instead of for every face in every frame
+"""
+
+import logging
+from dataclasses import dataclass, field
+
+import cv2
+import numpy as np
+
+from face_utils import DETECTION_WIDTH, box_iou, detect_face, normalize_rows
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class FaceTrack:
+    """One face followed across frames"""
+    id: int
+    box: tuple  # (x, y, w, h) in full-resolution pixels
+    template: np.ndarray = None  # grayscale patch at tracking scale, from the last detection
+    embeddings: list = field(default_factory=list)  # feature vectors collected so far
+    state: str = 'collecting'  # collecting -> matched | unknown
+    attempts: int = 0  # aggregated embeddings that matched nobody
+    student_id: int = None  # set once matched
+    score: float = None  # similarity of the aggregated embedding to its best student
+    misses: int = 0  # consecutive frames the face was not found in
+    age: int = 0  # frames since the track started
+
+    @property
+    def needs_embedding(self):
+        return self.state == 'collecting'
+
+    def aggregate_embedding(self):
+        """Mean of the collected embeddings, each normalized first so no frame dominates"""
+        return normalize_rows(normalize_rows(np.vstack(self.embeddings)).mean(axis=0))[0]
+
+    def to_dict(self):
+        return {
+            "track_id": self.id,
+            "box": [int(v) for v in self.box],
+            "state": self.state,
+            "student_id": self.student_id,
+            "score": self.score,
+        }
+
+class FaceTracker:
+    """
+    IoU tracker with template-matching between detections
+
+    Every detect_interval frames (and whenever nothing is tracked) the
+    cascade runs and detections are associated with tracks by IoU; faces no
+    track claims start new tracks. On the other frames each track is moved
+    to the best template match in a window around its last position.
+    Tracks not found for max_misses frames in a row are dropped.
+    """
+
+    def __init__(self, detect_interval=5, iou_threshold=0.3, max_misses=5, match_threshold=0.5,
+                 working_width=None):
+        self.detect_interval = detect_interval
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.match_threshold = match_threshold
+        self.working_width = working_width or DETECTION_WIDTH or 640
+        self.tracks = []
+        self.frames = 0
+        self.detections = 0
+        self._next_id = 1
+
+    def _tracking_gray(self, image):
+        height, width = image.shape[:2]
+        scale = min(1.0, self.working_width / width)
+        if scale < 1.0:
+            image = cv2.resize(image, (self.working_width, max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), scale
+
+    @staticmethod
+    def _scaled_box(box, scale):
+        return tuple(int(round(v * scale)) for v in box)
+
+    def update(self, image):
+        """Advance all tracks by one frame and return the live tracks"""
+        gray, scale = self._tracking_gray(image)
+        detect = not self.tracks or self.frames % self.detect_interval == 0
+        self.frames += 1
+
+        if detect:
+            self.detections += 1
+            self._associate(detect_face(image), gray, scale)
+        else:
+            for track in self.tracks:
+                self._follow(track, gray, scale)
+
+        for track in self.tracks:
+            track.age += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+        return self.tracks
+
+    def _template(self, gray, box, scale):
+        x, y, w, h = self._scaled_box(box, scale)
+        return gray[y:y + h, x:x + w].copy()
+
+    def _associate(self, faces, gray, scale):
+        faces = [tuple(int(v) for v in face) for face in faces]
+        pairs = sorted(
+            ((box_iou(track.box, face), t, f) for t, track in enumerate(self.tracks) for f, face in enumerate(faces)),
+            reverse=True,
+        )
+        claimed_tracks = set()
+        claimed_faces = set()
+        for iou, t, f in pairs:
+            if iou < self.iou_threshold:
+                break
+            if t in claimed_tracks or f in claimed_faces:
+                continue
+            track = self.tracks[t]
+            track.box = faces[f]
+            track.template = self._template(gray, faces[f], scale)
+            track.misses = 0
+            claimed_tracks.add(t)
+            claimed_faces.add(f)
+
+        for t, track in enumerate(self.tracks):
+            if t not in claimed_tracks:
+                track.misses += 1
+
+        for f, face in enumerate(faces):
+            if f not in claimed_faces:
+                self.tracks.append(FaceTrack(self._next_id, face, template=self._template(gray, face, scale)))
+                self._next_id += 1
+
+    def _follow(self, track, gray, scale):
+        template = track.template
+        if template is None or template.size == 0:
+            track.misses += 1
+            return
+        x, y, w, h = self._scaled_box(track.box, scale)
+        th, tw = template.shape
+        # Search a window of half a face in every direction
+        x0, y0 = max(0, x - w // 2), max(0, y - h // 2)
+        x1, y1 = min(gray.shape[1], x + w + w // 2), min(gray.shape[0], y + h + h // 2)
+        window = gray[y0:y1, x0:x1]
+        if window.shape[0] < th or window.shape[1] < tw:
+            track.misses += 1
+            return
+
+        result = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+        _, best, _, (bx, by) = cv2.minMaxLoc(result)
+        if best < self.match_threshold:
+            track.misses += 1
+            return
+        track.box = (int(round((x0 + bx) / scale)), int(round((y0 + by) / scale)), track.box[2], track.box[3])
+        track.misses = 0
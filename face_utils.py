@@ -6,6 +6,11 @@ from io import BytesIO
 import logging
 import os
 import json
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +18,33 @@ logger = logging.getLogger(__name__)
 face_cascade_path = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
 face_cascade = cv2.CascadeClassifier(face_cascade_path)
 
+# Binary face encoding format: a fixed little-endian header followed by the raw vector
+# header = magic, format version, dtype code, extractor version, dimension
+FACE_ENCODING_MAGIC = b'FENC'
+FACE_ENCODING_FORMAT_VERSION = 1
+# Bump whenever extract_face_features changes its output, so stale encodings are not compared
+EXTRACTOR_VERSION = 1
+_ENCODING_HEADER = struct.Struct('<4sBBHI')
+_ENCODING_DTYPES = {1: np.dtype('<f4'), 2: np.dtype('<f2')}
+_ENCODING_DTYPE_CODES = {dtype: code for code, dtype in _ENCODING_DTYPES.items()}
+
+@dataclass
+class FaceEncodingHeader:
+    """Metadata stored in front of a binary face encoding"""
+    format_version: int
+    dtype: np.dtype
+    extractor_version: int
+    dim: int
+
+@contextmanager
+def stage_timer(timings, stage):
+    """Add the seconds spent in the block to timings[stage]"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
 def process_image_data(image_data):
     """Process the base64 image data and return a numpy array"""
     try:
@@ -23,6 +55,15 @@ def process_image_data(image_data):
         # Decode base64 string to bytes
         image_bytes = base64.b64decode(image_data)
         
+        return process_image_bytes(image_bytes)
+    
+    except Exception as e:
+        logger.error(f"Error processing image data: {str(e)}")
+        return None
+
+def process_image_bytes(image_bytes):
+    """Decode an uploaded image file (JPEG, PNG, ...) straight from its bytes"""
+    try:
         # Convert bytes to numpy array
         image_array = np.frombuffer(image_bytes, dtype=np.uint8)
         
@@ -32,34 +73,228 @@ def process_image_data(image_data):
         return image
     
     except Exception as e:
-        logger.error(f"Error processing image data: {str(e)}")
+        logger.error(f"Error processing image bytes: {str(e)}")
         return None
 
-def detect_face(image):
-    """Detect face in the image using OpenCV's cascade classifier"""
+def load_image(image_data):
+    """Decode a frame given as raw upload bytes or as a base64 (data URL) string"""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return process_image_bytes(image_data)
+    return process_image_data(image_data)
+
+# Frames wider than this are downscaled to this width for detection (0 = detect at full resolution)
+DETECTION_WIDTH = int(os.environ.get("FACE_DETECTION_WIDTH", "640"))
+
+# Re-detect each face in a full-resolution crop around the downscaled detection
+DETECTION_REFINE = os.environ.get("FACE_DETECTION_REFINE", "0") == "1"
+
+# Smallest face reported, in full-resolution pixels
+DETECTION_MIN_SIZE = 80
+
+def detect_face(image, working_width=None, refine=None):
+    """
+    Detect face in the image using OpenCV's cascade classifier
+    
+    Frames wider than working_width (default DETECTION_WIDTH) are searched
+    on a downscaled copy and the boxes are mapped back to full resolution,
+    so the cost no longer grows with the camera resolution. With refine
+    (default DETECTION_REFINE) each box is then re-detected in a small
+    full-resolution region around it for a tighter fit.
+    """
     try:
+        working_width = DETECTION_WIDTH if working_width is None else working_width
+        refine = DETECTION_REFINE if refine is None else refine
+        
+        height, width = image.shape[:2]
+        scale = working_width / width if 0 < working_width < width else 1.0
+        if scale < 1.0:
+            # Area interpolation averages pixels, so the small copy is not aliased
+            small = cv2.resize(image, (working_width, max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+        else:
+            small = image
+        
         # Convert to grayscale for face detection
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
         
         # Apply histogram equalization to improve contrast
         gray = cv2.equalizeHist(gray)
         
         # Detect faces with more strict parameters
+        min_size = max(24, round(DETECTION_MIN_SIZE * scale))
         faces = face_cascade.detectMultiScale(
             gray,
             scaleFactor=1.1,
             minNeighbors=8,  # Increased for stricter detection
-            minSize=(80, 80)  # Increased minimum face size
+            minSize=(min_size, min_size)  # Increased minimum face size
         )
         
+        if scale == 1.0 or len(faces) == 0:
+            return faces
+        
+        # Map the boxes back to full resolution
+        faces = np.rint(np.asarray(faces, dtype=np.float64) / scale).astype(np.int32)
+        faces[:, 2:] = np.minimum(faces[:, 2:], [width, height] - faces[:, :2])
+        
+        if refine:
+            faces = np.array([refine_face_box(image, face) for face in faces], dtype=np.int32)
         return faces
     except Exception as e:
         logger.error(f"Error detecting face: {str(e)}")
         return []
 
-def extract_face_features(image, face):
-    """Extract features from a face region"""
-    try:
+def refine_face_box(image, face, margin=0.25):
+    """
+    Re-run the cascade in a full-resolution crop around a detected face
+    
+    Only sizes within ~30% of the coarse box are searched, so this costs a
+    fraction of a full-frame pass. Returns the detection closest in size
+    to the coarse box, or the coarse box if the crop yields none.
+    """
+    x, y, w, h = (int(v) for v in face)
+    pad_x, pad_y = int(w * margin), int(h * margin)
+    x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+    x1, y1 = min(image.shape[1], x + w + pad_x), min(image.shape[0], y + h + pad_y)
+    
+    gray = cv2.equalizeHist(cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY))
+    candidates = face_cascade.detectMultiScale(
+        gray,
+        scaleFactor=1.05,
+        minNeighbors=8,
+        minSize=(int(w * 0.7), int(h * 0.7)),
+        maxSize=(int(w * 1.3), int(h * 1.3))
+    )
+    if len(candidates) == 0:
+        return np.array([x, y, w, h])
+    
+    best = min(candidates, key=lambda c: abs(int(c[2]) - w))
+    return np.array([best[0] + x0, best[1] + y0, best[2], best[3]])
+
+def box_iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+def lbp_neighbor_offsets(radius=2, neighbors=8):
+    """
+    Return the (dy, dx) sampling offsets used by compute_lbp
+    
+    Neighbors are spaced evenly along the square ring at distance `radius`,
+    clockwise from the top-left corner. With 8 neighbors this is the corner /
+    edge-midpoint pattern the original per-pixel loop used, so bit k of the
+    code still means the same neighbor.
+    """
+    if radius < 1 or neighbors < 1:
+        raise ValueError("radius and neighbors must be positive")
+    
+    perimeter = 8 * radius
+    if neighbors > perimeter:
+        raise ValueError(f"At most {perimeter} neighbors fit on a ring of radius {radius}")
+    
+    offsets = []
+    for k in range(neighbors):
+        pos = k * perimeter // neighbors
+        side, step = divmod(pos, 2 * radius)
+        if side == 0:    # top edge, moving right
+            offsets.append((-radius, -radius + step))
+        elif side == 1:  # right edge, moving down
+            offsets.append((-radius + step, radius))
+        elif side == 2:  # bottom edge, moving left
+            offsets.append((radius, radius - step))
+        else:            # left edge, moving up
+            offsets.append((radius - step, -radius))
+    return offsets
+
+def lbp_code_dtype(neighbors):
+    """Smallest unsigned integer dtype that holds a code of `neighbors` bits"""
+    if neighbors <= 8:
+        return np.dtype(np.uint8)
+    if neighbors <= 16:
+        return np.dtype(np.uint16)
+    return np.dtype(np.uint32)
+
+def compute_lbp(gray, radius=2, neighbors=8, out=None):
+    """
+    Compute the Local Binary Pattern code image of a grayscale image
+    
+    Vectorized with whole-array shifted comparisons: for each neighbor offset
+    the interior of the image is compared against a shifted view of itself,
+    so the cost is `neighbors` array ops instead of a Python loop per pixel.
+    Border pixels closer than `radius` to the edge are left as 0.
+    A preallocated array of the image's shape and lbp_code_dtype can be
+    passed as `out` to avoid allocating the result.
+    """
+    code_dtype = lbp_code_dtype(neighbors).type
+    
+    rows, cols = gray.shape
+    if out is None:
+        lbp = np.zeros((rows, cols), dtype=code_dtype)
+    else:
+        lbp = out
+        lbp.fill(0)
+    if rows <= 2 * radius or cols <= 2 * radius:
+        return lbp
+    
+    center = gray[radius:rows-radius, radius:cols-radius]
+    codes = lbp[radius:rows-radius, radius:cols-radius]
+    for bit, (dy, dx) in enumerate(lbp_neighbor_offsets(radius, neighbors)):
+        neighbor = gray[radius+dy:rows-radius+dy, radius+dx:cols-radius+dx]
+        codes |= (neighbor >= center).astype(code_dtype) << code_dtype(bit)
+    
+    return lbp
+
+class FaceFeatureExtractor:
+    """
+    Reusable LBP + HOG face feature extractor
+    
+    The HOG descriptor, the LBP code image and the histogram index buffer
+    are allocated once per thread and reused for every face, so the hot
+    path only allocates the returned feature vector. Safe to share between
+    threads: each thread lazily gets its own descriptor and buffers.
+    """
+    
+    def __init__(self, face_size=200, radius=2, neighbors=8, grid_x=8, grid_y=8):
+        self.face_size = face_size
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.n_bins = 1 << neighbors
+        self.n_blocks = grid_x * grid_y
+        
+        rows = cols = face_size
+        block_size_y = rows // grid_y
+        block_size_x = cols // grid_x
+        self.block_pixels = block_size_y * block_size_x
+        
+        # Offset of each pixel's block in the concatenated histograms; pixels
+        # outside the grid (when the size is not divisible) go to a spill bin
+        block_row = np.arange(rows) // block_size_y
+        block_col = np.arange(cols) // block_size_x
+        block_index = block_row[:, None] * grid_x + block_col[None, :]
+        inside = (block_row[:, None] < grid_y) & (block_col[None, :] < grid_x)
+        self._spill_bin = self.n_blocks * self.n_bins
+        self._block_offsets = np.where(inside, block_index * self.n_bins, self._spill_bin).astype(np.intp)
+        
+        self._local = threading.local()
+    
+    def _scratch(self):
+        """Per-thread HOG descriptor and work buffers"""
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None:
+            size = self.face_size
+            scratch = {
+                'hog': cv2.HOGDescriptor((size, size), (20, 20), (10, 10), (10, 10), 9),
+                'lbp': np.zeros((size, size), dtype=lbp_code_dtype(self.neighbors)),
+                'index': np.empty((size, size), dtype=np.intp),
+            }
+            self._local.scratch = scratch
+        return scratch
+    
+    def preprocess(self, image, face):
+        """Crop the face with a margin and normalize it to an equalized, blurred gray square"""
         x, y, w, h = face
         
         # Add more margin to capture full face
@@ -72,7 +307,7 @@ def extract_face_features(image, face):
         face_img = image[y:y+h, x:x+w]
         
         # Higher resolution for better feature extraction
-        face_img = cv2.resize(face_img, (200, 200))
+        face_img = cv2.resize(face_img, (self.face_size, self.face_size))
         
         # Convert to grayscale
         gray_face = cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY)
@@ -81,94 +316,245 @@ def extract_face_features(image, face):
         gray_face = cv2.equalizeHist(gray_face)
         
         # Apply Gaussian blur to reduce noise
-        gray_face = cv2.GaussianBlur(gray_face, (5, 5), 0)
-        
-        # Use LBP (Local Binary Patterns) for more accurate face recognition
-        # Create LBPH extractor
-        radius = 2
-        neighbors = 8
-        grid_x = 8
-        grid_y = 8
-        
-        # Manual LBP feature extraction for better control
-        lbp_face = np.zeros_like(gray_face)
-        
-        # For each pixel, compare with neighbors and create binary pattern
-        rows, cols = gray_face.shape
-        for i in range(radius, rows-radius):
-            for j in range(radius, cols-radius):
-                center = gray_face[i, j]
-                binary = 0
-                
-                # Check all neighbors in clockwise order
-                if gray_face[i-radius, j-radius] >= center: binary |= 1 << 0
-                if gray_face[i-radius, j] >= center: binary |= 1 << 1
-                if gray_face[i-radius, j+radius] >= center: binary |= 1 << 2
-                if gray_face[i, j+radius] >= center: binary |= 1 << 3
-                if gray_face[i+radius, j+radius] >= center: binary |= 1 << 4
-                if gray_face[i+radius, j] >= center: binary |= 1 << 5
-                if gray_face[i+radius, j-radius] >= center: binary |= 1 << 6
-                if gray_face[i, j-radius] >= center: binary |= 1 << 7
-                
-                lbp_face[i, j] = binary
-        
-        # Create histogram for each region
-        block_size_x = cols // grid_x
-        block_size_y = rows // grid_y
-        
-        histograms = []
-        for i in range(grid_y):
-            for j in range(grid_x):
-                block = lbp_face[i*block_size_y:(i+1)*block_size_y, j*block_size_x:(j+1)*block_size_x]
-                hist, _ = np.histogram(block, bins=256, range=(0, 256), density=True)
-                histograms.extend(hist)
+        return cv2.GaussianBlur(gray_face, (5, 5), 0)
+    
+    def lbp_histograms(self, gray_face, out):
+        """Write the normalized LBP histogram of every grid block into `out`"""
+        scratch = self._scratch()
+        lbp_face = compute_lbp(gray_face, radius=self.radius, neighbors=self.neighbors, out=scratch['lbp'])
+        
+        # All block histograms in one bincount over block-offset codes
+        index = scratch['index']
+        np.add(self._block_offsets, lbp_face, out=index)
+        counts = np.bincount(index.ravel(), minlength=self._spill_bin + 1)
+        np.divide(counts[:self._spill_bin], self.block_pixels, out=out)
+        return out
+    
+    def extract(self, image, face):
+        """Return the combined LBP + HOG feature vector of one face"""
+        gray_face = self.preprocess(image, face)
         
         # Also add HOG features for additional discrimination
-        hog = cv2.HOGDescriptor((200, 200), (20, 20), (10, 10), (10, 10), 9)
-        hog_features = hog.compute(gray_face).flatten()
+        hog_features = self._scratch()['hog'].compute(gray_face).ravel()
         
-        # Combine LBP and HOG features
-        combined_features = np.concatenate((np.array(histograms), hog_features))
-        
-        return combined_features
+        n_lbp = self._spill_bin
+        features = np.empty(n_lbp + hog_features.shape[0], dtype=np.float64)
+        self.lbp_histograms(gray_face, features[:n_lbp])
+        features[n_lbp:] = hog_features
+        return features
+
+# Shared extractor used by extract_face_features
+face_feature_extractor = FaceFeatureExtractor()
+
+def extract_face_features(image, face):
+    """Extract features from a face region"""
+    try:
+        return face_feature_extractor.extract(image, face)
     except Exception as e:
         logger.error(f"Error extracting face features: {str(e)}")
         return None
 
-def process_and_encode_face(image_data):
-    """Process the image data and return the face features"""
+# Quality gate run on each detected face before feature extraction, so frames that
+# cannot match are rejected for a fraction of the extraction cost
+# Minimum variance of the Laplacian of the normalized face crop; lower is blurry
+QUALITY_MIN_SHARPNESS = float(os.environ.get("FACE_QUALITY_MIN_SHARPNESS", "25"))
+
+# Accepted range of the mean gray level of the face
+QUALITY_MIN_BRIGHTNESS = float(os.environ.get("FACE_QUALITY_MIN_BRIGHTNESS", "50"))
+QUALITY_MAX_BRIGHTNESS = float(os.environ.get("FACE_QUALITY_MAX_BRIGHTNESS", "210"))
+
+# Largest fraction of face pixels allowed to be crushed to black or blown out to white
+QUALITY_MAX_CLIPPED = float(os.environ.get("FACE_QUALITY_MAX_CLIPPED", "0.3"))
+
+# Minimum correlation between the eye region and its mirror image; turned or misframed faces score low
+QUALITY_MIN_SYMMETRY = float(os.environ.get("FACE_QUALITY_MIN_SYMMETRY", "0.2"))
+
+# Faces are scored on a crop resized to this size, so scores do not depend on the face size
+_QUALITY_CROP_SIZE = 128
+
+@dataclass
+class FaceQuality:
+    """Cheap quality scores of one detected face"""
+    scores: dict  # metric -> value: face_size, sharpness, brightness, dark_fraction, bright_fraction, symmetry
+    checks: dict  # check name -> passed
+    reason: str = None  # key of REGISTRATION_MESSAGES for the first failed check
+    
+    @property
+    def ok(self):
+        return self.reason is None
+
+def assess_face_quality(image, face, min_face_size=DETECTION_MIN_SIZE):
+    """
+    Score a detected face without extracting its features
+    
+    Checks, in order: the face is at least min_face_size pixels, it is
+    neither under- nor overexposed (mean gray level and clipped pixels of
+    its histogram), it is sharp (variance of the Laplacian) and it faces
+    the camera (left/right symmetry of the eye region). Exposure is checked
+    before sharpness because a dark face also has little detail.
+    """
+    x, y, w, h = (int(v) for v in face)
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(image.shape[1], x + w), min(image.shape[0], y + h)
+    scores = {'face_size': min(w, h)}
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return FaceQuality(scores, {'face_size': False}, reason='face_too_small')
+    
+    gray = cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+    gray = cv2.resize(gray, (_QUALITY_CROP_SIZE, _QUALITY_CROP_SIZE), interpolation=cv2.INTER_AREA)
+    
+    # Exposure from the gray-level histogram
+    histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel() / gray.size
+    scores['brightness'] = float(histogram @ np.arange(256))
+    scores['dark_fraction'] = float(histogram[:16].sum())
+    scores['bright_fraction'] = float(histogram[240:].sum())
+    
+    # Blur: a sharp face has strong second derivatives at its edges
+    scores['sharpness'] = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    
+    # Pose: a frontal face's eye band correlates with its own mirror image
+    band = gray[int(_QUALITY_CROP_SIZE * 0.2):int(_QUALITY_CROP_SIZE * 0.5)].astype(np.float32)
+    half = _QUALITY_CROP_SIZE // 2
+    left = band[:, :half] - band[:, :half].mean()
+    right = band[:, half:][:, ::-1] - band[:, half:].mean()
+    denominator = np.sqrt(float((left * left).sum()) * float((right * right).sum()))
+    scores['symmetry'] = float((left * right).sum() / denominator) if denominator > 0 else 0.0
+    
+    checks = {
+        'face_size': bool(w >= min_face_size and h >= min_face_size),
+        'not_too_dark': scores['brightness'] >= QUALITY_MIN_BRIGHTNESS and scores['dark_fraction'] <= QUALITY_MAX_CLIPPED,
+        'not_too_bright': scores['brightness'] <= QUALITY_MAX_BRIGHTNESS and scores['bright_fraction'] <= QUALITY_MAX_CLIPPED,
+        'sharpness': scores['sharpness'] >= QUALITY_MIN_SHARPNESS,
+        'symmetry': scores['symmetry'] >= QUALITY_MIN_SYMMETRY,
+    }
+    reasons = {'face_size': 'face_too_small', 'not_too_dark': 'too_dark', 'not_too_bright': 'too_bright',
+               'sharpness': 'blurry', 'symmetry': 'off_angle'}
+    reason = next((reasons[check] for check, passed in checks.items() if not passed), None)
+    return FaceQuality(scores, checks, reason)
+
+# User-facing explanation for each rejection reason of the registration and attendance pipelines
+REGISTRATION_MESSAGES = {
+    'invalid_image': "Could not process the image. Please try again.",
+    'no_face': "No face detected in the image. Please ensure your face is clearly visible.",
+    'multiple_faces': "Multiple faces detected. Please ensure only one person is in the frame.",
+    'face_too_small': "Face is too small in the image. Please move closer to the camera.",
+    'too_dark': "The image is too dark. Please improve the lighting on your face.",
+    'too_bright': "The image is overexposed. Please avoid strong light shining on your face or into the camera.",
+    'blurry': "The image is blurry. Please hold still and make sure the camera is in focus.",
+    'off_angle': "Please look straight at the camera with your whole face in the frame.",
+    'extraction_failed': "Could not extract facial features. Please ensure good lighting and a clear view of your face.",
+}
+
+@dataclass
+class RegistrationResult:
+    """Everything the registration pipeline computed for one frame"""
+    image: np.ndarray = None  # decoded BGR frame
+    faces: list = None  # detected face boxes (x, y, w, h)
+    quality: dict = None  # check name -> passed
+    quality_scores: dict = None  # FaceQuality scores of the detected face
+    features: np.ndarray = None  # normalized feature vector, None if rejected
+    reason: str = None  # key of REGISTRATION_MESSAGES when the frame was rejected
+    timings: dict = field(default_factory=dict)  # stage -> seconds spent in it
+    
+    @property
+    def ok(self):
+        return self.reason is None
+    
+    @property
+    def message(self):
+        return REGISTRATION_MESSAGES.get(self.reason)
+
+def prepare_face_registration(image_data, min_face_size=100, check_quality=True):
+    """
+    Run the registration pipeline on one frame, decoding and detecting only once
+    
+    Decodes the image (upload bytes or base64), detects faces, checks that
+    there is exactly one face and that it passes the quality gate (see
+    assess_face_quality) and extracts its normalized features. The result
+    carries the intermediate image and detections along with the verdicts,
+    so callers never need to repeat a stage.
+    """
+    result = RegistrationResult(quality={})
     try:
-        # Process the image data
-        image = process_image_data(image_data)
-        if image is None:
-            logger.error("Failed to process image data")
-            return None
-        
-        # Detect faces
-        faces = detect_face(image)
-        
-        # If no face or multiple faces detected, return None
-        if len(faces) != 1:
-            logger.warning(f"Expected exactly 1 face, but found {len(faces)} faces")
-            return None
-        
-        # Extract features from the face
-        face_features = extract_face_features(image, faces[0])
+        with stage_timer(result.timings, 'decode'):
+            result.image = load_image(image_data)
+        if result.image is None:
+            result.reason = 'invalid_image'
+            return result
+        
+        with stage_timer(result.timings, 'detect'):
+            result.faces = detect_face(result.image)
+        
+        result.quality['single_face'] = len(result.faces) == 1
+        if len(result.faces) == 0:
+            result.reason = 'no_face'
+            return result
+        if len(result.faces) > 1:
+            result.reason = 'multiple_faces'
+            return result
+        
+        # Face should be large, well exposed, sharp and frontal enough for good recognition
+        if check_quality:
+            with stage_timer(result.timings, 'quality'):
+                quality = assess_face_quality(result.image, result.faces[0], min_face_size=min_face_size)
+            result.quality.update(quality.checks)
+            result.quality_scores = quality.scores
+            if not quality.ok:
+                logger.info(f"Registration frame rejected: {quality.reason} {quality.scores}")
+                result.reason = quality.reason
+                return result
+        
+        with stage_timer(result.timings, 'extract'):
+            face_features = extract_face_features(result.image, result.faces[0])
+        if face_features is None or np.linalg.norm(face_features) == 0:
+            result.reason = 'extraction_failed'
+            return result
         
-        if face_features is None:
-            logger.error("Failed to extract face features")
-            return None
-            
         # Normalize the feature vector (important for consistent comparisons)
-        face_features = face_features / np.linalg.norm(face_features)
-        
-        return face_features
+        result.features = face_features / np.linalg.norm(face_features)
+        return result
     
     except Exception as e:
-        logger.error(f"Error encoding face: {str(e)}")
+        logger.error(f"Error in face registration pipeline: {str(e)}")
+        result.reason = result.reason or 'extraction_failed'
+        return result
+
+def process_and_encode_face(image_data):
+    """Process the image data and return the face features"""
+    result = prepare_face_registration(image_data, check_quality=False)
+    if not result.ok:
+        logger.warning(f"Could not encode face: {result.reason}")
         return None
+    return result.features
+
+def build_face_prototype(templates, max_deviation=0.1):
+    """
+    Aggregate the enrollment templates of one student into a single encoding
+    
+    Each template is compared with the mean of the others; templates
+    scoring more than max_deviation below the median (a blink, motion blur,
+    a half-turned head) are left out before the rest are averaged. With
+    fewer than three templates there is no majority to judge by and all
+    are kept.
+    
+    Returns the unit-length prototype and a boolean mask of the templates it
+    was built from.
+    """
+    templates = normalize_rows(templates)
+    keep = np.ones(len(templates), dtype=bool)
+    if len(templates) >= 3:
+        # Similarity of every template to the mean of all the others
+        others = normalize_rows(templates.sum(axis=0) - templates)
+        similarities = np.einsum('ij,ij->i', templates, others)
+        keep = similarities >= np.median(similarities) - max_deviation
+    
+    prototype = normalize_rows(templates[keep].mean(axis=0))[0]
+    return prototype, keep
+
+# Cosine similarity a face must exceed (strictly) to match a student, in every recognition path
+MATCH_THRESHOLD = 0.75
 
-def compare_face_features(face_features1, face_features2, tolerance=0.75):
+def compare_face_features(face_features1, face_features2, tolerance=MATCH_THRESHOLD):
     """
     Compare two face features and determine if they match
     
@@ -197,76 +583,382 @@ def compare_face_features(face_features1, face_features2, tolerance=0.75):
         logger.error(f"Error comparing faces: {str(e)}")
         return False
 
-def recognize_faces(image_data, known_encodings, known_ids, tolerance=0.75):
+def normalize_rows(matrix):
+    """Return a float32 copy of a 2D array with every non-zero row scaled to unit length"""
+    matrix = np.array(matrix, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # Leave all-zero rows as they are instead of dividing by zero
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+# Quantized gallery rows are widened to float32 this many at a time for scoring
+QUANTIZED_SCORE_BLOCK = 4096
+
+@dataclass
+class QuantizedMatrix:
+    """
+    L2-normalized gallery rows stored at reduced precision
+    
+    float16 rows are stored as they are. int8 rows are stored as
+    round(row / scale) with one float32 scale per row, so row ~= data * scale.
     """
-    Recognize faces in the image and return the IDs of recognized students
+    data: np.ndarray  # (n_rows, dim) float16 or int8
+    scales: np.ndarray = None  # (n_rows,) float32 per-row scales, int8 only
+    
+    def __len__(self):
+        return self.data.shape[0]
+    
+    @property
+    def shape(self):
+        return self.data.shape
+    
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+    
+    def score(self, probes):
+        """(n_probes, n_rows) dot products of normalized float32 probes with the rows"""
+        scores = np.empty((probes.shape[0], len(self)), dtype=np.float32)
+        # Widen one block at a time so scoring runs as a BLAS GEMM without a full float32 copy
+        for start in range(0, len(self), QUANTIZED_SCORE_BLOCK):
+            block = self.data[start:start + QUANTIZED_SCORE_BLOCK].astype(np.float32)
+            scores[:, start:start + QUANTIZED_SCORE_BLOCK] = probes @ block.T
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+GALLERY_DTYPES = ('float32', 'float16', 'int8')
+
+def quantize_rows(matrix, dtype='float32'):
+    """Normalize rows and store them as a float32 array or a float16 / int8 QuantizedMatrix"""
+    matrix = normalize_rows(matrix)
+    if dtype == 'float32':
+        return matrix
+    if dtype == 'float16':
+        return QuantizedMatrix(matrix.astype(np.float16))
+    if dtype == 'int8':
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        data = np.rint(matrix / scales[:, None]).astype(np.int8)
+        return QuantizedMatrix(data, scales.astype(np.float32))
+    raise ValueError(f"Unsupported gallery dtype: {dtype}")
+
+@dataclass
+class MatchResult:
+    """Scores of a batch of probe faces against a gallery"""
+    top_ids: np.ndarray  # (n_faces, k) gallery ids, best first
+    top_scores: np.ndarray  # (n_faces, k) cosine similarities, best first
+    assigned_ids: list  # per face, the student id it was assigned to or None
+    assigned_scores: list  # per face, the similarity of the assignment or None
+
+# Best candidates scoring within this distance of the threshold are re-scored against the full-precision templates
+RERANK_MARGIN = float(os.environ.get("FACE_RERANK_MARGIN", "0.05"))
+
+def match_face_features(probe_features, gallery_matrix, gallery_ids, tolerance=MATCH_THRESHOLD, top_k=3, gallery_normalized=False,
+                        templates=None, rerank_margin=RERANK_MARGIN):
+    """
+    Score every probe face against the whole gallery with one matrix product
     
     Args:
-        image_data: Base64 encoded image data
-        known_encodings: List of known face encodings (features)
+        probe_features: (n_faces, dim) feature vectors of the detected faces
+        gallery_matrix: (n_students, dim) known face encodings
+        gallery_ids: Student IDs aligned with the gallery rows
+        tolerance: Similarity a pair must exceed to count as a match
+        top_k: Number of best candidates to report per face
+        gallery_normalized: Skip re-normalizing gallery rows that are already unit length
+        templates: Full-precision encodings (the prototype and the individual
+            enrollment templates) by student id, as kept in CourseGallery.templates;
+            a face whose best candidate is within rerank_margin of the threshold
+            is re-scored with them before the match decision
+        rerank_margin: Distance from the threshold within which scores are re-scored
+        
+    Returns:
+        MatchResult. Faces are assigned one-to-one, best pair first, so two
+        faces in the same frame can never claim the same student.
+    """
+    scores = score_face_features(probe_features, gallery_matrix, gallery_normalized=gallery_normalized)
+    if templates:
+        rerank_near_threshold(scores, probe_features, gallery_ids, tolerance, templates, margin=rerank_margin)
+    return assign_face_matches(scores, gallery_ids, tolerance=tolerance, top_k=top_k)
+
+def score_face_features(probe_features, gallery_matrix, gallery_normalized=False):
+    """(n_faces, n_students) cosine similarities of probe faces to gallery rows, in a single GEMM"""
+    probes = normalize_rows(probe_features)
+    if isinstance(gallery_matrix, QuantizedMatrix):
+        return gallery_matrix.score(probes)
+    if gallery_normalized:
+        gallery = np.asarray(gallery_matrix, dtype=np.float32)
+    else:
+        gallery = normalize_rows(gallery_matrix)
+    return probes @ gallery.T
+
+def rerank_near_threshold(scores, probe_features, gallery_ids, tolerance, templates, margin=RERANK_MARGIN):
+    """
+    Re-score each face's best candidate when its score is within margin of the threshold
+    
+    Galleries hold one prototype per student, possibly quantized.
+    templates maps student ids to (n, dim) L2-normalized full-precision
+    rows (the prototype and its enrollment templates); a re-scored pair
+    takes its best row. Students without an entry keep their gallery
+    score. Scores are updated in place and returned.
+    """
+    if scores.size == 0:
+        return scores
+    best = scores.argmax(axis=1)
+    faces = np.nonzero(np.abs(scores[np.arange(len(best)), best] - tolerance) <= margin)[0]
+    if len(faces) == 0:
+        return scores
+    
+    gallery_ids = np.asarray(gallery_ids)
+    probes = normalize_rows(probe_features[faces])
+    reranked = 0
+    for probe, face in zip(probes, faces):
+        student_templates = templates.get(gallery_ids[best[face]].item())
+        if student_templates is not None:
+            scores[face, best[face]] = (student_templates @ probe).max()
+            reranked += 1
+    logger.debug(f"Re-ranked {reranked} near-threshold faces against full-precision templates")
+    return scores
+
+def assign_face_matches(scores, gallery_ids, tolerance=MATCH_THRESHOLD, top_k=3):
+    """
+    Turn a probe-by-gallery similarity matrix into a MatchResult
+    
+    Reports the top_k candidates per face and assigns faces one-to-one,
+    best pair first, so two faces can never claim the same student.
+    """
+    gallery_ids = np.asarray(gallery_ids)
+    n_faces, n_students = scores.shape
+    
+    k = min(top_k, n_students)
+    if k < n_students:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(n_students), (n_faces, n_students))
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    
+    # Greedy one-to-one assignment over the pairs above the threshold, best first
+    assigned_ids = [None] * n_faces
+    assigned_scores = [None] * n_faces
+    face_idx, gallery_idx = np.nonzero(scores > tolerance)
+    taken = set()
+    for pair in np.argsort(-scores[face_idx, gallery_idx], kind='stable'):
+        face, row = face_idx[pair], gallery_idx[pair]
+        if assigned_ids[face] is not None or row in taken:
+            continue
+        assigned_ids[face] = gallery_ids[row].item()
+        assigned_scores[face] = float(scores[face, row])
+        taken.add(row)
+    
+    return MatchResult(gallery_ids[top], top_scores, assigned_ids, assigned_scores)
+
+@dataclass
+class FaceRecognition:
+    """Match decision for one detected face"""
+    box: tuple  # (x, y, w, h) in the frame
+    best_id: int = None  # most similar student, whether or not it passed the threshold
+    best_score: float = None  # similarity to best_id
+    matched_id: int = None  # student the face was assigned to, None if no match
+    
+    @property
+    def matched(self):
+        return self.matched_id is not None
+
+@dataclass
+class RecognitionResult:
+    """Outcome of recognize_faces for one frame"""
+    faces: list  # FaceRecognition per detected face
+    reason: str = None  # why recognition could not run: 'no_gallery', 'invalid_image', 'no_face' or a quality reason
+    probes: 'ProbeFaces' = None  # the frame's extracted faces, with their stage timings and quality rejections
+    
+    @property
+    def recognized_ids(self):
+        return [face.matched_id for face in self.faces if face.matched]
+    
+    @property
+    def best_face(self):
+        """The face with the highest similarity to any known student, or None"""
+        scored = [face for face in self.faces if face.best_score is not None]
+        return max(scored, key=lambda face: face.best_score, default=None)
+
+@dataclass
+class ProbeFaces:
+    """Detected faces of one frame and their feature vectors, ready for matching"""
+    boxes: list  # (x, y, w, h) per face that produced features
+    features: np.ndarray = None  # (n_faces, dim) raw feature vectors, None if there are none
+    reason: str = None  # why there is nothing to match: 'invalid_image', 'no_face' or the quality reason of the first face
+    rejected: list = field(default_factory=list)  # quality reason of each face skipped before extraction
+    detected: int = 0  # faces found by the detector
+    timings: dict = field(default_factory=dict)  # stage -> seconds spent in it
+
+def extract_probe_features(image_data, check_quality=True):
+    """
+    Decode a frame (upload bytes or base64), detect faces and extract
+    features for each of them
+    
+    This is the expensive, database-independent half of recognition; the
+    result is small and picklable so it can be computed in a worker process.
+    Faces failing the quality gate are skipped before extraction; when all
+    of them fail, reason is the first face's quality reason.
+    """
+    timings = {}
+    
+    # Process the image data
+    with stage_timer(timings, 'decode'):
+        image = load_image(image_data)
+    if image is None:
+        logger.error("Failed to process image data")
+        return ProbeFaces([], reason='invalid_image', timings=timings)
+    
+    # Detect faces
+    with stage_timer(timings, 'detect'):
+        faces = detect_face(image)
+    
+    # If no faces detected, there is nothing to match
+    if len(faces) == 0:
+        logger.warning("No faces detected in the image")
+        return ProbeFaces([], reason='no_face', timings=timings)
+    
+    boxes = []
+    face_features = []
+    rejected = []
+    for face in faces:
+        if check_quality:
+            with stage_timer(timings, 'quality'):
+                quality = assess_face_quality(image, face)
+            if not quality.ok:
+                logger.info(f"Skipping low-quality face: {quality.reason} {quality.scores}")
+                rejected.append(quality.reason)
+                continue
+        
+        with stage_timer(timings, 'extract'):
+            features = extract_face_features(image, face)
+        if features is None:
+            logger.warning("Failed to extract features from detected face")
+            continue
+        boxes.append(tuple(int(v) for v in face))
+        face_features.append(features)
+    
+    if not face_features:
+        return ProbeFaces(boxes, reason=rejected[0] if rejected else None, rejected=rejected,
+                          detected=len(faces), timings=timings)
+    return ProbeFaces(boxes, np.vstack(face_features), rejected=rejected, detected=len(faces), timings=timings)
+
+def match_probe_faces(probes, known_encodings, known_ids, tolerance=MATCH_THRESHOLD, known_normalized=False, templates=None):
+    """Score extracted probe faces against known encodings and build the RecognitionResult"""
+    if probes.reason is not None or probes.features is None:
+        return build_recognition_result(probes, None)
+    
+    # Score all faces in one batch
+    with stage_timer(probes.timings, 'match'):
+        match = match_face_features(probes.features, known_encodings, known_ids,
+                                    tolerance=tolerance, gallery_normalized=known_normalized,
+                                    templates=templates)
+    return build_recognition_result(probes, match)
+
+def build_recognition_result(probes, match):
+    """Combine a frame's probe faces with their MatchResult (None if nothing was scored)"""
+    if probes.reason is not None:
+        return RecognitionResult([], reason=probes.reason, probes=probes)
+    
+    results = [FaceRecognition(box) for box in probes.boxes]
+    if match is None:
+        return RecognitionResult(results, probes=probes)
+    
+    for i, face in enumerate(results):
+        face.best_id = match.top_ids[i, 0].item()
+        face.best_score = float(match.top_scores[i, 0])
+        face.matched_id = match.assigned_ids[i]
+    
+    # Log the best candidates for troubleshooting
+    logger.info(f"Face match candidates: {[dict(zip(ids.tolist(), scores.tolist())) for ids, scores in zip(match.top_ids, match.top_scores)]}")
+    
+    return RecognitionResult(results, probes=probes)
+
+def recognize_faces(image_data, known_encodings, known_ids, tolerance=MATCH_THRESHOLD, known_normalized=False):
+    """
+    Recognize faces in the image and report the match decision for each face
+    
+    Args:
+        image_data: Uploaded image bytes or base64 encoded image data
+        known_encodings: List or matrix of known face encodings (features), one per row
         known_ids: List of corresponding student IDs
         tolerance: Face recognition similarity threshold (higher = stricter matching)
+        known_normalized: True if the known encodings are already unit length
         
     Returns:
-        List of recognized student IDs
+        RecognitionResult with the best candidate, its score and the match
+        decision for every detected face, so callers can log diagnostics
+        without running recognition again
     """
     try:
-        if not known_encodings or not known_ids:
+        if len(known_encodings) == 0 or len(known_ids) == 0:
             logger.warning("No known encodings or IDs provided")
-            return []
-        
-        # Process the image data
-        image = process_image_data(image_data)
-        if image is None:
-            logger.error("Failed to process image data")
-            return []
-        
-        # Detect faces
-        faces = detect_face(image)
-        
-        # If no faces detected, return empty list
-        if len(faces) == 0:
-            logger.warning("No faces detected in the image")
-            return []
-        
-        recognized_ids = []
-        similarities = {}  # Track similarities for logging
+            return RecognitionResult([], reason='no_gallery')
         
-        # Check each face in the image
-        for face in faces:
-            # Extract features
-            face_features = extract_face_features(image, face)
-            if face_features is None:
-                logger.warning("Failed to extract features from detected face")
-                continue
-            
-            # Normalize the feature vector
-            if np.linalg.norm(face_features) > 0:
-                face_features = face_features / np.linalg.norm(face_features)
-            
-            # Compare with known encodings
-            for i, known_encoding in enumerate(known_encodings):
-                # Compute similarity
-                if np.linalg.norm(known_encoding) > 0:
-                    known_encoding_norm = known_encoding / np.linalg.norm(known_encoding)
-                else:
-                    known_encoding_norm = known_encoding
-                
-                similarity = np.dot(face_features, known_encoding_norm)
-                similarities[known_ids[i]] = similarity
-                
-                if similarity > tolerance:
-                    recognized_ids.append(known_ids[i])
-                    break
-        
-        # Log all similarities for troubleshooting
-        if similarities:
-            logger.info(f"Face match similarities: {similarities}")
-            if not recognized_ids:
-                logger.info(f"No matches found with tolerance {tolerance}. Highest similarity: {max(similarities.values())}")
-        
-        return recognized_ids
+        probes = extract_probe_features(image_data)
+        return match_probe_faces(probes, known_encodings, known_ids,
+                                 tolerance=tolerance, known_normalized=known_normalized)
     
     except Exception as e:
         logger.error(f"Error recognizing faces: {str(e)}")
-        return []
\ No newline at end of file
+        return RecognitionResult([])
+
+def encode_face_encoding(features, dtype=np.float32, extractor_version=EXTRACTOR_VERSION):
+    """Serialize a feature vector to the binary face encoding format (float32 or float16)"""
+    dtype = np.dtype(dtype).newbyteorder('<')
+    if dtype not in _ENCODING_DTYPE_CODES:
+        raise ValueError(f"Unsupported face encoding dtype: {dtype}")
+    
+    vector = np.ascontiguousarray(np.ravel(features), dtype=dtype)
+    header = _ENCODING_HEADER.pack(FACE_ENCODING_MAGIC, FACE_ENCODING_FORMAT_VERSION,
+                                   _ENCODING_DTYPE_CODES[dtype], extractor_version, vector.shape[0])
+    return header + vector.tobytes()
+
+def read_face_encoding_header(blob):
+    """Parse and validate the header of a binary face encoding"""
+    if len(blob) < _ENCODING_HEADER.size:
+        raise ValueError("Face encoding is too short")
+    
+    magic, format_version, dtype_code, extractor_version, dim = _ENCODING_HEADER.unpack_from(blob)
+    if magic != FACE_ENCODING_MAGIC:
+        raise ValueError("Not a binary face encoding")
+    if format_version != FACE_ENCODING_FORMAT_VERSION:
+        raise ValueError(f"Unsupported face encoding format version {format_version}")
+    if dtype_code not in _ENCODING_DTYPES:
+        raise ValueError(f"Unknown face encoding dtype code {dtype_code}")
+    
+    dtype = _ENCODING_DTYPES[dtype_code]
+    if len(blob) != _ENCODING_HEADER.size + dim * dtype.itemsize:
+        raise ValueError("Face encoding length does not match its header")
+    return FaceEncodingHeader(format_version, dtype, extractor_version, dim)
+
+def decode_face_encoding(blob):
+    """
+    Decode a binary face encoding
+    
+    Returns a read-only view over the stored bytes (no copy is made),
+    in the dtype the encoding was written with.
+    """
+    header = read_face_encoding_header(blob)
+    return np.frombuffer(blob, dtype=header.dtype, count=header.dim, offset=_ENCODING_HEADER.size)
+
+def load_face_encoding(value):
+    """
+    Load a stored face encoding, either binary or legacy JSON text
+    
+    Raises ValueError for encodings produced by a different extractor
+    version, since they cannot be compared with current features.
+    """
+    if isinstance(value, str):
+        return np.array(json.loads(value), dtype=np.float32)
+    
+    header = read_face_encoding_header(value)
+    if header.extractor_version != EXTRACTOR_VERSION:
+        raise ValueError(f"Encoding was made by extractor version {header.extractor_version}, "
+                         f"current version is {EXTRACTOR_VERSION}; the face must be registered again")
+    return decode_face_encoding(value)
@@ -0,0 +1,155 @@
+"""
+In-memory cache of per-course face galleries
+Keeps the decoded, normalized encodings of each course's students so that
+mark_attendance does not have to parse every stored encoding on each request
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from face_utils import normalize_rows, quantize_rows
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class CourseGallery:
+    """Face encodings of one course, ready for matching"""
+    matrix: object  # (n_students, dim) float32 array or float16/int8 QuantizedMatrix, rows L2-normalized
+    ids: np.ndarray  # (n_students,) int64 student primary keys, aligned with matrix rows
+    names: dict = field(default_factory=dict)  # student id -> name, for logging
+    # student id -> (n, dim) float32 normalized prototype and enrollment templates, for re-ranking near-threshold matches
+    templates: dict = field(default_factory=dict)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        """Memory held by the encodings"""
+        return self.matrix.nbytes + sum(rows.nbytes for rows in self.templates.values())
+
+def build_gallery(encodings, ids, names=None, projection=None, dtype='float32', templates=None):
+    """
+    Stack encodings into a normalized matrix, skipping rows of the wrong dimension
+
+    With a FaceProjection the stored raw encodings are projected first, so
+    the gallery is matched in the projection's lower dimension. dtype
+    'float16' or 'int8' stores the rows quantized, at 1/2 or 1/4 of the
+    float32 size.
+
+    templates maps student ids to their raw enrollment templates. When
+    given, each student's full-precision prototype and templates are kept
+    for re-ranking near-threshold matches; a float32 gallery keeps them
+    only for students with two or more templates, since the prototype of a
+    single template already is that template at full precision.
+    """
+    names = names or {}
+    rows = []
+    kept_ids = []
+    dim = None
+    for student_id, encoding in zip(ids, encodings):
+        encoding = np.asarray(encoding, dtype=np.float32).ravel()
+        if dim is None:
+            dim = encoding.shape[0]
+        elif encoding.shape[0] != dim:
+            logger.warning(f"Skipping face encoding for student {student_id}: expected {dim} values, got {encoding.shape[0]}")
+            continue
+        rows.append(encoding)
+        kept_ids.append(student_id)
+
+    if not rows:
+        return CourseGallery(np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64), {})
+
+    matrix = np.vstack(rows)
+    if projection is not None:
+        matrix = projection.project(matrix)
+
+    kept_templates = {}
+    for row, student_id in enumerate(kept_ids if templates is not None else []):
+        student_templates = [np.asarray(template, dtype=np.float32).ravel() for template in templates.get(student_id, [])]
+        student_templates = [template for template in student_templates if template.shape[0] == dim]
+        if dtype == 'float32' and len(student_templates) < 2:
+            continue
+        exact = [matrix[row:row + 1]]
+        if student_templates:
+            stacked = np.vstack(student_templates)
+            exact.append(projection.project(stacked) if projection is not None else stacked)
+        kept_templates[student_id] = normalize_rows(np.vstack(exact))
+
+    matrix = quantize_rows(matrix, dtype)
+    kept_names = {student_id: names[student_id] for student_id in kept_ids if student_id in names}
+    return CourseGallery(matrix, np.asarray(kept_ids, dtype=np.int64), kept_names, kept_templates)
+
+class GalleryCache:
+    """
+    Process-level cache of CourseGallery objects keyed by course id
+
+    Galleries are built on first use by a loader callable and kept until
+    invalidate() is called for the course. Every route that changes a
+    student's encoding or course enrollment must invalidate the affected
+    courses after committing.
+
+    invalidate() only reaches the process it runs in. With several server
+    workers, a ttl in seconds bounds how long the other workers keep
+    serving a gallery built before the change; ttl None keeps galleries
+    until invalidated, which is only correct with a single worker.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._galleries = {}
+        # Monotonic time each cached gallery was loaded, for ttl expiry
+        self._loaded_at = {}
+        # Bumped on every invalidation so a load racing with an invalidation is not cached
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, course_id, loader):
+        """Return the gallery for a course, building it with loader(course_id) on a miss"""
+        with self._lock:
+            gallery = self._galleries.get(course_id)
+            if gallery is not None and self.ttl and time.monotonic() - self._loaded_at[course_id] > self.ttl:
+                del self._galleries[course_id]
+                gallery = None
+            if gallery is not None:
+                self.hits += 1
+                return gallery
+            self.misses += 1
+            generation = self._generations.get(course_id, 0)
+
+        loaded_at = time.monotonic()
+        gallery = loader(course_id)
+
+        with self._lock:
+            if self._generations.get(course_id, 0) == generation:
+                self._galleries[course_id] = gallery
+                self._loaded_at[course_id] = loaded_at
+        logger.info(f"Loaded face gallery for course {course_id} ({len(gallery)} students)")
+        return gallery
+
+    def invalidate(self, course_ids=None):
+        """Drop cached galleries for the given course ids, or for every course if None"""
+        with self._lock:
+            if course_ids is None:
+                course_ids = list(set(self._galleries) | set(self._generations))
+            for course_id in course_ids:
+                self._galleries.pop(course_id, None)
+                self._generations[course_id] = self._generations.get(course_id, 0) + 1
+
+    def stats(self):
+        """Return hit/miss counters and the number of cached courses"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "courses": len(self._galleries),
+            }
+
+# Shared instance used by the Flask routes
+gallery_cache = GalleryCache()
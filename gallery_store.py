@@ -0,0 +1,284 @@
+"""
+Memory-mapped gallery file shared by worker processes
+All course galleries are written to one file that every worker maps
+read-only, so N workers share a single page-cache copy of the encodings
+instead of decoding and holding their own
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+from face_utils import EXTRACTOR_VERSION, QuantizedMatrix
+from gallery_cache import CourseGallery
+
+logger = logging.getLogger(__name__)
+
+# File locking serializes rebuilds across processes where available
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+GALLERY_FILE_MAGIC = b'FGAL'
+GALLERY_FILE_FORMAT_VERSION = 3
+
+# magic, format version, dtype code, extractor version, dim, rows, template rows, courses, generation, projection version
+_GALLERY_HEADER = struct.Struct('<4sBBHIIIIQ32s')
+_COURSE_ENTRY = np.dtype([('course_id', '<i8'), ('offset', '<u4'), ('count', '<u4'),
+                          ('template_offset', '<u4'), ('template_count', '<u4')])
+_GALLERY_DTYPES = {1: 'float32', 2: 'float16', 3: 'int8'}
+_GALLERY_DTYPE_CODES = {name: code for code, name in _GALLERY_DTYPES.items()}
+
+# The matrix starts on a cache-line boundary
+_MATRIX_ALIGNMENT = 64
+
+def _matrix_parts(matrix):
+    """(data, scales, dtype name) of a float32 array or QuantizedMatrix"""
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.data, matrix.scales, matrix.data.dtype.name
+    return np.asarray(matrix, dtype=np.float32), None, 'float32'
+
+def _padding(position):
+    return b'\0' * (-position % _MATRIX_ALIGNMENT)
+
+def write_gallery_file(path, galleries, generation=0, dtype=None, projection_version=None):
+    """
+    Write {course_id: CourseGallery} to path, atomically replacing any existing file
+
+    Each course's rows are stored contiguously, so a student enrolled in
+    several courses is stored once per course, and so are the float32
+    templates kept for re-ranking. All galleries must share one dimension
+    and storage dtype (dtype, or the first course's when None); courses
+    that do not are skipped. The extractor version, dtype and
+    projection_version (None for raw features) are recorded in the header,
+    so readers can tell a file built under another configuration.
+    """
+    entries = []
+    ids = []
+    data_parts = []
+    scale_parts = []
+    template_ids = []
+    template_parts = []
+    dim = None
+    dtype_name = dtype
+    offset = 0
+    template_offset = 0
+    for course_id, gallery in galleries.items():
+        if len(gallery) == 0:
+            entries.append((course_id, offset, 0, template_offset, 0))
+            continue
+        data, scales, name = _matrix_parts(gallery.matrix)
+        if dim is None and dtype_name in (None, name):
+            dim, dtype_name = data.shape[1], name
+        elif data.shape[1] != dim or name != dtype_name:
+            logger.warning(f"Skipping course {course_id} in gallery file: {name} x {data.shape[1]} does not match {dtype_name} x {dim}")
+            continue
+        course_templates = 0
+        for student_id, rows in gallery.templates.items():
+            template_ids.append(np.full(len(rows), student_id, dtype='<i8'))
+            template_parts.append(np.asarray(rows, dtype='<f4'))
+            course_templates += len(rows)
+        entries.append((course_id, offset, len(gallery), template_offset, course_templates))
+        ids.append(np.asarray(gallery.ids, dtype='<i8'))
+        data_parts.append(data)
+        if scales is not None:
+            scale_parts.append(scales)
+        offset += len(gallery)
+        template_offset += course_templates
+
+    dim = dim or 0
+    dtype_name = dtype_name or 'float32'
+    header = _GALLERY_HEADER.pack(GALLERY_FILE_MAGIC, GALLERY_FILE_FORMAT_VERSION, _GALLERY_DTYPE_CODES[dtype_name],
+                                  EXTRACTOR_VERSION, dim, offset, template_offset, len(entries), generation,
+                                  (projection_version or '').encode('ascii'))
+    sections = [
+        header,
+        np.array(entries, dtype=_COURSE_ENTRY).tobytes(),
+        np.concatenate(ids).tobytes() if ids else b'',
+        np.concatenate(scale_parts).astype('<f4').tobytes() if scale_parts else b'',
+        np.concatenate(template_ids).tobytes() if template_ids else b'',
+    ]
+    position = sum(len(section) for section in sections)
+    sections.append(_padding(position))
+    position += len(sections[-1])
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        for section in sections:
+            f.write(section)
+        for data in data_parts:
+            chunk = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<')).tobytes()
+            f.write(chunk)
+            position += len(chunk)
+        f.write(_padding(position))
+        for rows in template_parts:
+            f.write(np.ascontiguousarray(rows).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_gallery_generation(path):
+    """Generation number of the gallery file at path, -1 if there is none"""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_GALLERY_HEADER.size)
+        magic, format_version, _, _, _, _, _, _, generation, _ = _GALLERY_HEADER.unpack(header)
+    except (OSError, struct.error):
+        return -1
+    return generation if magic == GALLERY_FILE_MAGIC and format_version == GALLERY_FILE_FORMAT_VERSION else -1
+
+class GalleryFile:
+    """A gallery file mapped read-only; course galleries are zero-copy views of the mapping"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < _GALLERY_HEADER.size or self._map[:4] != GALLERY_FILE_MAGIC:
+            raise ValueError(f"{path} is not a gallery file")
+        if self._map[4] != GALLERY_FILE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported gallery file format version {self._map[4]}")
+        (_, _, dtype_code, self.extractor_version, dim, n_rows, n_template_rows, n_courses, self.generation,
+         projection_version) = _GALLERY_HEADER.unpack_from(self._map)
+        dtype_name = self.dtype = _GALLERY_DTYPES[dtype_code]
+        self.projection_version = projection_version.rstrip(b'\0').decode('ascii') or None
+
+        position = _GALLERY_HEADER.size
+        entries = np.frombuffer(self._map, dtype=_COURSE_ENTRY, count=n_courses, offset=position)
+        position += entries.nbytes
+        ids = np.frombuffer(self._map, dtype='<i8', count=n_rows, offset=position)
+        position += ids.nbytes
+        scales = None
+        if dtype_name == 'int8':
+            scales = np.frombuffer(self._map, dtype='<f4', count=n_rows, offset=position)
+            position += scales.nbytes
+        template_ids = np.frombuffer(self._map, dtype='<i8', count=n_template_rows, offset=position)
+        position += template_ids.nbytes
+        position += -position % _MATRIX_ALIGNMENT
+        matrix = np.frombuffer(self._map, dtype=np.dtype(dtype_name).newbyteorder('<'),
+                               count=n_rows * dim, offset=position).reshape(n_rows, dim)
+        position += matrix.nbytes
+        position += -position % _MATRIX_ALIGNMENT
+        templates = np.frombuffer(self._map, dtype='<f4', count=n_template_rows * dim,
+                                  offset=position).reshape(n_template_rows, dim)
+
+        self.galleries = {}
+        for course_id, offset, count, template_offset, template_count in entries.tolist():
+            rows = slice(offset, offset + count)
+            if dtype_name == 'float32':
+                course_matrix = matrix[rows]
+            else:
+                course_matrix = QuantizedMatrix(matrix[rows], scales[rows] if scales is not None else None)
+            # A student's templates are stored contiguously within the course
+            course_template_ids = template_ids[template_offset:template_offset + template_count]
+            student_ids, starts, counts = np.unique(course_template_ids, return_index=True, return_counts=True)
+            course_templates = {
+                student_id: templates[template_offset + start:template_offset + start + n]
+                for student_id, start, n in zip(student_ids.tolist(), starts.tolist(), counts.tolist())
+            }
+            self.galleries[course_id] = CourseGallery(course_matrix, ids[rows], templates=course_templates)
+
+    def matches(self, dtype, projection_version):
+        """Whether the file was built by the current extractor with this dtype and projection"""
+        return (self.extractor_version, self.dtype, self.projection_version) == (EXTRACTOR_VERSION, dtype, projection_version)
+
+    def same_file(self, stat):
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size) == (self.stat.st_ino, self.stat.st_mtime_ns, self.stat.st_size)
+
+class GalleryStore:
+    """
+    Shared, memory-mapped source of course galleries
+
+    get() re-maps the file whenever it has been replaced, so every worker
+    picks up a rebuild on its next request. Requests still holding views of
+    the previous mapping keep working: a replaced file stays readable until
+    the last view of it is gone.
+
+    A missing file, or one built with another extractor version, gallery
+    dtype or projection, is treated alike: get() returns None and asks
+    builder() -> {course_id: CourseGallery} for a rebuild.
+    """
+
+    def __init__(self, path, builder, dtype='float32', projection_version=None):
+        self.path = path
+        self.builder = builder
+        self.dtype = dtype
+        self.projection_version = projection_version
+        self._file = None
+        self._lock = threading.Lock()
+        self._rebuild_pending = False
+        self._rebuilding = False
+
+    def get(self, course_id):
+        """Return the mapped CourseGallery for a course, or None if the file is missing or stale or lacks the course"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.request_rebuild()
+            return None
+        with self._lock:
+            if self._file is None or not self._file.same_file(stat):
+                try:
+                    self._file = GalleryFile(self.path)
+                except Exception as e:
+                    logger.error(f"Error mapping gallery file {self.path}: {str(e)}")
+                    self._file = None
+                else:
+                    logger.info(f"Mapped gallery file {self.path} (generation {self._file.generation}, "
+                                f"{len(self._file.galleries)} courses)")
+                    if not self._file.matches(self.dtype, self.projection_version):
+                        logger.warning(f"Gallery file {self.path} was built for extractor version {self._file.extractor_version}, "
+                                       f"{self._file.dtype} and projection {self._file.projection_version}; rebuilding it")
+            gallery_file = self._file
+        if gallery_file is None or not gallery_file.matches(self.dtype, self.projection_version):
+            self.request_rebuild()
+            return None
+        return gallery_file.galleries.get(int(course_id))
+
+    def request_rebuild(self):
+        """
+        Rebuild the file in the background from builder()
+
+        Requests arriving while a rebuild runs are coalesced into one more
+        rebuild afterwards, so the file always ends up reflecting the last
+        change.
+        """
+        with self._lock:
+            self._rebuild_pending = True
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_loop, name="gallery-file-rebuild", daemon=True).start()
+
+    def _rebuild_loop(self):
+        while True:
+            with self._lock:
+                if not self._rebuild_pending:
+                    self._rebuilding = False
+                    return
+                self._rebuild_pending = False
+            try:
+                self.rebuild()
+            except Exception as e:
+                logger.error(f"Error rebuilding gallery file {self.path}: {str(e)}")
+
+    def rebuild(self):
+        """Build and write the file now, holding an exclusive lock against other processes"""
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Read the database only once the lock is held, so the last writer saw the last commit
+                galleries = self.builder()
+                write_gallery_file(self.path, galleries, generation=read_gallery_generation(self.path) + 1,
+                                   dtype=self.dtype, projection_version=self.projection_version)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        logger.info(f"Rebuilt gallery file {self.path} ({len(galleries)} courses)")
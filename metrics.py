@@ -0,0 +1,195 @@
+"""
+In-process metrics exported in the Prometheus text format
+Counters and latency histograms cheap enough for the recognition hot path
+(an update is a dict lookup and a few additions under a lock), plus
+gauges read from the app's caches and queues only when /metrics is scraped
+"""
+
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Seconds; spans a cached-gallery lookup up to a saturated recognition pool
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(labelnames, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    """A count that only goes up, e.g. faces detected"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in values]
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets, e.g. stage latencies in seconds"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [per-bucket counts (last is +Inf), sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return sum(series[0]) if series else 0
+
+    def render(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        lines = self.header()
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class CallbackMetric(_Metric):
+    """
+    A gauge or counter whose value is read from the app when rendered
+
+    function() returns a number, or {label values tuple: number} for a
+    labelled metric. Nothing is recorded on the hot path.
+    """
+
+    def __init__(self, name, documentation, function, kind='gauge', labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.function = function
+
+    def render(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in sorted(values.items())]
+
+class Registry:
+    """Named metrics rendered together; registering an existing name returns the existing metric"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, function, kind='gauge', labelnames=()):
+        with self._lock:
+            # Replaced rather than kept, so the callback always reads the current objects
+            metric = self._metrics[name] = CallbackMetric(name, documentation, function, kind, labelnames)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:
+                # One broken callback must not take the whole endpoint down
+                logger.error(f"Error rendering metric {metric.name}: {str(e)}")
+        return '\n'.join(lines) + '\n'
+
+# Shared registry rendered by the /metrics route
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'face_stage_duration_seconds', 'Time spent in each recognition stage', ('stage',))
+faces_detected = registry.counter(
+    'face_detections_total', 'Faces detected in uploaded frames', ('endpoint',))
+match_decisions = registry.counter(
+    'face_match_decisions_total', 'Detected faces that did or did not match a student', ('result',))
+rejections = registry.counter(
+    'face_rejections_total', 'Frames and faces rejected before matching, by reason', ('endpoint', 'reason'))
+
+def record_timings(timings):
+    """Observe a {stage: seconds} dict, as collected by face_utils"""
+    for stage, seconds in (timings or {}).items():
+        stage_seconds.observe(seconds, stage=stage)
+
+@contextmanager
+def timed(stage):
+    """Observe the time spent in the block as one sample of stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
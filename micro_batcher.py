@@ -0,0 +1,183 @@
+"""
+Cross-request micro-batching for face recognition
+Frames that arrive within a short window are extracted together and every
+course's faces are scored against its gallery in one matrix product, then
+the results are handed back to the waiting requests
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+import face_projection
+import face_utils
+from recognition_pool import recognition_pool, probe_job
+
+logger = logging.getLogger(__name__)
+
+class _PendingFrame:
+    def __init__(self, key, image_data, gallery_matrix, gallery_ids, tolerance, templates):
+        self.key = key
+        self.image_data = image_data
+        self.gallery_matrix = gallery_matrix
+        self.gallery_ids = gallery_ids
+        self.tolerance = tolerance
+        self.templates = templates
+        self.future = Future()
+        self.probes = None
+
+class RecognitionBatcher:
+    """
+    Collects recognition requests for up to window_ms (or max_batch frames)
+    and processes them as one batch on a background thread
+
+    Feature extraction for the batch runs in the recognition pool when it
+    is enabled, otherwise on a thread pool. Frames are then grouped by
+    gallery, and each group is scored with a single GEMM before faces are
+    assigned per frame. A request waits at most window_ms longer than the
+    batch it ends up in takes to process.
+    """
+
+    def __init__(self, window_ms=0, max_batch=32, timeout=30):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._extractors = None
+        self.batches = 0
+        self.frames = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def _start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            if not recognition_pool.enabled:
+                # Decoding, detection and extraction release the GIL, so threads give real parallelism
+                self._extractors = ThreadPoolExecutor(max_workers=os.cpu_count() or 4,
+                                                      thread_name_prefix="batch-extract")
+            self._thread = threading.Thread(target=self._run, name="recognition-batcher", daemon=True)
+            self._thread.start()
+
+    def recognize(self, key, image_data, gallery_matrix, gallery_ids, tolerance=None, templates=None):
+        """
+        Recognize the faces in one frame as part of the next batch
+
+        key identifies the gallery (the course id); gallery_matrix must be
+        L2-normalized and may be a QuantizedMatrix; near-threshold matches
+        are re-ranked against templates (see CourseGallery.templates). Blocks
+        until the batch is processed and returns the frame's RecognitionResult. Raises PoolSaturated if the recognition
+        pool rejected the frame. tolerance defaults to the active
+        projection's match threshold.
+        """
+        if tolerance is None:
+            tolerance = face_projection.match_threshold()
+        self._start()
+        frame = _PendingFrame(key, image_data, gallery_matrix, gallery_ids, tolerance, templates)
+        with self._condition:
+            self._pending.append(frame)
+            self._condition.notify()
+        return frame.future.result(timeout=self.timeout)
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            # The first frame opens the window; close it early once the batch is full
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.error(f"Error processing recognition batch: {str(e)}")
+                for frame in batch:
+                    if not frame.future.done():
+                        frame.future.set_exception(e)
+
+    def _extract(self, batch):
+        if recognition_pool.enabled:
+            futures = []
+            for frame in batch:
+                try:
+                    futures.append(recognition_pool.submit(probe_job, frame.image_data))
+                except Exception as e:
+                    futures.append(None)
+                    frame.future.set_exception(e)
+        else:
+            futures = [self._extractors.submit(probe_job, frame.image_data) for frame in batch]
+
+        for frame, future in zip(batch, futures):
+            if future is None:
+                continue
+            try:
+                frame.probes = future.result(timeout=self.timeout)
+            except Exception as e:
+                frame.future.set_exception(e)
+
+    def _process(self, batch):
+        self._extract(batch)
+        self.batches += 1
+        self.frames += len(batch)
+
+        # Group frames that share a gallery; the cache hands out one matrix per course
+        groups = {}
+        for frame in batch:
+            if frame.future.done():
+                continue
+            if frame.probes.reason is not None or frame.probes.features is None:
+                frame.future.set_result(face_utils.build_recognition_result(frame.probes, None))
+                continue
+            groups.setdefault((frame.key, id(frame.gallery_matrix)), []).append(frame)
+
+        for frames in groups.values():
+            gallery_matrix = frames[0].gallery_matrix
+            gallery_ids = frames[0].gallery_ids
+
+            # Every face of every frame in the group against the gallery in one product
+            group_start = time.perf_counter()
+            scores = face_utils.score_face_features(np.vstack([frame.probes.features for frame in frames]),
+                                                    gallery_matrix, gallery_normalized=True)
+            # Each frame is charged its share of the shared product
+            group_seconds = (time.perf_counter() - group_start) / len(frames)
+            start = 0
+            for frame in frames:
+                end = start + len(frame.probes.features)
+                frame_scores = scores[start:end]
+                frame.probes.timings['match'] = group_seconds
+                with face_utils.stage_timer(frame.probes.timings, 'match'):
+                    if frame.templates:
+                        face_utils.rerank_near_threshold(frame_scores, frame.probes.features, gallery_ids,
+                                                         frame.tolerance, frame.templates)
+                    # One-to-one assignment stays within a frame
+                    match = face_utils.assign_face_matches(frame_scores, gallery_ids, tolerance=frame.tolerance)
+                frame.future.set_result(face_utils.build_recognition_result(frame.probes, match))
+                start = end
+
+        logger.debug(f"Processed recognition batch of {len(batch)} frames in {len(groups)} galleries")
+
+# Shared batcher used by the Flask routes; disabled unless a window is configured
+recognition_batcher = RecognitionBatcher(
+    window_ms=float(os.environ.get("RECOGNITION_BATCH_WINDOW_MS", "0")),
+    max_batch=int(os.environ.get("RECOGNITION_BATCH_MAX_SIZE", "32")),
+    timeout=float(os.environ.get("RECOGNITION_POOL_TIMEOUT", "30")),
+)
@@ -1,5 +1,5 @@
 from app import db
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time
 from flask_login import UserMixin
 import secrets
 
@@ -55,13 +55,35 @@ class Student(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     student_id = db.Column(db.String(20), unique=True, nullable=False)
-    face_encoding = db.Column(db.Text, nullable=True)  # JSON serialized face encoding
+    face_encoding = db.Column(db.Text, nullable=True)  # Legacy JSON serialized face encoding, migrated to face_encoding_bin
+    face_encoding_bin = db.Column(db.LargeBinary, nullable=True)  # Binary face encoding (see face_utils.encode_face_encoding)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Update the relationship to use many-to-many
     courses = db.relationship('Course', secondary=student_course_association, 
                             backref=db.backref('students', lazy='dynamic'))
     attendances = db.relationship('Attendance', backref='student', lazy=True, cascade="all, delete-orphan")
+    face_templates = db.relationship('FaceTemplate', backref='student', lazy=True, cascade="all, delete-orphan",
+                                     order_by='FaceTemplate.id')
+    
+    @property
+    def has_face_encoding(self):
+        # Rows not yet converted by the encoding migration still count as registered
+        return self.face_encoding_bin is not None or self.face_encoding is not None
+    
+    @property
+    def stored_face_encoding(self):
+        # The binary encoding wins over a leftover legacy JSON value
+        return self.face_encoding_bin if self.face_encoding_bin is not None else self.face_encoding
+
+class FaceTemplate(db.Model):
+    """One enrollment shot of a student; face_encoding_bin holds the prototype aggregated from them"""
+    __tablename__ = 'face_templates'
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete='CASCADE'), nullable=False, index=True)
+    encoding = db.Column(db.LargeBinary, nullable=False)  # Binary face encoding (see face_utils.encode_face_encoding)
+    outlier = db.Column(db.Boolean, nullable=False, default=False)  # Left out of the prototype as unlike the other shots
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Course(db.Model):
     __tablename__ = 'courses'
@@ -73,15 +95,40 @@ class Course(db.Model):
     # Relationships
     attendances = db.relationship('Attendance', backref='course', lazy=True, cascade="all, delete-orphan")
 
+def _attendance_date_default(context):
+    # Calendar day of the row's timestamp, falling back to the timestamp column's own default
+    timestamp = context.get_current_parameters().get('timestamp')
+    return (timestamp or datetime.utcnow()).date()
+
 class Attendance(db.Model):
     __tablename__ = 'attendances'
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete='CASCADE'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id', ondelete='CASCADE'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    attendance_date = db.Column(db.Date, nullable=False, default=_attendance_date_default)  # Day of timestamp, for per-day uniqueness
     
     # Add index for faster reporting queries
     __table_args__ = (
         db.Index('idx_attendance_date', timestamp),
         db.Index('idx_student_course', student_id, course_id),
-    )
\ No newline at end of file
+        # Day-scoped per-course lookups (today's roll for a course, duplicate checks)
+        db.Index('idx_attendance_course_date_student', course_id, attendance_date, student_id),
+        # A student can be marked present at most once per course per day, even with concurrent kiosks
+        db.UniqueConstraint(student_id, course_id, attendance_date, name='uq_attendance_student_course_date'),
+    )
+    
+    @classmethod
+    def between_days(cls, first_day=None, last_day=None):
+        """
+        Filter on timestamp for the calendar days first_day..last_day, both inclusive
+        
+        Uses a half-open timestamp range instead of wrapping the column in
+        date(), so the condition can use idx_attendance_date.
+        """
+        conditions = []
+        if first_day is not None:
+            conditions.append(cls.timestamp >= datetime.combine(first_day, time.min))
+        if last_day is not None:
+            conditions.append(cls.timestamp < datetime.combine(last_day + timedelta(days=1), time.min))
+        return db.and_(db.true(), *conditions)
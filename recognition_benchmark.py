@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark of the recognition pipeline on synthetic data
+Draws face-like frames and random galleries of any size, and reports
+per-stage latency percentiles, end-to-end throughput at several
+concurrency levels and peak RSS as one JSON document, so runs on the same
+machine can be compared for regressions
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from face_utils import (MATCH_THRESHOLD, assess_face_quality, detect_face, extract_face_features, match_face_features,
+                        normalize_rows, process_image_data, quantize_rows, recognize_faces)
+
+logger = logging.getLogger(__name__)
+
+def synthetic_face_image(rng, width=640, height=480):
+    """
+    A camera-like frame with one drawn face the cascade detects
+
+    Returns the BGR image and the drawn face's (x, y, w, h) box. Face size,
+    position, skin tone and lighting vary with rng.
+    """
+    y, x = np.mgrid[0:height, 0:width]
+    background = (60 + 80 * x / width + 40 * y / height).astype(np.float32)
+    image = np.dstack([background * rng.uniform(0.7, 1.1) for _ in range(3)])
+
+    face_w = int(rng.uniform(0.22, 0.3) * width)
+    face_h = int(face_w * 1.3)
+    cx = int(rng.uniform(0.35, 0.65) * width)
+    cy = int(rng.uniform(0.45, 0.55) * height)
+    skin = tuple(float(v) for v in rng.uniform([90, 120, 170], [130, 160, 220]))
+    cv2.ellipse(image, (cx, cy), (face_w // 2, face_h // 2), 0, 0, 360, skin, -1)
+
+    eye_y = cy - face_h // 8
+    eye_x = face_w // 5
+    for side in (-1, 1):
+        cv2.ellipse(image, (cx + side * eye_x, eye_y - face_h // 10), (face_w // 8, face_h // 40), 0, 180, 360, (40, 40, 50), 3)
+        cv2.ellipse(image, (cx + side * eye_x, eye_y), (face_w // 10, face_h // 22), 0, 0, 360, (240, 240, 240), -1)
+        cv2.circle(image, (cx + side * eye_x, eye_y), face_h // 30, (40, 30, 30), -1)
+    cv2.line(image, (cx, eye_y + face_h // 20), (cx - face_w // 20, cy + face_h // 10), (70, 90, 140), 2)
+    cv2.ellipse(image, (cx, cy + face_h // 4), (face_w // 6, face_h // 20), 0, 0, 180, (60, 60, 150), -1)
+
+    image = cv2.GaussianBlur(image, (0, 0), 1.5) + rng.normal(0, 6, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8), (cx - face_w // 2, cy - face_h // 2, face_w, face_h)
+
+def synthetic_frames(rng, count, width=640, height=480, quality=85):
+    """Frames as (image, face box, base64 JPEG upload), the box taken from the detector when it finds one"""
+    frames = []
+    for _ in range(count):
+        image, box = synthetic_face_image(rng, width, height)
+        faces = detect_face(image)
+        if len(faces) > 0:
+            box = tuple(int(v) for v in faces[0])
+        jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+        frames.append((image, box, base64.b64encode(jpeg).decode('ascii')))
+    return frames
+
+def synthetic_gallery(rng, n_students, dim, chunk_size=10000):
+    """(n_students, dim) unit-length random encodings, generated in chunks to bound temporary memory"""
+    gallery = np.empty((n_students, dim), dtype=np.float32)
+    for start in range(0, n_students, chunk_size):
+        end = min(start + chunk_size, n_students)
+        gallery[start:end] = normalize_rows(rng.standard_normal((end - start, dim), dtype=np.float32))
+    return gallery
+
+def synthetic_probes(rng, gallery, count, noise=0.5):
+    """Noisy copies of random gallery rows, so every probe has a genuine match"""
+    rows = rng.integers(0, len(gallery), count)
+    noisy = gallery[rows] + noise * rng.standard_normal((count, gallery.shape[1]), dtype=np.float32) / np.sqrt(gallery.shape[1])
+    return normalize_rows(noisy), rows
+
+def latency_stats(latencies):
+    """Percentiles of a list of per-call latencies, in milliseconds"""
+    latencies = np.asarray(latencies, dtype=np.float64)
+    return {
+        'n': int(len(latencies)),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+def timed_calls(function, inputs, repeats=1, warmup=1):
+    """Latency in milliseconds of function(*args) for every args tuple in inputs, repeated"""
+    for args in inputs[:warmup]:
+        function(*args)
+    latencies = []
+    for _ in range(repeats):
+        for args in inputs:
+            start = time.perf_counter()
+            function(*args)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def benchmark_stages(frames, repeats=1):
+    """Latency of each per-frame stage, on the same frames"""
+    return {
+        'process_image_data': latency_stats(timed_calls(process_image_data, [(data,) for _, _, data in frames], repeats)),
+        'detect_face': latency_stats(timed_calls(detect_face, [(image,) for image, _, _ in frames], repeats)),
+        'assess_face_quality': latency_stats(timed_calls(assess_face_quality, [(image, box) for image, box, _ in frames], repeats)),
+        'extract_face_features': latency_stats(timed_calls(extract_face_features, [(image, box) for image, box, _ in frames], repeats)),
+    }
+
+def benchmark_matching(rng, n_students, dim, dtype='float32', probes=50, faces_per_frame=1, tolerance=MATCH_THRESHOLD):
+    """Latency of matching one frame's faces against a gallery of n_students, and rank-1 accuracy"""
+    start = time.perf_counter()
+    gallery = synthetic_gallery(rng, n_students, dim)
+    probe_features, expected = synthetic_probes(rng, gallery, probes * faces_per_frame)
+    matrix = quantize_rows(gallery, dtype)
+    build_s = time.perf_counter() - start
+    if dtype != 'float32':
+        # Only the stored rows stay resident, as in a quantized gallery
+        del gallery
+    ids = np.arange(n_students)
+
+    frames = [(probe_features[i:i + faces_per_frame],) for i in range(0, len(probe_features), faces_per_frame)]
+    match = lambda features: match_face_features(features, matrix, ids, tolerance=tolerance, gallery_normalized=True)
+    latencies = timed_calls(match, frames)
+
+    top_ids = np.concatenate([match(*frame).top_ids[:, 0] for frame in frames])
+    return {
+        'students': n_students,
+        'dim': dim,
+        'dtype': dtype,
+        'faces_per_frame': faces_per_frame,
+        'gallery_mb': matrix.nbytes / (1024 * 1024),
+        'build_s': build_s,
+        'rank1_accuracy': float(np.mean(top_ids == expected)),
+        'latency': latency_stats(latencies),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def benchmark_throughput(frames, gallery, ids, concurrency, n_frames, tolerance=MATCH_THRESHOLD):
+    """
+    End-to-end recognize_faces throughput with concurrency threads
+
+    OpenCV and the BLAS matrix products release the GIL, so threads show
+    how the pipeline itself scales; the recognition pool adds process
+    overhead on top.
+    """
+    uploads = [frames[i % len(frames)][2] for i in range(n_frames)]
+
+    def recognize(image_data):
+        start = time.perf_counter()
+        recognize_faces(image_data, gallery, ids, tolerance=tolerance, known_normalized=True)
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(recognize, uploads[:concurrency]))
+        start = time.perf_counter()
+        latencies = list(executor.map(recognize, uploads))
+        wall_s = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'frames': n_frames,
+        'frames_per_s': n_frames / wall_s,
+        'latency': latency_stats(latencies),
+    }
+
+def environment_info():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'opencv_threads': cv2.getNumThreads(),
+    }
+
+def run_benchmark(args):
+    rng = np.random.default_rng(args.seed)
+    frames = synthetic_frames(rng, args.frames, args.width, args.height)
+    detected = sum(len(detect_face(image)) > 0 for image, _, _ in frames)
+    dim = args.dim or len(extract_face_features(frames[0][0], frames[0][1]))
+
+    report = {
+        'config': vars(args),
+        'environment': environment_info(),
+        'frames_with_detected_face': detected,
+        'stages': benchmark_stages(frames, repeats=args.repeats),
+        'matching': [],
+        'throughput': [],
+    }
+    for n_students in args.students:
+        logger.info(f"Matching against {n_students} students ({dim} dims, {args.dtype})")
+        report['matching'].append(benchmark_matching(rng, n_students, dim, args.dtype, probes=args.probes,
+                                                     faces_per_frame=args.faces_per_frame))
+
+    # End-to-end runs need raw-dimension encodings, since recognize_faces matches unprojected features
+    raw_dim = len(extract_face_features(frames[0][0], frames[0][1]))
+    gallery = synthetic_gallery(rng, args.throughput_students, raw_dim)
+    ids = list(range(args.throughput_students))
+    for concurrency in args.concurrency:
+        logger.info(f"End-to-end throughput with {concurrency} threads")
+        report['throughput'].append(benchmark_throughput(frames, gallery, ids, concurrency, args.throughput_frames))
+
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Latency, throughput and memory of the recognition pipeline on synthetic data')
+    parser.add_argument('--students', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='Gallery sizes to match against; 100000 at the raw dimension needs ~12 GB as float32')
+    parser.add_argument('--dim', type=int, default=0,
+                        help='Encoding dimension for the matching runs (0 = the extractor output, e.g. 256 for a projection)')
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'int8'], default='float32', help='Gallery storage precision')
+    parser.add_argument('--frames', type=int, default=20, help='Distinct synthetic frames')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--repeats', type=int, default=3, help='Timed passes over the frames per stage')
+    parser.add_argument('--probes', type=int, default=50, help='Matched frames per gallery size')
+    parser.add_argument('--faces-per-frame', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8], help='Thread counts for end-to-end runs')
+    parser.add_argument('--throughput-students', type=int, default=1000, help='Gallery size for end-to-end runs')
+    parser.add_argument('--throughput-frames', type=int, default=100, help='Frames per end-to-end run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    # Per-frame INFO lines from face_utils would dominate the timings
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger('face_utils').setLevel(logging.WARNING)
+
+    report = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote benchmark report to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,143 @@
+"""
+Optional process pool for face processing
+Moves decoding, detection and feature extraction off the Flask request
+thread and out of the GIL. Disabled (work runs inline) unless
+RECOGNITION_POOL_SIZE is set to a positive number of worker processes.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import face_utils
+from face_projection import project_features
+
+logger = logging.getLogger(__name__)
+
+class PoolSaturated(Exception):
+    """Raised when the pool already has as many jobs in flight as it accepts"""
+    pass
+
+def _init_worker():
+    # Runs once in each worker: importing face_utils loads the Haar cascade,
+    # and touching the extractor allocates its per-thread buffers up front
+    face_utils.face_feature_extractor._scratch()
+
+def registration_job(image_data, min_face_size=100):
+    """Registration pipeline for a worker; the decoded image is not sent back"""
+    result = face_utils.prepare_face_registration(image_data, min_face_size=min_face_size)
+    result.image = None
+    return result
+
+def probe_job(image_data):
+    """Detect faces and extract probe features for recognition, projected like the galleries"""
+    probes = face_utils.extract_probe_features(image_data)
+    if probes.features is not None:
+        with face_utils.stage_timer(probes.timings, 'project'):
+            probes.features = project_features(probes.features)
+    return probes
+
+class RecognitionPool:
+    """
+    Bounded front end to a ProcessPoolExecutor
+
+    At most max_pending jobs may be queued or running at once; submitting
+    beyond that raises PoolSaturated so the route can answer 429 instead
+    of letting requests pile up. With size 0 jobs run inline.
+    """
+
+    def __init__(self, size=0, max_pending=None, timeout=30):
+        self.size = size
+        self.max_pending = max_pending if max_pending is not None else 2 * size
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    @property
+    def pending(self):
+        """Jobs queued or running in the pool"""
+        return self._pending
+
+    def start(self):
+        """
+        Start the worker processes now
+
+        Call this at startup, before the web server or any background
+        thread is running: workers are forked where the platform allows it,
+        and forking a process that already has other threads can deadlock
+        the child. Forking also avoids re-importing the app in each worker,
+        which spawned workers would do through the main module.
+        """
+        if not self.enabled or self._executor is not None:
+            return
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        self._executor = ProcessPoolExecutor(max_workers=self.size, mp_context=context, initializer=_init_worker)
+        # The first job makes the executor start its workers
+        self._executor.submit(_init_worker).result()
+        logger.info(f"Started recognition pool with {self.size} workers (max {self.max_pending} pending jobs)")
+
+    def _get_executor(self):
+        if self._executor is None:
+            self.start()
+        return self._executor
+
+    def _job_done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def note_rejection(self):
+        """Count a job refused because the pool was full"""
+        with self._lock:
+            self.rejected += 1
+
+    def submit(self, fn, *args, count_rejection=True):
+        """
+        Queue a job in the pool and return its Future; raises PoolSaturated when full
+
+        Pass count_rejection=False when the caller may still get the job in
+        after a refusal, and call note_rejection() once it gives up.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                if count_rejection:
+                    self.rejected += 1
+                raise PoolSaturated(f"Recognition pool is busy ({self._pending} jobs pending)")
+            self._pending += 1
+            try:
+                future = self._get_executor().submit(fn, *args)
+            except Exception:
+                self._pending -= 1
+                raise
+        future.add_done_callback(self._job_done)
+        return future
+
+    def run(self, fn, *args):
+        """Run a job and wait for its result, in the pool when enabled and inline otherwise"""
+        if not self.enabled:
+            return fn(*args)
+        return self.submit(fn, *args).result(timeout=self.timeout)
+
+    def shutdown(self):
+        """Stop the worker processes, cancelling queued jobs"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# Shared pool used by the Flask routes
+recognition_pool = RecognitionPool(
+    size=int(os.environ.get("RECOGNITION_POOL_SIZE", "0")),
+    max_pending=int(os.environ["RECOGNITION_POOL_MAX_PENDING"]) if os.environ.get("RECOGNITION_POOL_MAX_PENDING") else None,
+    timeout=float(os.environ.get("RECOGNITION_POOL_TIMEOUT", "30")),
+)
@@ -110,8 +110,14 @@ class Webcam {
         this._streamList = [];
     }
 
-    /* Take a screenshot */
-    snap() {
+    /* Take a screenshot
+     *
+     * Resolves to a JPEG Blob, or null if the video is not playing yet.
+     * Frames wider than maxWidth are scaled down before encoding; pass the
+     * server's capture config ({maxWidth, quality}) to upload at the size
+     * it works at.
+     */
+    snap({ maxWidth = 0, quality = 0.92 } = {}) {
         if (this._canvasElement === null) {
             this._canvasElement = document.createElement('canvas');
         }
@@ -119,20 +125,22 @@ class Webcam {
         const videoWidth = this._webcamElement.videoWidth;
         const videoHeight = this._webcamElement.videoHeight;
 
-        if (videoWidth && videoHeight) {
-            // Set canvas size to match video
-            this._canvasElement.width = videoWidth;
-            this._canvasElement.height = videoHeight;
+        if (!videoWidth || !videoHeight) {
+            return Promise.resolve(null);
+        }
 
-            // Draw the video frame to canvas
-            const context = this._canvasElement.getContext('2d');
-            context.drawImage(this._webcamElement, 0, 0, videoWidth, videoHeight);
+        // Set canvas size to the video, scaled down to maxWidth if needed
+        const scale = maxWidth > 0 && videoWidth > maxWidth ? maxWidth / videoWidth : 1;
+        this._canvasElement.width = Math.round(videoWidth * scale);
+        this._canvasElement.height = Math.round(videoHeight * scale);
 
-            // Get base64 encoded image data
-            const dataUrl = this._canvasElement.toDataURL('image/jpeg');
-            return dataUrl;
-        }
-        
-        return null;
+        // Draw the video frame to canvas
+        const context = this._canvasElement.getContext('2d');
+        context.drawImage(this._webcamElement, 0, 0, this._canvasElement.width, this._canvasElement.height);
+
+        // Encode as binary JPEG; uploaded as-is, without base64
+        return new Promise(resolve => {
+            this._canvasElement.toBlob(resolve, 'image/jpeg', quality);
+        });
     }
 }
@@ -0,0 +1,126 @@
+"""
+Campus index refresh against the database generation and its saved copy
+"""
+
+import numpy as np
+import pytest
+
+from ann_index import BruteForceIndex, CampusIndex, IVFIndex, read_index_generation
+
+class FakeStudents:
+    """Registered students as the app's loaders see them; time advances with every registration"""
+
+    def __init__(self, n, dim=16):
+        self.rng = np.random.default_rng(0)
+        self.dim = dim
+        self.vectors = {}
+        self.registered_at = {}
+        self.clock = 0
+        self.loads = 0
+        for student_id in range(1, n + 1):
+            self.register(student_id)
+
+    def register(self, student_id):
+        self.clock += 1
+        self.vectors[student_id] = self.rng.standard_normal(self.dim).astype(np.float32)
+        self.registered_at[student_id] = self.clock
+
+    def delete(self, student_id):
+        del self.vectors[student_id]
+        del self.registered_at[student_id]
+
+    def loader(self):
+        self.loads += 1
+        ids = sorted(self.vectors)
+        return ids, [np.vstack([self.vectors[i] for i in ids])]
+
+    def generation(self):
+        return ['raw', len(self.vectors), max(self.registered_at.values(), default=None)]
+
+    def updates(self, since):
+        ids = [i for i, at in sorted(self.registered_at.items()) if since is None or at >= since]
+        return ids, [self.vectors[i] for i in ids]
+
+    def search(self, index, student_id):
+        return index.search(self.vectors[student_id][None, :], k=1)[0][0, 0]
+
+def get(campus, students):
+    return campus.get(students.loader, students.generation, updates=students.updates)
+
+@pytest.mark.parametrize('kind', ['brute', 'ivf'])
+def test_other_workers_registrations_are_picked_up(kind):
+    students = FakeStudents(20)
+    campus = CampusIndex(kind=kind, min_ivf_size=10, check_interval=0, n_lists=4, n_probe=4)
+    index = get(campus, students)
+    assert len(index) == 20 and students.loads == 1
+
+    # Registered and re-registered through another worker
+    students.register(21)
+    students.register(3)
+    index = get(campus, students)
+    assert len(index) == 21 and students.loads == 1
+    assert students.search(index, 21) == 21
+    assert students.search(index, 3) == 3
+
+def test_deletions_rebuild_the_index():
+    students = FakeStudents(5)
+    campus = CampusIndex(kind='brute', check_interval=0)
+    get(campus, students)
+    students.delete(2)
+    index = get(campus, students)
+    assert len(index) == 4 and students.loads == 2
+
+def test_checks_wait_for_the_interval():
+    students = FakeStudents(5)
+    campus = CampusIndex(kind='brute', check_interval=3600)
+    get(campus, students)
+    students.register(6)
+    assert len(get(campus, students)) == 5
+
+@pytest.mark.parametrize('kind', ['brute', 'ivf'])
+def test_saved_index_is_used_only_at_the_current_generation(tmp_path, kind):
+    path = str(tmp_path / 'face_index')
+    students = FakeStudents(20)
+    options = {'kind': kind, 'path': path, 'min_ivf_size': 10, 'check_interval': 0, 'n_lists': 4, 'n_probe': 4}
+    get(CampusIndex(**options), students)
+    assert read_index_generation(path) == students.generation()
+
+    # Another worker starting now loads the saved copy
+    assert len(get(CampusIndex(**options), students)) == 20
+    assert students.loads == 1
+
+    # Same number of students, different content: the saved copy is rebuilt, not trusted
+    students.delete(20)
+    students.register(30)
+    index = get(CampusIndex(**options), students)
+    assert students.loads == 2
+    assert students.search(index, 30) == 30
+    assert read_index_generation(path) == students.generation()
+
+def test_a_stale_worker_does_not_overwrite_a_newer_save(tmp_path):
+    path = str(tmp_path / 'face_index')
+    students = FakeStudents(5)
+    campus = CampusIndex(kind='brute', path=path, check_interval=0)
+    get(campus, students)
+    saved = read_index_generation(path)
+
+    # The database moves on before this worker's save takes the lock
+    stale = students.generation()
+    students.register(6)
+    campus._generation = stale
+    campus._save(campus._index, students.generation)
+    assert read_index_generation(path) == saved
+
+def test_loaded_ivf_index_does_not_write_bucket_files(tmp_path):
+    path = str(tmp_path / 'face_index')
+    students = FakeStudents(20)
+    options = {'kind': 'ivf', 'path': path, 'min_ivf_size': 10, 'check_interval': 0, 'n_lists': 4, 'n_probe': 4}
+    index = get(CampusIndex(**options), students)
+    assert isinstance(index, IVFIndex) and index.path is None
+    index = get(CampusIndex(**options), students)
+    assert index.path is None
+
+def test_brute_index_ignores_ivf_options():
+    students = FakeStudents(5)
+    campus = CampusIndex(kind='brute', check_interval=0, n_lists=4, n_probe=2)
+    assert isinstance(get(campus, students), BruteForceIndex)
@@ -0,0 +1,57 @@
+"""
+Marking of recognized students in a roll-call session
+"""
+
+import numpy as np
+import pytest
+
+import attendance_sessions
+from attendance_sessions import AttendanceSession
+from face_tracking import FaceTrack
+
+class FakeTracker:
+    """The same single face in every frame"""
+
+    def __init__(self):
+        self.tracks = [FaceTrack(id=1, box=(0, 0, 10, 10))]
+        self.frames = 0
+        self.detections = 0
+
+    def update(self, image):
+        self.frames += 1
+        return self.tracks
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(attendance_sessions, 'load_image', lambda image_data: np.zeros((10, 10, 3), np.uint8))
+    monkeypatch.setattr(attendance_sessions, 'assess_face_quality', lambda image, box: type('Quality', (), {'ok': True}))
+    monkeypatch.setattr(attendance_sessions, 'extract_face_features', lambda image, box: np.ones(8, np.float32))
+    monkeypatch.setattr(attendance_sessions, 'project_features', lambda features: features)
+    session = AttendanceSession(1, embeddings_per_track=1)
+    session.tracker = FakeTracker()
+    return session
+
+def match(embedding):
+    return 7, 0.9
+
+def test_student_is_marked_once(session):
+    calls = []
+    mark = lambda student_ids: calls.append(student_ids) or ['Ada']
+    assert session.process_frame(b'frame', match, mark)['marked'] == ['Ada']
+    assert session.process_frame(b'frame', match, mark)['marked'] == []
+    assert calls == [[7]]
+    assert session.summary()['recognized'] == 1
+
+def test_failed_mark_keeps_the_student_eligible(session):
+    def failing_mark(student_ids):
+        raise RuntimeError('database is locked')
+
+    with pytest.raises(RuntimeError):
+        session.process_frame(b'frame', match, failing_mark)
+    assert session.summary()['recognized'] == 0
+    assert session.tracker.tracks[0].needs_embedding
+
+    # The next frame matches the track again and marks the student
+    assert session.process_frame(b'frame', match, lambda student_ids: ['Ada'])['marked'] == ['Ada']
+    assert session.summary()['recognized'] == 1
+    assert session.summary()['marked'] == ['Ada']
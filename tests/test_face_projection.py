@@ -0,0 +1,75 @@
+"""
+Match threshold calibration of the PCA projection
+"""
+
+import numpy as np
+import pytest
+
+import face_projection
+from face_projection import FaceProjection, calibrate_threshold, fit_projection
+from face_utils import MATCH_THRESHOLD
+
+def synthetic_faces(n_people=40, shots=3, dim=300, seed=0):
+    """Samples that share a large common component, like raw LBP + HOG encodings"""
+    rng = np.random.default_rng(seed)
+    common = rng.standard_normal(dim) * 4
+    people = rng.standard_normal((n_people, dim))
+    samples = np.repeat(people, shots, axis=0) + 0.4 * rng.standard_normal((n_people * shots, dim)) + common
+    return samples.astype(np.float32), np.repeat(np.arange(n_people), shots)
+
+def test_threshold_bounds_false_accepts():
+    features, labels = synthetic_faces()
+    gallery, gallery_labels = features[::3], labels[::3]
+    probe_mask = np.arange(len(labels)) % 3 != 0
+    projection = fit_projection(gallery, dims=16)
+
+    calibration = calibrate_threshold(projection.project(gallery), gallery_labels,
+                                      projection.project(features[probe_mask]), labels[probe_mask], target_far=0.05)
+    assert calibration['false_accept_rate'] <= 0.05
+    assert calibration['genuine_accept_rate'] > 0.9
+    assert calibration['probes'] == probe_mask.sum()
+
+def test_raw_threshold_does_not_carry_over_to_the_projection():
+    features, labels = synthetic_faces()
+    gallery, gallery_labels = features[::3], labels[::3]
+    raw = calibrate_threshold(gallery, gallery_labels, features, labels)
+    projection = fit_projection(gallery, dims=16)
+    projected = calibrate_threshold(projection.project(gallery), gallery_labels, projection.project(features), labels)
+    # Raw scores of different people sit far above the projected ones
+    assert raw['threshold'] > MATCH_THRESHOLD > projected['threshold']
+
+def test_probes_identical_to_the_gallery_have_no_genuine_rate():
+    features, labels = synthetic_faces(shots=1)
+    calibration = calibrate_threshold(features, labels, features, labels)
+    assert calibration['genuine_accept_rate'] is None
+
+def test_saved_threshold_round_trips(tmp_path):
+    features, _ = synthetic_faces()
+    projection = fit_projection(features, dims=8)
+    projection.threshold = 0.42
+    path = str(tmp_path / 'projection.npz')
+    projection.save(path)
+    loaded = FaceProjection.load(path)
+    assert loaded.threshold == pytest.approx(0.42)
+    assert loaded.version == projection.version
+
+def test_projection_without_threshold_is_refused(tmp_path):
+    features, _ = synthetic_faces()
+    projection = fit_projection(features, dims=8)
+    with pytest.raises(ValueError):
+        projection.save(str(tmp_path / 'projection.npz'))
+
+    path = str(tmp_path / 'old.npz')
+    np.savez(path, mean=projection.mean, components=projection.components, extractor_version=np.int64(1))
+    with pytest.raises(ValueError):
+        FaceProjection.load(path)
+    assert face_projection.load_configured_projection(path) is None
+
+def test_match_threshold_follows_the_active_projection(monkeypatch):
+    monkeypatch.setattr(face_projection, 'active_projection', None)
+    assert face_projection.match_threshold() == MATCH_THRESHOLD
+    features, _ = synthetic_faces()
+    projection = fit_projection(features, dims=8)
+    projection.threshold = 0.3
+    monkeypatch.setattr(face_projection, 'active_projection', projection)
+    assert face_projection.match_threshold() == 0.3
@@ -0,0 +1,109 @@
+"""
+Round trip of the shared gallery file and its configuration check
+"""
+
+import numpy as np
+import pytest
+
+import gallery_store
+from face_utils import EXTRACTOR_VERSION, QuantizedMatrix
+from gallery_cache import build_gallery
+from gallery_store import GalleryFile, GalleryStore, read_gallery_generation, write_gallery_file
+
+def random_galleries(dtype, dim=64):
+    rng = np.random.default_rng(0)
+    templates = {10: list(rng.standard_normal((3, dim))), 11: list(rng.standard_normal((1, dim)))}
+    return {
+        1: build_gallery(list(rng.standard_normal((5, dim))), [10, 11, 12, 13, 14], dtype=dtype, templates=templates),
+        2: build_gallery([], []),
+        3: build_gallery(list(rng.standard_normal((2, dim))), [11, 20], dtype=dtype, templates=templates),
+    }
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16', 'int8'])
+def test_round_trip(tmp_path, dtype):
+    path = str(tmp_path / 'galleries.bin')
+    galleries = random_galleries(dtype)
+    write_gallery_file(path, galleries, generation=7, dtype=dtype, projection_version='pca32-e1-abcdef12')
+
+    mapped = GalleryFile(path)
+    assert mapped.generation == read_gallery_generation(path) == 7
+    assert (mapped.dtype, mapped.extractor_version, mapped.projection_version) == (dtype, EXTRACTOR_VERSION, 'pca32-e1-abcdef12')
+    assert sorted(mapped.galleries) == [1, 2, 3]
+    assert len(mapped.galleries[2]) == 0
+    for course_id in (1, 3):
+        expected = galleries[course_id]
+        actual = mapped.galleries[course_id]
+        assert np.array_equal(actual.ids, expected.ids)
+        assert sorted(actual.templates) == sorted(expected.templates)
+        for student_id, rows in expected.templates.items():
+            assert np.array_equal(actual.templates[student_id], rows)
+        if dtype == 'float32':
+            assert np.array_equal(actual.matrix, expected.matrix)
+        else:
+            assert isinstance(actual.matrix, QuantizedMatrix)
+            assert np.array_equal(actual.matrix.data, expected.matrix.data)
+            if dtype == 'int8':
+                assert np.array_equal(actual.matrix.scales, expected.matrix.scales)
+            else:
+                assert actual.matrix.scales is None
+
+def test_templates_kept_for_re_ranking():
+    float32 = random_galleries('float32')
+    # A single template is the float32 prototype itself, so only student 10 keeps any
+    assert sorted(float32[1].templates) == [10]
+    assert float32[1].templates[10].shape == (4, 64)
+    assert sorted(float32[3].templates) == []
+    # Quantized galleries keep the full-precision prototype of every student
+    int8 = random_galleries('int8')
+    assert sorted(int8[1].templates) == [10, 11, 12, 13, 14]
+    assert [len(int8[1].templates[student_id]) for student_id in (10, 11, 12)] == [4, 2, 1]
+
+def test_only_empty_courses(tmp_path):
+    path = str(tmp_path / 'galleries.bin')
+    write_gallery_file(path, {5: build_gallery([], []), 6: build_gallery([], [])}, dtype='int8')
+    mapped = GalleryFile(path)
+    assert mapped.dtype == 'int8' and mapped.projection_version is None
+    assert [len(gallery) for gallery in mapped.galleries.values()] == [0, 0]
+
+def test_courses_of_another_dtype_are_skipped(tmp_path):
+    path = str(tmp_path / 'galleries.bin')
+    galleries = random_galleries('float32')
+    galleries[4] = build_gallery([np.ones(64)], [30], dtype='int8')
+    write_gallery_file(path, galleries, dtype='float32')
+    assert 4 not in GalleryFile(path).galleries
+
+@pytest.mark.parametrize('written', [
+    {'dtype': 'int8', 'projection_version': None},
+    {'dtype': 'float32', 'projection_version': 'pca32-e1-abcdef12'},
+])
+def test_store_rebuilds_a_file_built_under_another_configuration(tmp_path, written):
+    path = str(tmp_path / 'galleries.bin')
+    write_gallery_file(path, random_galleries(written['dtype']), **written)
+
+    store = GalleryStore(path, builder=lambda: random_galleries('float32'), dtype='float32')
+    requests = []
+    store.request_rebuild = lambda: requests.append(True)
+    assert store.get(1) is None
+    assert requests
+
+    store.rebuild()
+    rebuilt = store.get(1)
+    assert rebuilt is not None and len(rebuilt) == 5
+    assert read_gallery_generation(path) == 1
+
+def test_store_rebuilds_after_an_extractor_change(tmp_path, monkeypatch):
+    path = str(tmp_path / 'galleries.bin')
+    store = GalleryStore(path, builder=lambda: random_galleries('float32'))
+    store.rebuild()
+    assert store.get(1) is not None
+
+    monkeypatch.setattr(gallery_store, 'EXTRACTOR_VERSION', EXTRACTOR_VERSION + 1)
+    store.request_rebuild = lambda: None
+    assert store.get(1) is None
+
+def test_missing_file_requests_a_rebuild(tmp_path):
+    store = GalleryStore(str(tmp_path / 'galleries.bin'), builder=dict)
+    requests = []
+    store.request_rebuild = lambda: requests.append(True)
+    assert store.get(1) is None
+    assert requests
@@ -0,0 +1,98 @@
+"""
+Parity of the vectorized LBP engine with the original per-pixel loop
+Stored face encodings were produced by the original implementation, so
+compute_lbp and extract_face_features must reproduce it exactly
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from face_utils import compute_lbp, extract_face_features, lbp_code_dtype
+
+def reference_lbp(gray_face, radius=2):
+    """The original nested-loop LBP, 8 neighbors in clockwise order; border pixels stay 0"""
+    lbp_face = np.zeros_like(gray_face)
+    rows, cols = gray_face.shape
+    for i in range(radius, rows-radius):
+        for j in range(radius, cols-radius):
+            center = gray_face[i, j]
+            binary = 0
+            if gray_face[i-radius, j-radius] >= center: binary |= 1 << 0
+            if gray_face[i-radius, j] >= center: binary |= 1 << 1
+            if gray_face[i-radius, j+radius] >= center: binary |= 1 << 2
+            if gray_face[i, j+radius] >= center: binary |= 1 << 3
+            if gray_face[i+radius, j+radius] >= center: binary |= 1 << 4
+            if gray_face[i+radius, j] >= center: binary |= 1 << 5
+            if gray_face[i+radius, j-radius] >= center: binary |= 1 << 6
+            if gray_face[i, j-radius] >= center: binary |= 1 << 7
+            lbp_face[i, j] = binary
+    return lbp_face
+
+def reference_features(image, face):
+    """The original extract_face_features: LBP histograms on an 8x8 grid followed by HOG"""
+    x, y, w, h = face
+    margin = int(0.2 * w)
+    x = max(0, x - margin)
+    y = max(0, y - margin)
+    w = min(image.shape[1] - x, w + 2*margin)
+    h = min(image.shape[0] - y, h + 2*margin)
+
+    face_img = cv2.resize(image[y:y+h, x:x+w], (200, 200))
+    gray_face = cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY)
+    gray_face = cv2.equalizeHist(gray_face)
+    gray_face = cv2.GaussianBlur(gray_face, (5, 5), 0)
+
+    lbp_face = reference_lbp(gray_face)
+    rows, cols = gray_face.shape
+    block_size_x = cols // 8
+    block_size_y = rows // 8
+    histograms = []
+    for i in range(8):
+        for j in range(8):
+            block = lbp_face[i*block_size_y:(i+1)*block_size_y, j*block_size_x:(j+1)*block_size_x]
+            hist, _ = np.histogram(block, bins=256, range=(0, 256), density=True)
+            histograms.extend(hist)
+
+    hog = cv2.HOGDescriptor((200, 200), (20, 20), (10, 10), (10, 10), 9)
+    return np.concatenate((np.array(histograms), hog.compute(gray_face).flatten()))
+
+def crops():
+    rng = np.random.default_rng(0)
+    gradient = np.add.outer(np.arange(200), np.arange(200)) % 256
+    return {
+        'random': rng.integers(0, 256, (200, 200), dtype=np.uint8),
+        'flat': np.full((200, 200), 128, dtype=np.uint8),
+        'gradient': gradient.astype(np.uint8),
+    }
+
+@pytest.mark.parametrize('name', ['random', 'flat', 'gradient'])
+def test_compute_lbp_matches_reference(name):
+    gray = crops()[name]
+    expected = reference_lbp(gray)
+    actual = compute_lbp(gray)
+    assert np.array_equal(actual, expected)
+    # Border rows and columns within the radius are never coded
+    assert not actual[:2].any() and not actual[-2:].any()
+    assert not actual[:, :2].any() and not actual[:, -2:].any()
+
+def test_compute_lbp_reuses_out_buffer():
+    gray = crops()['random']
+    out = np.full(gray.shape, 255, dtype=lbp_code_dtype(8))
+    result = compute_lbp(gray, out=out)
+    assert result is out
+    assert np.array_equal(out, reference_lbp(gray))
+
+@pytest.mark.parametrize('face', [(50, 50, 150, 150), (0, 0, 120, 120), (200, 180, 100, 120)])
+def test_extract_face_features_unchanged(face):
+    rng = np.random.default_rng(1)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (300, 300, 3), dtype=np.uint8), (3, 3), 0)
+    expected = reference_features(image, face)
+    actual = extract_face_features(image, face)
+    assert actual.shape == expected.shape == (29380,)
+    assert np.array_equal(actual, expected)
+
+def test_extract_face_features_unchanged_on_flat_image():
+    image = np.full((300, 300, 3), 90, dtype=np.uint8)
+    face = (50, 50, 150, 150)
+    assert np.array_equal(extract_face_features(image, face), reference_features(image, face))
@@ -0,0 +1,37 @@
+"""
+Re-ranking of near-threshold matches against the templates kept in the gallery
+"""
+
+import numpy as np
+
+from face_utils import match_face_features, normalize_rows, rerank_near_threshold
+
+def unit(vector):
+    return normalize_rows(vector)[0]
+
+def test_only_each_faces_best_candidate_is_re_scored():
+    scores = np.array([[0.74, 0.73], [0.50, 0.76]], dtype=np.float32)
+    probes = np.eye(2, 4, dtype=np.float32)
+    templates = {
+        1: np.array([unit([1, 0, 0, 0])]),
+        2: np.array([unit([1, 0, 0, 0]), unit([0, 1, 0, 0])]),
+    }
+    rerank_near_threshold(scores, probes, [1, 2], 0.75, templates, margin=0.05)
+    # Face 0's best is student 1; student 2 is near the threshold too but not re-scored
+    assert scores[0, 0] == 1.0 and scores[0, 1] == np.float32(0.73)
+    assert scores[1, 1] == 1.0 and scores[1, 0] == np.float32(0.50)
+
+def test_students_without_templates_keep_their_score():
+    scores = np.array([[0.76]], dtype=np.float32)
+    rerank_near_threshold(scores, np.ones((1, 4), dtype=np.float32), [1], 0.75, {2: np.eye(1, 4)}, margin=0.05)
+    assert scores[0, 0] == np.float32(0.76)
+
+def test_template_can_rescue_a_near_miss():
+    gallery = normalize_rows(np.array([[1, 1, 0, 0], [0, 0, 1, 0]], dtype=np.float32))
+    probe = np.array([[1, 0.3, 0, 0]], dtype=np.float32)
+    templates = {7: normalize_rows(np.array([[1, 1, 0, 0], [1, 0.25, 0, 0]], dtype=np.float32))}
+    without = match_face_features(probe, gallery, [7, 8], tolerance=0.9, gallery_normalized=True)
+    assert without.assigned_ids == [None]
+    with_templates = match_face_features(probe, gallery, [7, 8], tolerance=0.9, gallery_normalized=True,
+                                         templates=templates, rerank_margin=0.2)
+    assert with_templates.assigned_ids == [7]